@@ -0,0 +1,75 @@
+import os
+import time
+
+from betfairutil.synthetic import generate_synthetic_prices_file
+
+# Arguments passed to generate_synthetic_prices_file. The event-level workload mimics an official historic data file
+# containing every market for an event
+WORKLOADS = {
+    "small": {"number_of_runners": 8, "updates_per_second": 5, "pre_off_seconds": 200},
+    "medium": {
+        "number_of_runners": 14,
+        "updates_per_second": 10,
+        "pre_off_seconds": 1_000,
+    },
+    "event": {
+        "number_of_markets": 8,
+        "number_of_runners": 14,
+        "updates_per_second": 20,
+        "pre_off_seconds": 1_000,
+    },
+}
+# Arguments passed to generate_synthetic_prices_file when generating race files. A race file only ever covers a single
+# race so the event-level workload is the race file recorded alongside the event-level prices file, with the longer
+# race and higher update rate of the busiest races
+RACE_WORKLOADS = {
+    "small": {
+        "number_of_runners": 8,
+        "inplay_seconds": 60,
+        "race_updates_per_second": 10,
+    },
+    "medium": {
+        "number_of_runners": 14,
+        "inplay_seconds": 300,
+        "race_updates_per_second": 20,
+    },
+    "event": {
+        "number_of_markets": 8,
+        "number_of_runners": 14,
+        "inplay_seconds": 600,
+        "race_updates_per_second": 50,
+    },
+}
+
+
+def create_prices_files(directory: str) -> dict[str, str]:
+    paths_to_prices_files = {}
+    for workload, kwargs in WORKLOADS.items():
+        path_to_prices_file = os.path.join(directory, f"{workload}.json")
+        generate_synthetic_prices_file(path_to_prices_file, **kwargs)
+        paths_to_prices_files[workload] = path_to_prices_file
+    return paths_to_prices_files
+
+
+def create_race_files(directory: str) -> dict[str, str]:
+    paths_to_race_files = {}
+    for workload, kwargs in RACE_WORKLOADS.items():
+        path_to_race_file = os.path.join(directory, f"{workload}.jsonl")
+        generate_synthetic_prices_file(
+            os.path.join(directory, f"{workload}-race.json"),
+            path_to_race_file=path_to_race_file,
+            pre_off_seconds=0,
+            updates_per_second=1,
+            **kwargs,
+        )
+        paths_to_race_files[workload] = path_to_race_file
+    return paths_to_race_files
+
+
+def measure_rate(fun, amount: float) -> float:
+    """
+    Call fun once and return amount divided by the number of seconds it took, for use in asv track benchmarks
+    """
+    start = time.perf_counter()
+    fun()
+    return amount / (time.perf_counter() - start)
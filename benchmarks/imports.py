@@ -0,0 +1,19 @@
+# Each timeraw benchmark is run in a fresh interpreter so these measure the full cost of importing betfairutil
+
+
+def timeraw_import_betfairutil():
+    return "import betfairutil"
+
+
+def timeraw_import_betfairutil_and_betfairlightweight():
+    return """
+    import betfairutil
+    betfairutil.MarketBook
+    """
+
+
+def timeraw_import_betfairutil_examples():
+    return """
+    import betfairutil
+    betfairutil.EXAMPLE_MARKET_BOOK
+    """
@@ -0,0 +1,54 @@
+import os
+import random
+
+from betfairutil import BETFAIR_PRICES
+from betfairutil import Side
+from betfairutil import calculate_book_percentage
+from betfairutil import calculate_market_book_diff
+from betfairutil import make_price_betfair_valid
+from betfairutil import read_prices_file
+
+from .common import WORKLOADS
+from .common import create_prices_files
+
+
+class LadderSuite:
+    params = list(WORKLOADS)
+    param_names = ["workload"]
+
+    def setup_cache(self):
+        return create_prices_files(os.getcwd())
+
+    def setup(self, paths_to_prices_files, workload):
+        self.market_books = read_prices_file(paths_to_prices_files[workload])
+        # Event-level files interleave the updates of several markets so consecutive market books are only diffed when
+        # they belong to the same market
+        market_books_by_market_id = {}
+        for market_book in self.market_books:
+            market_books_by_market_id.setdefault(market_book["marketId"], []).append(
+                market_book
+            )
+        self.consecutive_market_books = [
+            (previous_market_book, current_market_book)
+            for market_books in market_books_by_market_id.values()
+            for previous_market_book, current_market_book in zip(
+                market_books, market_books[1:]
+            )
+        ]
+        rng = random.Random(0)
+        self.prices = [
+            rng.uniform(BETFAIR_PRICES[0], BETFAIR_PRICES[-1]) for _ in range(10_000)
+        ]
+
+    def time_calculate_market_book_diff(self, paths_to_prices_files, workload):
+        for previous_market_book, current_market_book in self.consecutive_market_books:
+            calculate_market_book_diff(current_market_book, previous_market_book)
+
+    def time_calculate_book_percentage(self, paths_to_prices_files, workload):
+        for market_book in self.market_books:
+            calculate_book_percentage(market_book, Side.BACK)
+
+    def time_make_price_betfair_valid(self, paths_to_prices_files, workload):
+        for price in self.prices:
+            make_price_betfair_valid(price, Side.BACK)
+            make_price_betfair_valid(price, Side.LAY)
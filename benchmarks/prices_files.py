@@ -0,0 +1,106 @@
+import os
+
+from betfairutil import DataFrameFormatEnum
+from betfairutil import create_market_book_generator_from_prices_file
+from betfairutil import get_total_volume_traded_from_prices_file
+from betfairutil import prices_file_to_data_frame
+from betfairutil import read_prices_file
+
+from .common import WORKLOADS
+from .common import create_prices_files
+from .common import measure_rate
+
+
+def _consume(path_to_prices_file: str, lightweight: bool = True) -> int:
+    number_of_market_books = 0
+    for _ in create_market_book_generator_from_prices_file(
+        path_to_prices_file, lightweight=lightweight
+    ):
+        number_of_market_books += 1
+    return number_of_market_books
+
+
+class PricesFileSuite:
+    params = list(WORKLOADS)
+    param_names = ["workload"]
+    timeout = 600
+
+    def setup_cache(self):
+        return create_prices_files(os.getcwd())
+
+    def time_create_market_book_generator_from_prices_file(
+        self, paths_to_prices_files, workload
+    ):
+        _consume(paths_to_prices_files[workload])
+
+    def time_create_market_book_generator_from_prices_file_not_lightweight(
+        self, paths_to_prices_files, workload
+    ):
+        _consume(paths_to_prices_files[workload], lightweight=False)
+
+    def time_read_prices_file(self, paths_to_prices_files, workload):
+        read_prices_file(paths_to_prices_files[workload])
+
+    def time_get_total_volume_traded_from_prices_file(
+        self, paths_to_prices_files, workload
+    ):
+        get_total_volume_traded_from_prices_file(paths_to_prices_files[workload])
+
+    def peakmem_create_market_book_generator_from_prices_file(
+        self, paths_to_prices_files, workload
+    ):
+        _consume(paths_to_prices_files[workload])
+
+    def peakmem_read_prices_file(self, paths_to_prices_files, workload):
+        read_prices_file(paths_to_prices_files[workload])
+
+    def peakmem_get_total_volume_traded_from_prices_file(
+        self, paths_to_prices_files, workload
+    ):
+        get_total_volume_traded_from_prices_file(paths_to_prices_files[workload])
+
+    def track_market_books_per_second(self, paths_to_prices_files, workload):
+        path_to_prices_file = paths_to_prices_files[workload]
+        return measure_rate(
+            lambda: _consume(path_to_prices_file), _consume(path_to_prices_file)
+        )
+
+    track_market_books_per_second.unit = "books/s"
+
+    def track_megabytes_per_second(self, paths_to_prices_files, workload):
+        path_to_prices_file = paths_to_prices_files[workload]
+        return measure_rate(
+            lambda: _consume(path_to_prices_file),
+            os.path.getsize(path_to_prices_file) / 1e6,
+        )
+
+    track_megabytes_per_second.unit = "MB/s"
+
+
+class PricesFileToDataFrameSuite:
+    # prices_file_to_data_frame builds a data frame per market book so is orders of magnitude slower than the other
+    # readers. Each benchmark is only run once per sample to keep the suite's run time manageable
+    params = list(WORKLOADS)
+    param_names = ["workload"]
+    number = 1
+    repeat = 1
+    rounds = 1
+    warmup_time = 0
+    timeout = 1200
+
+    def setup_cache(self):
+        return create_prices_files(os.getcwd())
+
+    def time_prices_file_to_data_frame(self, paths_to_prices_files, workload):
+        prices_file_to_data_frame(paths_to_prices_files[workload])
+
+    def time_prices_file_to_data_frame_last_price_traded(
+        self, paths_to_prices_files, workload
+    ):
+        prices_file_to_data_frame(
+            paths_to_prices_files[workload],
+            _format=DataFrameFormatEnum.LAST_PRICE_TRADED,
+        )
+
+    def peakmem_prices_file_to_data_frame(self, paths_to_prices_files, workload):
+        prices_file_to_data_frame(paths_to_prices_files[workload])
@@ -0,0 +1,67 @@
+import os
+
+from betfairutil import create_race_change_generator_from_race_file
+from betfairutil import race_file_to_arrays
+from betfairutil import race_file_to_rankings
+from betfairutil import read_race_file
+
+from .common import RACE_WORKLOADS
+from .common import create_race_files
+from .common import measure_rate
+
+
+def _consume(path_to_race_file: str, prefetch: int = 0) -> int:
+    number_of_race_changes = 0
+    for _ in create_race_change_generator_from_race_file(
+        path_to_race_file, prefetch=prefetch
+    ):
+        number_of_race_changes += 1
+    return number_of_race_changes
+
+
+class RaceFileSuite:
+    params = list(RACE_WORKLOADS)
+    param_names = ["workload"]
+    timeout = 600
+
+    def setup_cache(self):
+        return create_race_files(os.getcwd())
+
+    def time_create_race_change_generator_from_race_file(
+        self, paths_to_race_files, workload
+    ):
+        _consume(paths_to_race_files[workload])
+
+    def time_create_race_change_generator_from_race_file_with_prefetch(
+        self, paths_to_race_files, workload
+    ):
+        _consume(paths_to_race_files[workload], prefetch=1024)
+
+    def time_race_file_to_arrays(self, paths_to_race_files, workload):
+        race_file_to_arrays(paths_to_race_files[workload])
+
+    def time_race_file_to_rankings(self, paths_to_race_files, workload):
+        race_file_to_rankings(paths_to_race_files[workload])
+
+    def peakmem_read_race_file(self, paths_to_race_files, workload):
+        read_race_file(paths_to_race_files[workload])
+
+    def peakmem_race_file_to_arrays(self, paths_to_race_files, workload):
+        race_file_to_arrays(paths_to_race_files[workload])
+
+    def track_race_changes_per_second(self, paths_to_race_files, workload):
+        path_to_race_file = paths_to_race_files[workload]
+        return measure_rate(
+            lambda: _consume(path_to_race_file), _consume(path_to_race_file)
+        )
+
+    track_race_changes_per_second.unit = "race changes/s"
+
+    def track_megabytes_per_second(self, paths_to_race_files, workload):
+        path_to_race_file = paths_to_race_files[workload]
+        return measure_rate(
+            lambda: _consume(path_to_race_file),
+            os.path.getsize(path_to_race_file) / 1e6,
+        )
+
+    track_megabytes_per_second.unit = "MB/s"
@@ -1,9 +1,16 @@
+import copy
 import datetime
 import enum
+import functools
 import heapq
+import importlib
 import itertools
+import operator
+import os
 import pickle
 import re
+import sys
+import warnings
 from bisect import bisect_left
 from bisect import bisect_right
 from collections import deque
@@ -11,13 +18,17 @@ from collections.abc import Mapping
 from collections.abc import Sequence
 from math import asin
 from math import cos
+from math import log
 from math import radians
 from math import sin
 from math import sqrt
 from pathlib import Path
 from typing import (
     Any,
+    BinaryIO,
+    Callable,
     Generator,
+    Iterable,
     Iterator,
     Optional,
     TYPE_CHECKING,
@@ -25,17 +36,63 @@ from typing import (
 )
 
 if TYPE_CHECKING:
+    import numpy as np
     import pandas as pd
+    from betfairlightweight import APIClient
+    from betfairlightweight import StreamListener
+    from betfairlightweight.resources.bettingresources import MarketBook
+    from betfairlightweight.resources.bettingresources import MarketCatalogue
+    from betfairlightweight.resources.bettingresources import PriceSize
+    from betfairlightweight.resources.bettingresources import RunnerBook
+    from betfairlightweight.resources.streamingresources import MarketDefinition
+    from .examples import EXAMPLE_MARKET_BOOK
+    from .examples import EXAMPLE_RUNNER_BOOK
+
+# The names imported above are not part of the public interface (see __all__ at the end of the module)
+_IMPORTED_NAMES = frozenset(globals())
+
+# Importing betfairlightweight (and in turn requests) dominates the time taken to import this module so it, along with
+# the examples, is only imported when one of these attributes is first accessed (see PEP 562)
+_LAZY_ATTRIBUTE_MODULES = {
+    "APIClient": "betfairlightweight",
+    "StreamListener": "betfairlightweight",
+    "MarketBook": "betfairlightweight.resources.bettingresources",
+    "MarketCatalogue": "betfairlightweight.resources.bettingresources",
+    "PriceSize": "betfairlightweight.resources.bettingresources",
+    "RunnerBook": "betfairlightweight.resources.bettingresources",
+    "MarketDefinition": "betfairlightweight.resources.streamingresources",
+    "EXAMPLE_MARKET_BOOK": "betfairutil.examples",
+    "EXAMPLE_RUNNER_BOOK": "betfairutil.examples",
+}
+
+
+def __getattr__(name: str) -> Any:
+    module_name = _LAZY_ATTRIBUTE_MODULES.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module_name), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> list[str]:
+    return sorted({*globals(), *_LAZY_ATTRIBUTE_MODULES})
+
+
+def _is_betfairlightweight_object(o: Any, class_name: str) -> bool:
+    """
+    Test whether o is an instance of the named betfairlightweight class without importing betfairlightweight. If it has
+    not been imported yet then o cannot be an instance of one of its classes
 
-from betfairlightweight import APIClient
-from betfairlightweight import StreamListener
-from betfairlightweight.resources.bettingresources import MarketBook
-from betfairlightweight.resources.bettingresources import MarketCatalogue
-from betfairlightweight.resources.bettingresources import PriceSize
-from betfairlightweight.resources.bettingresources import RunnerBook
-from betfairlightweight.resources.streamingresources import MarketDefinition
+    :param o: The object to test
+    :param class_name: The name of the betfairlightweight class, for example "MarketBook"
+    :return: True if o is an instance of the class otherwise False
+    """
+    if type(o) is dict:
+        return False
+    module = sys.modules.get(_LAZY_ATTRIBUTE_MODULES[class_name])
+    return module is not None and isinstance(o, getattr(module, class_name))
 
-from .examples import *
 
 BETFAIR_PRICES = [
     1.01,
@@ -1455,17 +1512,85 @@ _AVERAGE_EARTH_RADIUS_IN_METERS = 6371008.8
 
 class _OpenMocker:
     def __init__(self, path_to_file: str):
+        # smart_open keeps a reference to builtins.open when it is first imported so it must be imported before
+        # builtins.open is patched otherwise it would end up calling this mock recursively
+        import smart_open
+
         self.path_to_file = path_to_file
+        self.smart_open = smart_open.open
 
     def open(self, file, *args, **kwargs):
         if file == self.path_to_file:
-            import smart_open
-
-            return smart_open.open(file, *args, **kwargs)
+            return self.smart_open(file, *args, **kwargs)
         else:
             return _ORIGINAL_OPEN(file, *args, **kwargs)
 
 
+def _is_compressed_file(path_to_file: Union[str, Path]) -> bool:
+    import smart_open.compression
+
+    return str(path_to_file).endswith(
+        tuple(smart_open.compression.get_supported_extensions())
+    )
+
+
+def _create_reverse_line_generator(
+    f: BinaryIO, block_size: int = 1 << 16
+) -> Generator[bytes, None, None]:
+    """
+    Read the lines of a seekable binary file from last to first by seeking backwards from the end of the file in
+    blocks, so that reading can stop as soon as the line of interest has been found
+
+    :param f: The seekable binary file to read, which must not be a decompressing stream
+    :param block_size: The number of bytes to read at a time
+    :return: A generator of the non-empty lines of the file, from last to first, without line endings
+    """
+    position = f.seek(0, os.SEEK_END)
+    remainder = b""
+    while position > 0:
+        read_size = min(block_size, position)
+        position -= read_size
+        f.seek(position)
+        lines = (f.read(read_size) + remainder).split(b"\n")
+        # The first line may be incomplete so keep it until the preceding block has been read
+        remainder = lines[0]
+        for line in reversed(lines[1:]):
+            line = line.rstrip(b"\r")
+            if line:
+                yield line
+    remainder = remainder.rstrip(b"\r")
+    if remainder:
+        yield remainder
+
+
+def _find_last_line(
+    path_to_file: Union[str, Path], predicate: Callable[[bytes], bool]
+) -> Optional[bytes]:
+    """
+    Find the last line of a file satisfying a predicate. Uncompressed files which can be seeked, including local files
+    and those stored in AWS S3, are read backwards from the end and reading stops at the first match. Compressed files
+    and streams which cannot be seeked are read forwards in full, retaining only the latest match
+
+    :param path_to_file: The file to search. This can be a local file, one stored in AWS S3, or any of the other options that can be handled by the smart_open package. The file can be compressed or uncompressed
+    :param predicate: A function taking a line of the file as bytes and returning whether it is of interest
+    :return: The last line satisfying predicate, or None if there is no such line
+    """
+    import smart_open
+
+    with smart_open.open(path_to_file, "rb") as f:
+        if not _is_compressed_file(path_to_file) and f.seekable():
+            for line in _create_reverse_line_generator(f):
+                if predicate(line):
+                    return line
+            return None
+
+        the_line = None
+        for line in f:
+            if predicate(line):
+                the_line = line
+        return the_line
+
+
 def _load_json_object(o: Union[dict[str, Any], str, Path]) -> dict[str, Any]:
     """
     Takes either a JSON object and simply returns it or a path to a JSON file containing a JSON
@@ -1476,20 +1601,139 @@ def _load_json_object(o: Union[dict[str, Any], str, Path]) -> dict[str, Any]:
         o refers to contains
     """
     if isinstance(o, (str, Path)):
-        import orjson
-        import smart_open
-
-        with smart_open.open(o, "r") as f:
-            o = orjson.loads(f.read())
+        o = _read_json_file(o)
 
     return o
 
 
+def _read_json_file(path_to_file: Union[str, Path]) -> dict[str, Any]:
+    import orjson
+    import smart_open
+
+    with smart_open.open(path_to_file, "r") as f:
+        return orjson.loads(f.read())
+
+
+def _extract_race_card_and_result_fields(
+    path_to_file: str, mtime_ns: int
+) -> dict[str, Any]:
+    # The modification time is part of the cache key so that a file which has been rewritten is read again. Only the
+    # extracted values are kept, not the parsed file. Errors are kept too and raised when the value is asked for
+    o = _read_json_file(path_to_file)
+    fields = {}
+    for name, getter in [
+        ("bsp", get_bsp_from_race_result),
+        ("winners", get_winners_from_race_result),
+        ("distance_in_metres", get_race_distance_in_metres_from_race_card),
+        ("is_jump", get_is_jump_from_race_card),
+        ("win_market_id", get_win_market_id_from_race_card),
+    ]:
+        try:
+            fields[name] = getter(o)
+        except Exception as e:
+            fields[name] = e
+    return fields
+
+
+_extract_race_card_and_result_fields_cached = functools.lru_cache(maxsize=1024)(
+    _extract_race_card_and_result_fields
+)
+
+
+# Returned by _get_race_card_or_result_field when the value cannot be cached
+_NOT_CACHED = object()
+
+
+def _get_race_card_or_result_field(o: Any, name: str) -> Any:
+    """
+    Look up a value extracted from a local race card or race result file, parsing the file only the first time any of
+    its values is asked for
+
+    :param o: The argument passed to one of the race card or race result functions
+    :param name: The name of the value
+    :return: The value, or _NOT_CACHED if o is not the path to a local file
+    """
+    if not isinstance(o, (str, Path)):
+        return _NOT_CACHED
+    try:
+        mtime_ns = os.stat(o).st_mtime_ns
+    except OSError:
+        return _NOT_CACHED
+    value = _extract_race_card_and_result_fields_cached(os.path.abspath(o), mtime_ns)[
+        name
+    ]
+    if isinstance(value, Exception):
+        raise value
+    return value
+
+
+def set_race_card_and_result_cache_size(maxsize: Optional[int] = 1024) -> None:
+    """
+    Set how many local race card and race result files the values extracted by get_bsp_from_race_result,
+    get_winners_from_race_result, get_race_distance_in_metres_from_race_card, get_is_jump_from_race_card and
+    get_win_market_id_from_race_card are cached for, so that calling several of these functions on the same file only
+    parses it once. The cache is cleared
+
+    :param maxsize: The number of files. 0 disables the cache and None makes it unbounded
+    """
+    global _extract_race_card_and_result_fields_cached
+    _extract_race_card_and_result_fields_cached = functools.lru_cache(maxsize=maxsize)(
+        _extract_race_card_and_result_fields
+    )
+
+
+def clear_race_card_and_result_cache() -> None:
+    """
+    Discard the cached values extracted from local race card and race result files. See
+    set_race_card_and_result_cache_size
+    """
+    _extract_race_card_and_result_fields_cached.cache_clear()
+
+
 class DataFrameFormatEnum(enum.Enum):
     FULL_LADDER = "FULL_LADDER"
     LAST_PRICE_TRADED = "LAST_PRICE_TRADED"
 
 
+class CopyModeEnum(enum.Enum):
+    DEEP_COPY = "DEEP_COPY"
+    STRUCTURAL_SHARING = "STRUCTURAL_SHARING"
+    IN_PLACE = "IN_PLACE"
+
+
+class WindowSelectorEnum(enum.Enum):
+    MIN = "MIN"
+    MAX = "MAX"
+    FIRST = "FIRST"
+    LAST = "LAST"
+
+
+# The arguments accepted by betfairlightweight's RunnerBook and those without defaults
+_RUNNER_BOOK_FIELDS = frozenset(
+    {
+        "selectionId",
+        "status",
+        "handicap",
+        "adjustmentFactor",
+        "lastPriceTraded",
+        "totalMatched",
+        "removalDate",
+        "sp",
+        "ex",
+        "orders",
+        "matches",
+        "matchesByStrategy",
+    }
+)
+_RUNNER_BOOK_REQUIRED_FIELDS = frozenset({"selectionId", "status", "handicap"})
+_MARKET_DEFINITION_REQUIRED_FIELDS = frozenset(
+    {"betDelay", "inPlay", "marketTime", "runners", "status"}
+)
+_MARKET_DEFINITION_RUNNER_REQUIRED_FIELDS = frozenset({"id", "status"})
+_PRICE_SIZE_LADDER_KEYS = ("atb", "atl", "trd", "spb", "spl")
+_LEVEL_PRICE_SIZE_LADDER_KEYS = ("batb", "batl", "bdatb", "bdatl")
+
+
 class Side(enum.Enum):
     BACK = "Back"
     LAY = "Lay"
@@ -1540,213 +1784,1630 @@ class MarketBookDiff:
         return self.d[(selection_id, handicap)].get(ex_key)
 
 
-def calculate_book_percentage(
-    market_book: Union[dict[str, Any], MarketBook], side: Side
-) -> float:
-    implied_probabilities = []
-    for runner in iterate_active_runners(market_book):
-        best_price_size = get_best_price_size(runner, side)
-        if best_price_size is not None:
-            if isinstance(best_price_size, PriceSize):
-                best_price = best_price_size.price
-            else:
-                best_price = best_price_size["price"]
-        else:
-            best_price = None
-
-        if best_price is not None:
-            implied_probabilities.append(1.0 / best_price)
-        else:
-            if side is Side.BACK:
-                other_best_price_size = get_best_price_size(runner, side.other_side)
-                if other_best_price_size is not None:
-                    implied_probabilities.append(1.0)
+class _RunnerIndexState:
+    __slots__ = (
+        "runners",
+        "runners_length",
+        "positions",
+        "market_definition_runners",
+        "market_definition_runners_length",
+        "name_positions",
+    )
 
-    return sum(implied_probabilities)
+    def __init__(self):
+        self.runners = None
+        self.runners_length = None
+        self.positions = {}
+        self.market_definition_runners = None
+        self.market_definition_runners_length = None
+        self.name_positions = {}
 
 
-def calculate_available_volume(
-    market_book: Union[dict[str, Any], MarketBook],
-    side: Side,
-    max_book_percentage: float,
-) -> float:
+class RunnerIndex:
     """
-    Calculate the available volume up to a maximum book_percentage value.
-
-    :param market_book: A market book either as a dictionary or betfairlightweight MarketBook object
-    :param side: Indicate whether to get the available volume on the back or lay side.
-    :param max_book_percentage: Maximum book_percentage value to use for calculating the volume.
-    :return: Available total volume.
+    An index of the runners in one or more markets that allows runner books to be looked up by selection ID or runner
+    name in O(1) time. Within a market, Betfair keeps the order of both the runners and the market definition runners
+    fixed so the index stores each runner's position and validates it on every lookup. The positions are recalculated
+    when a stored position turns out to be stale or when a runner is not found in a runners list or market definition
+    the index has not seen before (or whose length has changed since), which typically only happens when the market
+    definition changes. A runners list which is modified in place therefore cannot give a stale answer. A single index
+    can be shared across many markets as state is kept per market ID
     """
-    available_volume = 0
-    for depth in itertools.count():
-        book_percentage = 0
-        size = 0
-        for runner in market_book["runners"]:
-            runner_price_size = get_price_size_by_depth(
-                runner=runner, side=side, depth=depth
-            )
-            if runner_price_size:
-                book_percentage += 1.0 / runner_price_size["price"]
-                size += runner_price_size["size"]
-            else:
-                return available_volume
 
-        if book_percentage <= max_book_percentage:
-            available_volume += size
+    def __init__(self):
+        self._states: dict[Optional[str], _RunnerIndexState] = {}
 
+    def clear(self, market_id: Optional[str] = None) -> None:
+        """
+        Discard the cached positions either for a single market or, if market_id is None, for all markets
 
-def calculate_market_book_diff(
-    current_market_book: Union[dict[str, Any], MarketBook],
-    previous_market_book: Union[dict[str, Any], MarketBook],
-) -> MarketBookDiff:
-    """
-    Calculate the size differences between amounts available to back, available to lay, and traded between two market books
+        :param market_id: Optionally the market whose cached positions should be discarded
+        """
+        if market_id is None:
+            self._states.clear()
+        else:
+            self._states.pop(market_id, None)
 
-    :param current_market_book: The current market book to use in the comparison
-    :param previous_market_book: The previous market book to use in the comparison
-    :return: The complete set of size differences stored in a MarketBookDiff
-    """
-    if isinstance(current_market_book, MarketBook):
-        current_market_book = current_market_book._data
-    if isinstance(previous_market_book, MarketBook):
-        previous_market_book = previous_market_book._data
+    def get_runner_position(
+        self,
+        market_book: Union[Mapping[str, Any], "MarketBook"],
+        selection_id: Optional[int] = None,
+        runner_name: Optional[str] = None,
+        handicap: float = 0.0,
+    ) -> Optional[int]:
+        """
+        Find the position of a runner within the runners of a market book
+
+        :param market_book: A market book either as a mapping or betfairlightweight MarketBook object
+        :param selection_id: Optionally identify the runner by the runner's ID
+        :param runner_name: Alternatively identify the runner by the runner's name
+        :param handicap: The handicap of the desired runner
+        :return: The index of the runner in the market book's runners if it can be found otherwise None
+        """
+        if _is_betfairlightweight_object(market_book, "MarketBook"):
+            market_book = market_book._data
+
+        market_id = market_book.get("marketId")
+        state = self._states.get(market_id)
+        if state is None:
+            state = _RunnerIndexState()
+            self._states[market_id] = state
 
-    diff = {
-        (runner["selectionId"], runner["handicap"]): {ex_key: {} for ex_key in EX_KEYS}
-        for runner in current_market_book["runners"]
-    }
+        if selection_id is None:
+            market_definition_runners = market_book.get("marketDefinition", {}).get(
+                "runners", []
+            )
+            position = state.name_positions.get(runner_name)
+            if not (
+                position is not None
+                and position < len(market_definition_runners)
+                and market_definition_runners[position].get("name") == runner_name
+            ):
+                if (
+                    position is None
+                    and market_definition_runners is state.market_definition_runners
+                    and len(market_definition_runners)
+                    == state.market_definition_runners_length
+                ):
+                    return
+                state.market_definition_runners = market_definition_runners
+                state.market_definition_runners_length = len(market_definition_runners)
+                state.name_positions = {}
+                for i, runner in enumerate(market_definition_runners):
+                    state.name_positions.setdefault(runner.get("name"), i)
+                position = state.name_positions.get(runner_name)
+                if position is None:
+                    return
+            selection_id = market_definition_runners[position].get("id")
+            if selection_id is None:
+                return
+
+        runners = market_book.get("runners", [])
+        position = state.positions.get((selection_id, handicap))
+        if (
+            position is not None
+            and position < len(runners)
+            and runners[position].get("selectionId") == selection_id
+            and runners[position].get("handicap", 0) == handicap
+        ):
+            return position
 
-    for current_runner in current_market_book["runners"]:
-        previous_runner = get_runner_book_from_market_book(
-            previous_market_book,
-            current_runner["selectionId"],
-            handicap=current_runner["handicap"],
-        )
-        if current_runner == previous_runner:
-            continue
+        if (
+            position is None
+            and runners is state.runners
+            and len(runners) == state.runners_length
+        ):
+            return
+        state.runners = runners
+        state.runners_length = len(runners)
+        state.positions = {}
+        for i, runner in enumerate(runners):
+            state.positions.setdefault(
+                (runner.get("selectionId"), runner.get("handicap", 0)), i
+            )
+        return state.positions.get((selection_id, handicap))
 
-        for ex_key in EX_KEYS:
-            previous_prices = {
-                price_size["price"]: price_size["size"]
-                for price_size in previous_runner.get("ex", {}).get(ex_key, [])
-            }
-            current_prices = {
-                price_size["price"]: price_size["size"]
-                for price_size in current_runner.get("ex", {}).get(ex_key, [])
-            }
-            all_prices = set(itertools.chain(previous_prices, current_prices))
 
-            for price in all_prices:
-                previous_size = previous_prices.get(price, 0)
-                current_size = current_prices.get(price, 0)
-                delta = round(current_size - previous_size, 2)
+_RunnerKey = tuple[str, int, Union[int, float]]
 
-                diff[(current_runner["selectionId"], current_runner["handicap"])][
-                    ex_key
-                ][price] = delta
 
-    return MarketBookDiff(diff)
+class _TradedVolumeTracker:
+    """
+    Tracks the cumulative volume traded at each price for every runner of one or more markets and reports the changes
+    between consecutive market books to subclasses. Market books generated from a prices file or the streaming API
+    carry the raw stream update that produced them and when this is present only the changed traded volume levels are
+    examined. A market image ("img") replaces the traded volume of every runner of the market and the volume it
+    contains is taken as a baseline rather than reported as a change. Otherwise, only runners which have changed since
+    the previous market book are compared
+    """
 
+    def __init__(self):
+        self._traded_volumes: dict[
+            _RunnerKey, dict[Union[int, float], Union[int, float]]
+        ] = {}
+        self._runners: dict[_RunnerKey, Any] = {}
+        self._runner_index = RunnerIndex()
+
+    def process_market_book(self, market_book: Union[dict[str, Any], "MarketBook"]):
+        if _is_betfairlightweight_object(market_book, "MarketBook"):
+            streaming_update = getattr(market_book, "streaming_update", None)
+            market_book = market_book._data
+        else:
+            streaming_update = market_book.get("streaming_update")
+
+        market_id = market_book["marketId"]
+        publish_time = market_book.get("publishTime")
+        if streaming_update is not None:
+            is_image = bool(streaming_update.get("img"))
+            if is_image:
+                # A market image replaces the cached state of every runner rather than updating it
+                self._clear_market(market_id, publish_time)
+            for runner_change in streaming_update.get("rc", []):
+                selection_id = runner_change["id"]
+                handicap = runner_change.get("hc", 0)
+                key = (market_id, selection_id, handicap)
+                if is_image:
+                    if runner_change.get("trd"):
+                        self._process_traded_volume_image(
+                            key, runner_change["trd"], publish_time
+                        )
+                elif "trd" in runner_change:
+                    self._process_traded_volume_levels(
+                        key, runner_change["trd"], publish_time
+                    )
+                position = self._runner_index.get_runner_position(
+                    market_book, selection_id=selection_id, handicap=handicap
+                )
+                if position is not None:
+                    self._on_runner_update(key, market_book["runners"][position])
+        else:
+            for runner in market_book.get("runners", []):
+                key = (market_id, runner["selectionId"], runner.get("handicap", 0))
+                if self._runners.get(key) is runner:
+                    continue
+                self._runners[key] = runner
+                traded_volume = runner.get("ex", {}).get("tradedVolume", [])
+                if traded_volume:
+                    previous_traded_volume = self._traded_volumes.get(key, {})
+                    current_traded_volume = {
+                        ps["price"]: ps["size"] for ps in traded_volume
+                    }
+                    levels = [
+                        [price, current_traded_volume.get(price, 0)]
+                        for price in sorted(
+                            set(
+                                itertools.chain(
+                                    previous_traded_volume, current_traded_volume
+                                )
+                            )
+                        )
+                        if current_traded_volume.get(price, 0)
+                        != previous_traded_volume.get(price, 0)
+                    ]
+                    if levels:
+                        self._process_traded_volume_levels(key, levels, publish_time)
+                else:
+                    self._process_traded_volume_levels(key, [], publish_time)
+                self._on_runner_update(key, runner)
+
+    def process_runner_change(
+        self, market_id: str, runner_change: dict[str, Any], publish_time: int
+    ):
+        """
+        Update the tracker directly from a runner change ("rc") object of the Betfair price stream. Only the traded
+        volume ("trd") field is used
+
+        :param market_id: The market ID of the market change containing the runner change
+        :param runner_change: A runner change object as a dictionary
+        :param publish_time: The publish time of the message containing the runner change
+        """
+        if "trd" in runner_change:
+            self._process_traded_volume_levels(
+                (market_id, runner_change["id"], runner_change.get("hc", 0)),
+                runner_change["trd"],
+                publish_time,
+            )
 
-def calculate_order_book_imbalance(
-    runner_book: Union[dict[str, Any], RunnerBook]
-) -> Optional[float]:
-    best_back_price_size = get_best_price_size(runner_book, Side.BACK)
-    if best_back_price_size is not None:
-        best_lay_price_size = get_best_price_size(runner_book, Side.LAY)
-        if best_lay_price_size is not None:
-            if isinstance(best_back_price_size, PriceSize):
-                back_size = best_back_price_size.size
-                lay_size = best_lay_price_size.size
+    def _process_traded_volume_levels(
+        self,
+        key: _RunnerKey,
+        levels: list[list[Union[int, float]]],
+        publish_time: Optional[int],
+    ) -> None:
+        if not levels:
+            # Betfair clears the traded volume as a market closes
+            traded_volume = self._traded_volumes.pop(key, None)
+            if traded_volume:
+                self._on_traded_volume_cleared(key, traded_volume, publish_time)
+            return
+
+        traded_volume = self._traded_volumes.get(key)
+        if traded_volume is None:
+            traded_volume = {}
+            self._traded_volumes[key] = traded_volume
+        for price, size in levels:
+            delta = round(size - traded_volume.get(price, 0), 2)
+            if size == 0:
+                traded_volume.pop(price, None)
             else:
-                back_size = best_back_price_size["size"]
-                lay_size = best_lay_price_size["size"]
+                traded_volume[price] = size
+            if delta != 0:
+                self._on_traded_volume_change(key, price, delta, publish_time)
 
-            numerator = back_size - lay_size
-            denominator = back_size + lay_size
-            return numerator / denominator
+    def _clear_market(self, market_id: str, publish_time: Optional[int]) -> None:
+        for key in [key for key in self._traded_volumes if key[0] == market_id]:
+            traded_volume = self._traded_volumes.pop(key)
+            if traded_volume:
+                self._on_traded_volume_cleared(key, traded_volume, publish_time)
 
+    def _process_traded_volume_image(
+        self,
+        key: _RunnerKey,
+        levels: list[list[Union[int, float]]],
+        publish_time: Optional[int],
+    ) -> None:
+        # The volume in an image was traded at some unknown point before it so it is not reported as a change
+        traded_volume = {price: size for price, size in levels if size != 0}
+        self._traded_volumes[key] = traded_volume
+        if traded_volume:
+            self._on_traded_volume_image(key, traded_volume, publish_time)
+
+    def _on_traded_volume_change(
+        self,
+        key: _RunnerKey,
+        price: Union[int, float],
+        delta: Union[int, float],
+        publish_time: Optional[int],
+    ) -> None:
+        pass
+
+    def _on_traded_volume_image(
+        self,
+        key: _RunnerKey,
+        traded_volume: dict[Union[int, float], Union[int, float]],
+        publish_time: Optional[int],
+    ) -> None:
+        pass
 
-def calculate_price_difference(a: Union[int, float], b: Union[int, float]) -> int:
-    """
-    Calculate the price difference between two prices as the number of steps on the Betfair price ladder. For example, the difference between 1.03 and 1.01 is 2. Conversely, the difference between 1.01 and 1.03 is -2
+    def _on_traded_volume_cleared(
+        self,
+        key: _RunnerKey,
+        traded_volume: dict[Union[int, float], Union[int, float]],
+        publish_time: Optional[int],
+    ) -> None:
+        pass
 
-    :param a: A valid Betfair price
-    :param b: A valid Betfair price
-    :return: The difference between a and b as the number of steps on the Betfair price ladder
-    :raises: As it is assumed a and b are already valid Betfair prices, an IndexError will be thrown when trying to look up an invalid price in the index map
-    """
-    a_index = BETFAIR_PRICE_TO_PRICE_INDEX_MAP[a]
-    b_index = BETFAIR_PRICE_TO_PRICE_INDEX_MAP[b]
-    return a_index - b_index
+    def _on_runner_update(self, key: _RunnerKey, runner: dict[str, Any]) -> None:
+        pass
 
 
-def calculate_total_matched(
-    market_book: Union[dict[str, Any], MarketBook]
-) -> Union[int, float]:
+class TradeTape(_TradedVolumeTracker):
     """
-    Calculate the total matched on this market from the amounts matched on each runner at each price point. Useful for historic data where this field is not populated
+    Infers individual trades from the changes in cumulative traded volume between consecutive market books of one or
+    more markets. Only the current traded volume at each price and the best available prices are held for each runner
+    so no history is retained
 
-    :param market_book: A market book either as a dictionary or betfairlightweight MarketBook object
-    :return: The total matched on this market
+    Each trade is a dictionary with the following keys:
+
+      - market_id: The Betfair market ID
+      - selection_id: The selection ID of the runner
+      - handicap: The handicap of the runner
+      - price: The price at which the volume was traded
+      - size: The increase in the volume traded at that price
+      - publish_time: The publish time of the market book in which the increase was observed
+      - aggressor_side: Side.BACK if the price was at or below the best available to back price before the update,
+        i.e. a backer took volume available to back, Side.LAY if the price was at or above the best available to lay
+        price before the update, otherwise None
     """
-    if isinstance(market_book, MarketBook):
-        market_book = market_book._data
 
-    return sum(
-        ps["size"]
-        for r in market_book.get("runners", [])
-        for ps in r.get("ex", {}).get("tradedVolume", [])
-    )
+    def __init__(self):
+        super().__init__()
+        self._best_prices: dict[
+            _RunnerKey, tuple[Optional[Union[int, float]], Optional[Union[int, float]]]
+        ] = {}
+        self._trades = []
+
+    def process_market_book(
+        self, market_book: Union[dict[str, Any], "MarketBook"]
+    ) -> list[dict[str, Any]]:
+        """
+        Update the tape with the next market book and return the trades inferred from it
+
+        :param market_book: A market book either as a dictionary or betfairlightweight MarketBook object
+        :return: A list of the trades inferred from the changes in traded volume since the previous market book of the
+            same market. See the class documentation for the format of each trade
+        """
+        self._trades = []
+        super().process_market_book(market_book)
+        return self._trades
+
+    def process_runner_change(
+        self, market_id: str, runner_change: dict[str, Any], publish_time: int
+    ) -> list[dict[str, Any]]:
+        """
+        Update the tape directly from a runner change ("rc") object of the Betfair price stream and return the trades
+        inferred from it. As only the traded volume ("trd") field is used, the aggressor side will reflect the best
+        available prices as of the last market book processed
+
+        :param market_id: The market ID of the market change containing the runner change
+        :param runner_change: A runner change object as a dictionary
+        :param publish_time: The publish time of the message containing the runner change
+        :return: A list of the trades inferred from the runner change
+        """
+        self._trades = []
+        super().process_runner_change(market_id, runner_change, publish_time)
+        return self._trades
+
+    def _on_traded_volume_change(
+        self,
+        key: _RunnerKey,
+        price: Union[int, float],
+        delta: Union[int, float],
+        publish_time: Optional[int],
+    ) -> None:
+        if delta < 0:
+            return
 
+        best_back_price, best_lay_price = self._best_prices.get(key, (None, None))
+        if best_back_price is not None and price <= best_back_price:
+            aggressor_side = Side.BACK
+        elif best_lay_price is not None and price >= best_lay_price:
+            aggressor_side = Side.LAY
+        else:
+            aggressor_side = None
+        self._trades.append(
+            {
+                "market_id": key[0],
+                "selection_id": key[1],
+                "handicap": key[2],
+                "price": price,
+                "size": delta,
+                "publish_time": publish_time,
+                "aggressor_side": aggressor_side,
+            }
+        )
 
-def convert_yards_to_metres(yards: Optional[Union[int, float]]) -> Optional[float]:
-    if yards is None:
-        return None
+    def _on_runner_update(self, key: _RunnerKey, runner: dict[str, Any]) -> None:
+        ex = runner.get("ex") or {}
+        available_to_back = ex.get("availableToBack") or []
+        available_to_lay = ex.get("availableToLay") or []
+        self._best_prices[key] = (
+            available_to_back[0]["price"] if available_to_back else None,
+            available_to_lay[0]["price"] if available_to_lay else None,
+        )
 
-    return yards * NUMBER_OF_METRES_IN_A_YARD
 
+class TradedVolumeStatistics(_TradedVolumeTracker):
+    """
+    Maintains traded volume statistics for every runner of one or more markets from consecutive market books or raw
+    price stream runner changes. Each update costs time proportional to the number of changed traded volume levels
+    rather than the size of the ladder. The following are available at any time:
 
-def does_market_book_contain_runner_names(
-    market_book: Union[dict[str, Any], MarketBook]
-) -> bool:
-    if isinstance(market_book, dict):
-        market_definition = market_book["marketDefinition"]
-    else:
-        market_definition = market_book.market_definition
-        if market_definition is None:
-            return False
+      - The total matched on each market, as calculate_total_matched would give for the latest market book
+      - The total matched and volume weighted average price (VWAP) of each runner
+      - The volume traded at each price (the volume profile) of each runner
+      - The volume traded on each runner within one or more rolling windows of publish time
 
-    return does_market_definition_contain_runner_names(market_definition)
+    Betfair zeroes the traded volume as a market closes. The totals, VWAPs and volume profiles follow the data and will
+    therefore also be zeroed. Only increases in traded volume count towards the rolling windows, so the volume contained
+    in a market image does not
 
+    :param rolling_windows: The lengths of the rolling windows in milliseconds
+    """
 
-def does_market_definition_contain_runner_names(
-    market_definition: Union[dict[str, Any], MarketDefinition]
-) -> bool:
-    if isinstance(market_definition, dict):
-        runners = market_definition.get("runners", [])
-    else:
-        runners = market_definition.runners
+    def __init__(self, rolling_windows: Sequence[int] = ()):
+        super().__init__()
+        self.rolling_windows = tuple(rolling_windows)
+        self._total_matched: dict[str, Union[int, float]] = {}
+        self._runner_total_matched: dict[_RunnerKey, Union[int, float]] = {}
+        self._runner_notional: dict[_RunnerKey, Union[int, float]] = {}
+        self._rolling_trades: dict[
+            _RunnerKey, list[deque[tuple[int, Union[int, float]]]]
+        ] = {}
+        self._rolling_volumes: dict[_RunnerKey, list[Union[int, float]]] = {}
+        self._latest_publish_times: dict[str, int] = {}
+
+    def process_market_book(
+        self, market_book: Union[dict[str, Any], "MarketBook"]
+    ) -> None:
+        """
+        Update the statistics with the next market book
+
+        :param market_book: A market book either as a dictionary or betfairlightweight MarketBook object
+        """
+        super().process_market_book(market_book)
+        if _is_betfairlightweight_object(market_book, "MarketBook"):
+            market_book = market_book._data
+        if market_book.get("publishTime") is not None:
+            self._latest_publish_times[market_book["marketId"]] = market_book[
+                "publishTime"
+            ]
 
-    if len(runners) == 0:
-        return False
+    def process_runner_change(
+        self, market_id: str, runner_change: dict[str, Any], publish_time: int
+    ) -> None:
+        """
+        Update the statistics directly from a runner change ("rc") object of the Betfair price stream. Only the traded
+        volume ("trd") field is used
+
+        :param market_id: The market ID of the market change containing the runner change
+        :param runner_change: A runner change object as a dictionary
+        :param publish_time: The publish time of the message containing the runner change
+        """
+        super().process_runner_change(market_id, runner_change, publish_time)
+        self._latest_publish_times[market_id] = publish_time
+
+    def get_total_matched(self, market_id: str) -> Union[int, float]:
+        """
+        Get the total volume traded on a market
+
+        :param market_id: The market ID of the market
+        :return: The total volume traded on the market, rounded to 2 decimal places, or 0 if the market has not been seen
+        """
+        return round(self._total_matched.get(market_id, 0), 2)
+
+    def get_runner_total_matched(
+        self, market_id: str, selection_id: int, handicap: Union[int, float] = 0
+    ) -> Union[int, float]:
+        """
+        Get the total volume traded on a runner
+
+        :param market_id: The market ID of the runner
+        :param selection_id: The selection ID of the runner
+        :param handicap: The handicap of the runner
+        :return: The total volume traded on the runner, rounded to 2 decimal places, or 0 if the runner has not been
+            seen
+        """
+        return round(
+            self._runner_total_matched.get((market_id, selection_id, handicap), 0), 2
+        )
 
-    runner = runners[0]
+    def get_vwap(
+        self, market_id: str, selection_id: int, handicap: Union[int, float] = 0
+    ) -> Optional[float]:
+        """
+        Get the volume weighted average price at which a runner has traded
+
+        :param market_id: The market ID of the runner
+        :param selection_id: The selection ID of the runner
+        :param handicap: The handicap of the runner
+        :return: The volume weighted average price if any volume has been traded on the runner, otherwise None
+        """
+        key = (market_id, selection_id, handicap)
+        total_matched = self._runner_total_matched.get(key, 0)
+        if round(total_matched, 2) > 0:
+            return self._runner_notional[key] / total_matched
+
+    def get_volume_profile(
+        self,
+        market_id: str,
+        selection_id: int,
+        handicap: Union[int, float] = 0,
+        should_copy: bool = True,
+    ) -> dict[Union[int, float], Union[int, float]]:
+        """
+        Get the volume traded at each price on a runner
+
+        :param market_id: The market ID of the runner
+        :param selection_id: The selection ID of the runner
+        :param handicap: The handicap of the runner
+        :param should_copy: Should a copy of the volume profile be returned. If False then the dictionary maintained by
+            this object is returned which is cheaper but will change as further updates are processed and must not be
+            modified
+        :return: A dictionary mapping price to the volume traded at that price
+        """
+        volume_profile = self._traded_volumes.get((market_id, selection_id, handicap))
+        if volume_profile is None:
+            return {}
+        return dict(volume_profile) if should_copy else volume_profile
+
+    def get_rolling_traded_volume(
+        self,
+        market_id: str,
+        selection_id: int,
+        window: int,
+        handicap: Union[int, float] = 0,
+    ) -> Union[int, float]:
+        """
+        Get the volume traded on a runner within a rolling window ending at the latest publish time processed for its
+        market
+
+        :param market_id: The market ID of the runner
+        :param selection_id: The selection ID of the runner
+        :param window: The length of the rolling window in milliseconds. Must be one of the rolling_windows given when
+            this object was created
+        :param handicap: The handicap of the runner
+        :return: The volume traded on the runner with a publish time in (latest publish time - window, latest publish
+            time]
+        :raises: ValueError if window is not one of the rolling_windows given when this object was created
+        """
+        try:
+            i = self.rolling_windows.index(window)
+        except ValueError:
+            raise ValueError(f"{window} is not one of {self.rolling_windows}")
+
+        key = (market_id, selection_id, handicap)
+        if key not in self._rolling_trades:
+            return 0
+        self._evict(key, self._latest_publish_times.get(market_id))
+        return round(self._rolling_volumes[key][i], 2)
+
+    def _evict(self, key: _RunnerKey, publish_time: Optional[int]) -> None:
+        if publish_time is None:
+            return
+        rolling_volumes = self._rolling_volumes[key]
+        for i, (window, trades) in enumerate(
+            zip(self.rolling_windows, self._rolling_trades[key])
+        ):
+            cutoff = publish_time - window
+            while trades and trades[0][0] <= cutoff:
+                rolling_volumes[i] -= trades.popleft()[1]
+
+    def _on_traded_volume_change(
+        self,
+        key: _RunnerKey,
+        price: Union[int, float],
+        delta: Union[int, float],
+        publish_time: Optional[int],
+    ) -> None:
+        market_id = key[0]
+        self._total_matched[market_id] = self._total_matched.get(market_id, 0) + delta
+        self._runner_total_matched[key] = self._runner_total_matched.get(key, 0) + delta
+        self._runner_notional[key] = self._runner_notional.get(key, 0) + price * delta
+        if delta > 0 and self.rolling_windows and publish_time is not None:
+            if key not in self._rolling_trades:
+                self._rolling_trades[key] = [deque() for _ in self.rolling_windows]
+                self._rolling_volumes[key] = [0] * len(self.rolling_windows)
+            self._evict(key, publish_time)
+            for i, trades in enumerate(self._rolling_trades[key]):
+                trades.append((publish_time, delta))
+                self._rolling_volumes[key][i] += delta
+
+    def _on_traded_volume_cleared(
+        self,
+        key: _RunnerKey,
+        traded_volume: dict[Union[int, float], Union[int, float]],
+        publish_time: Optional[int],
+    ) -> None:
+        for price, size in traded_volume.items():
+            self._on_traded_volume_change(key, price, -size, publish_time)
+
+    def _on_traded_volume_image(
+        self,
+        key: _RunnerKey,
+        traded_volume: dict[Union[int, float], Union[int, float]],
+        publish_time: Optional[int],
+    ) -> None:
+        # Volume from an image counts towards the totals but not the rolling windows
+        market_id = key[0]
+        for price, size in traded_volume.items():
+            self._total_matched[market_id] = (
+                self._total_matched.get(market_id, 0) + size
+            )
+            self._runner_total_matched[key] = (
+                self._runner_total_matched.get(key, 0) + size
+            )
+            self._runner_notional[key] = (
+                self._runner_notional.get(key, 0) + price * size
+            )
+
+
+class SimulatedOrder:
+    """
+    A simulated limit order resting against a replayed Betfair order book. The status follows the Betfair order
+    statuses: PENDING while the order is subject to the bet delay, EXECUTABLE while it has unmatched size and
+    EXECUTION_COMPLETE once it has been fully matched, cancelled or lapsed
+
+    :param order_id: An identifier for the order unique within a SimulatedMatchingEngine
+    :param market_id: The market ID of the runner the order is placed on
+    :param selection_id: The selection ID of the runner the order is placed on
+    :param handicap: The handicap of the runner the order is placed on
+    :param side: Whether the order is to back or lay the runner
+    :param price: The limit price of the order
+    :param size: The size of the order
+    :param placed_time: The publish time at which the order was placed
+    :param active_time: The publish time at which the order reaches the exchange, i.e. after any bet delay
+    """
+
+    __slots__ = (
+        "order_id",
+        "market_id",
+        "selection_id",
+        "handicap",
+        "side",
+        "price",
+        "size",
+        "placed_time",
+        "active_time",
+        "status",
+        "size_matched",
+        "size_cancelled",
+        "size_lapsed",
+        "matched_notional",
+        "queue_ahead",
+        "_level_size",
+        "_level_price_sizes",
+        "_traded",
+    )
+
+    def __init__(
+        self,
+        order_id: int,
+        market_id: str,
+        selection_id: int,
+        handicap: Union[int, float],
+        side: Side,
+        price: Union[int, float],
+        size: Union[int, float],
+        placed_time: int,
+        active_time: int,
+    ):
+        self.order_id = order_id
+        self.market_id = market_id
+        self.selection_id = selection_id
+        self.handicap = handicap
+        self.side = side
+        self.price = price
+        self.size = size
+        self.placed_time = placed_time
+        self.active_time = active_time
+        self.status = "PENDING"
+        self.size_matched = 0
+        self.size_cancelled = 0
+        self.size_lapsed = 0
+        self.matched_notional = 0
+        # The volume at this price which must trade before this order starts to be matched
+        self.queue_ahead = 0
+        self._level_size = 0
+        self._level_price_sizes = None
+        self._traded = 0
+
+    @property
+    def size_remaining(self) -> Union[int, float]:
+        return round(
+            self.size - self.size_matched - self.size_cancelled - self.size_lapsed, 2
+        )
+
+    @property
+    def average_price_matched(self) -> Optional[float]:
+        if self.size_matched > 0:
+            return self.matched_notional / self.size_matched
+
+    def __repr__(self) -> str:
+        return (
+            f"<SimulatedOrder {self.order_id}: {self.side.value} {self.size} @ {self.price} on "
+            f"{self.market_id}/{self.selection_id} {self.status}>"
+        )
+
+
+class SimulatedMatchingEngine(_TradedVolumeTracker):
+    """
+    Simulates the matching of orders against a replayed Betfair order book, typically the market books generated from
+    a prices file. Orders reach the exchange once the market's bet delay has elapsed and are immediately matched
+    against any available volume at the same or better prices. Any remainder rests in the queue at its price behind
+    the volume already available there. The queue is then worked through by increases in the volume traded at that
+    price while any other reduction in the available volume is treated as cancellations spread evenly across the
+    queue. Any volume traded at a price better than the order's price means the market has traded through it, so the
+    order is filled in full at its price. Only runners which have changed are examined on each update. Unmatched orders are lapsed when the market
+    closes and orders still subject to the bet delay are lapsed if the market is suspended when they would otherwise
+    reach the exchange
+
+    The simulation makes the usual simplifying assumptions: simulated orders do not affect the replayed order book or
+    each other's queue positions and available volume matched by a simulated order remains available to other
+    simulated orders
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._next_order_id = 1
+        self._orders: dict[_RunnerKey, list[SimulatedOrder]] = {}
+        self._pending_orders: dict[str, list[SimulatedOrder]] = {}
+        self._latest_runners: dict[_RunnerKey, dict[str, Any]] = {}
+        self._markets: dict[str, dict[str, Any]] = {}
+        self._fills: list[dict[str, Any]] = []
+        self._publish_time = None
+
+    def place_order(
+        self,
+        market_id: str,
+        selection_id: int,
+        side: Side,
+        price: Union[int, float],
+        size: Union[int, float],
+        handicap: Union[int, float] = 0,
+        publish_time: Optional[int] = None,
+    ) -> SimulatedOrder:
+        """
+        Place a simulated order. The order will reach the exchange once the bet delay of the market, as of the latest
+        market book processed, has elapsed. If that is immediately then any fills against the available volume are
+        returned by the next call to process_market_book
+
+        :param market_id: The market ID of the runner to place the order on
+        :param selection_id: The selection ID of the runner to place the order on
+        :param side: Whether to back or lay the runner
+        :param price: The limit price of the order
+        :param size: The size of the order
+        :param handicap: The handicap of the runner to place the order on
+        :param publish_time: The time at which the order is placed. Defaults to the publish time of the latest market
+            book processed for the market
+        :return: The order, which will be updated in place as it is matched
+        :raises: ValueError if no market book has been processed for the market
+        """
+        market = self._markets.get(market_id)
+        if market is None:
+            raise ValueError(f"No market book has been processed for {market_id}")
+        if publish_time is None:
+            publish_time = market["publishTime"]
+        bet_delay = market.get("betDelay") or 0
+
+        order = SimulatedOrder(
+            order_id=self._next_order_id,
+            market_id=market_id,
+            selection_id=selection_id,
+            handicap=handicap,
+            side=side,
+            price=price,
+            size=size,
+            placed_time=publish_time,
+            active_time=publish_time + bet_delay * 1000,
+        )
+        self._next_order_id += 1
+        self._pending_orders.setdefault(market_id, []).append(order)
+        if order.active_time <= market["publishTime"]:
+            self._publish_time = market["publishTime"]
+            self._activate_orders(market_id, market["publishTime"])
+        return order
+
+    def cancel_order(
+        self, order: SimulatedOrder, size_reduction: Optional[Union[int, float]] = None
+    ) -> None:
+        """
+        Cancel all or part of the unmatched size of a simulated order. Cancellations are not subject to the bet delay
+
+        :param order: The order to cancel
+        :param size_reduction: Optionally the amount by which to reduce the unmatched size. If not given then all of
+            the unmatched size is cancelled
+        """
+        size_remaining = order.size_remaining
+        if size_reduction is None or size_reduction > size_remaining:
+            size_reduction = size_remaining
+        order.size_cancelled = round(order.size_cancelled + size_reduction, 2)
+        if order.size_remaining <= 0:
+            self._complete_order(order)
+
+    def process_market_book(
+        self, market_book: Union[dict[str, Any], "MarketBook"]
+    ) -> list[dict[str, Any]]:
+        """
+        Update the simulation with the next market book and return the resulting fills
+
+        :param market_book: A market book either as a dictionary or betfairlightweight MarketBook object
+        :return: A list of fills, each a dictionary with the keys "order", "price", "size" and "publish_time". This
+            includes any fills made as orders were placed since the previous market book was processed
+        """
+        # The original market book is passed on so that the raw stream update of a MarketBook object is available
+        data = (
+            market_book._data
+            if _is_betfairlightweight_object(market_book, "MarketBook")
+            else market_book
+        )
+        market_id = data["marketId"]
+        self._markets[market_id] = data
+        self._publish_time = data.get("publishTime")
+        super().process_market_book(market_book)
+        if self._pending_orders.get(market_id):
+            self._activate_orders(market_id, self._publish_time)
+        if data.get("status") == "CLOSED":
+            # Any unmatched orders are lapsed when the market closes
+            for order in list(self.iterate_orders(market_id)):
+                order.size_lapsed = order.size_remaining
+                self._complete_order(order)
+        fills = self._fills
+        self._fills = []
+        return fills
+
+    def iterate_orders(
+        self, market_id: Optional[str] = None
+    ) -> Generator[SimulatedOrder, None, None]:
+        """
+        Iterate the orders which are pending or executable
+
+        :param market_id: Optionally restrict the orders to a single market
+        """
+        for orders in self._pending_orders.values():
+            for order in orders:
+                if market_id is None or order.market_id == market_id:
+                    yield order
+        for orders in self._orders.values():
+            for order in orders:
+                if market_id is None or order.market_id == market_id:
+                    yield order
+
+    def _activate_orders(self, market_id: str, publish_time: int) -> None:
+        market = self._markets[market_id]
+        still_pending = []
+        for order in self._pending_orders[market_id]:
+            if order.status != "PENDING":
+                continue
+            if order.active_time > publish_time:
+                still_pending.append(order)
+                continue
+            if market.get("status") != "OPEN":
+                # Orders in flight when a market suspends are lapsed
+                order.size_lapsed = order.size_remaining
+                self._complete_order(order)
+                continue
+            order.status = "EXECUTABLE"
+            key = (order.market_id, order.selection_id, order.handicap)
+            runner = self._latest_runners.get(key)
+            if runner is None:
+                position = self._runner_index.get_runner_position(
+                    market, selection_id=order.selection_id, handicap=order.handicap
+                )
+                if position is not None:
+                    runner = market["runners"][position]
+            if runner is not None:
+                self._match_available_volume(order, runner)
+                self._join_queue(order, runner)
+            if order.status == "EXECUTABLE":
+                self._orders.setdefault(key, []).append(order)
+        self._pending_orders[market_id] = still_pending
+
+    def _fill(
+        self, order: SimulatedOrder, price: Union[int, float], size: Union[int, float]
+    ) -> None:
+        size = min(size, order.size_remaining)
+        if size <= 0:
+            return
+        order.size_matched = round(order.size_matched + size, 2)
+        order.matched_notional += price * size
+        self._fills.append(
+            {
+                "order": order,
+                "price": price,
+                "size": size,
+                "publish_time": self._publish_time,
+            }
+        )
+        if order.size_remaining <= 0:
+            self._complete_order(order)
+
+    def _complete_order(self, order: SimulatedOrder) -> None:
+        if order.status == "EXECUTABLE":
+            orders = self._orders.get(
+                (order.market_id, order.selection_id, order.handicap), []
+            )
+            if order in orders:
+                orders.remove(order)
+        order.status = "EXECUTION_COMPLETE"
+
+    def _match_available_volume(
+        self, order: SimulatedOrder, runner: dict[str, Any]
+    ) -> None:
+        for price_size in iterate_price_sizes(runner, order.side):
+            if not is_price_the_same_or_better(
+                price_size["price"], order.price, order.side
+            ):
+                break
+            self._fill(order, price_size["price"], price_size["size"])
+            if order.status != "EXECUTABLE":
+                break
+
+    def _join_queue(self, order: SimulatedOrder, runner: dict[str, Any]) -> None:
+        order._level_price_sizes = runner.get("ex", {}).get(
+            order.side.other_side.ex_key
+        )
+        order._level_size = next(
+            (
+                price_size["size"]
+                for price_size in order._level_price_sizes or []
+                if price_size["price"] == order.price
+            ),
+            0,
+        )
+        order.queue_ahead = order._level_size
+
+    def _on_traded_volume_change(
+        self,
+        key: _RunnerKey,
+        price: Union[int, float],
+        delta: Union[int, float],
+        publish_time: Optional[int],
+    ) -> None:
+        if delta <= 0:
+            return
+        for order in list(self._orders.get(key, ())):
+            if order.price == price:
+                order._traded += delta
+                consumed = min(order.queue_ahead, delta)
+                order.queue_ahead -= consumed
+                self._fill(order, price, delta - consumed)
+            elif is_price_the_same_or_better(price, order.price, order.side):
+                # The market has traded through the order so everything ahead of it, and the order, has been matched
+                order.queue_ahead = 0
+                self._fill(order, order.price, order.size_remaining)
+
+    def _on_runner_update(self, key: _RunnerKey, runner: dict[str, Any]) -> None:
+        self._latest_runners[key] = runner
+        orders = self._orders.get(key)
+        if not orders:
+            return
+
+        for order in list(orders):
+            price_sizes = runner.get("ex", {}).get(order.side.other_side.ex_key)
+            if price_sizes is not order._level_price_sizes:
+                order._level_price_sizes = price_sizes
+                level_size = next(
+                    (
+                        price_size["size"]
+                        for price_size in price_sizes or []
+                        if price_size["price"] == order.price
+                    ),
+                    0,
+                )
+                remaining_level_size = order._level_size - order._traded
+                cancelled = remaining_level_size - level_size
+                if cancelled > 0 and remaining_level_size > 0:
+                    order.queue_ahead -= (
+                        order.queue_ahead * cancelled / remaining_level_size
+                    )
+                order.queue_ahead = max(0, min(order.queue_ahead, level_size))
+                order._level_size = level_size
+            order._traded = 0
+            self._match_available_volume(order, runner)
+
+
+class VirtualLadderCalculator:
+    """
+    Calculates the virtual (cross matched) ladders Betfair generates for each runner in a market from the ladders of
+    all of the other active runners. A virtual price available to back on a runner is created by combining volume
+    available to lay on every other runner and vice versa. Each virtual level is found by taking the best level of each
+    of the other runners: the virtual price is 1 / (1 - sum of the implied probabilities) and the virtual size is
+    limited by whichever runner's level can cover the least. The volume used is then removed from every level and the
+    process repeated. The calculations are vectorised across all runners using NumPy and the ladders of each runner are
+    only converted into arrays when they change. Similarly, the virtual ladders on a side are only recalculated when
+    the ladders they depend on have changed
+
+    :param max_depth: The maximum number of virtual levels to calculate for each runner on each side
+    :param max_iterations: Optionally limit the number of levels of the other runners' ladders to combine. By default
+        this continues until max_depth virtual levels have been found or the other runners' ladders are exhausted
+    """
+
+    def __init__(self, max_depth: int = 3, max_iterations: Optional[int] = None):
+        self.max_depth = max_depth
+        self.max_iterations = max_iterations
+        self._selection_ids = None
+        self._source_price_sizes: dict[Side, list] = {}
+        self._arrays: dict[Side, tuple] = {}
+        self._ladders: dict[Side, dict[int, list[dict[str, Union[int, float]]]]] = {}
+
+    def update(
+        self, market_book: Union[dict[str, Any], "MarketBook"]
+    ) -> dict[int, dict[str, list[dict[str, Union[int, float]]]]]:
+        """
+        Calculate the virtual ladders for the next market book of the market
+
+        :param market_book: A market book either as a dictionary or betfairlightweight MarketBook object
+        :return: A dictionary mapping the selection ID of each active runner to its virtual ladders. These are in the
+            same format as the "ex" field of a runner book except there is no "tradedVolume"
+        """
+        if _is_betfairlightweight_object(market_book, "MarketBook"):
+            market_book = market_book._data
+
+        runners = list(iterate_active_runners(market_book))
+        selection_ids = tuple(runner["selectionId"] for runner in runners)
+        is_new_set_of_runners = selection_ids != self._selection_ids
+        if is_new_set_of_runners:
+            self._selection_ids = selection_ids
+            self._source_price_sizes = {side: [None] * len(runners) for side in Side}
+            self._arrays = {}
+            self._ladders = {side: {} for side in Side}
+
+        for side in Side:
+            # Volume available on one side of the other runners creates virtual volume on this side
+            source_side = side.other_side
+            source_price_sizes = self._source_price_sizes[source_side]
+            changed = []
+            for i, runner in enumerate(runners):
+                price_sizes = runner.get("ex", {}).get(source_side.ex_key) or []
+                if price_sizes is not source_price_sizes[i]:
+                    source_price_sizes[i] = price_sizes
+                    changed.append(i)
+            if not changed:
+                continue
+
+            self._update_arrays(source_side, changed)
+            if len(changed) == 1 and not is_new_set_of_runners:
+                # A runner's virtual ladder does not depend on its own ladder
+                targets = [i for i in range(len(runners)) if i != changed[0]]
+            else:
+                targets = list(range(len(runners)))
+            for i, ladder in zip(
+                targets, self._calculate_virtual_ladders(source_side, targets)
+            ):
+                self._ladders[side][selection_ids[i]] = ladder
+
+        return {
+            selection_id: {
+                side.ex_key: self._ladders[side].get(selection_id, []) for side in Side
+            }
+            for selection_id in selection_ids
+        }
+
+    def _update_arrays(self, source_side: Side, changed: list[int]) -> None:
+        import numpy as np
+
+        source_price_sizes = self._source_price_sizes[source_side]
+        n = len(source_price_sizes)
+        depth = max(len(source_price_sizes[i]) for i in changed)
+        arrays = self._arrays.get(source_side)
+        # One extra column of padding ensures walking off the end of a ladder is always detectable
+        if arrays is None:
+            arrays = (np.full((n, depth + 1), np.nan), np.zeros((n, depth + 1)))
+        elif depth + 1 > arrays[0].shape[1]:
+            capacity = max(depth + 1, 2 * arrays[0].shape[1])
+            prices = np.full((n, capacity), np.nan)
+            sizes = np.zeros((n, capacity))
+            prices[:, : arrays[0].shape[1]] = arrays[0]
+            sizes[:, : arrays[1].shape[1]] = arrays[1]
+            arrays = (prices, sizes)
+        self._arrays[source_side] = arrays
+
+        prices, sizes = arrays
+        for i in changed:
+            price_sizes = source_price_sizes[i]
+            prices[i] = np.nan
+            sizes[i] = 0
+            prices[i, : len(price_sizes)] = [ps["price"] for ps in price_sizes]
+            sizes[i, : len(price_sizes)] = [ps["size"] for ps in price_sizes]
+
+    def _calculate_virtual_ladders(
+        self, source_side: Side, targets: list[int]
+    ) -> list[list[dict[str, Union[int, float]]]]:
+        import numpy as np
+
+        prices, sizes = self._arrays[source_side]
+        n = prices.shape[0]
+        if n < 2 or not targets:
+            return [[] for _ in targets]
+
+        side = source_side.other_side
+        number_of_prices = len(BETFAIR_PRICES)
+        betfair_prices = np.asarray(BETFAIR_PRICES, dtype=float)
+        t = len(targets)
+        columns = np.arange(n)[None, :]
+        is_target = np.asarray(targets)[:, None] == columns
+        level = np.zeros((t, n), dtype=int)
+        remaining = np.repeat(sizes[None, :, 0], t, axis=0)
+        alive = np.ones(t, dtype=bool)
+        number_of_levels = np.zeros(t, dtype=int)
+        last_index = np.full(t, -1)
+
+        step_indices = []
+        step_sizes = []
+        max_iterations = self.max_iterations or prices.shape[1] * (n - 1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for _ in range(max_iterations):
+                best_prices = prices[columns, level]
+                total = np.where(is_target, 0.0, 1.0 / best_prices).sum(axis=1)
+                alive &= np.isfinite(total) & (total < 1)
+                if not alive.any():
+                    break
+
+                raw_price = 1.0 / (1.0 - total)
+                # Equivalent to make_price_betfair_valid(raw_price, side)
+                if side is Side.BACK:
+                    index = np.searchsorted(betfair_prices, raw_price, side="left")
+                else:
+                    index = np.searchsorted(betfair_prices, raw_price, side="right") - 1
+                is_valid = alive & (index >= 0) & (index < number_of_prices)
+                number_of_levels += is_valid & (index != last_index)
+                is_valid &= number_of_levels <= self.max_depth
+                alive &= number_of_levels <= self.max_depth
+                if not alive.any():
+                    break
+
+                # The amount each other runner's best level can cover limits the virtual size
+                cover = np.where(is_target, np.inf, remaining * best_prices).min(axis=1)
+                step_indices.append(np.where(is_valid, index, -1))
+                step_sizes.append(cover / raw_price)
+                last_index = np.where(is_valid, index, last_index)
+
+                remaining = remaining - np.where(
+                    is_target | ~alive[:, None], 0.0, cover[:, None] / best_prices
+                )
+                exhausted = (remaining <= 1e-9) & ~is_target & alive[:, None]
+                if exhausted.any():
+                    level = level + exhausted
+                    remaining = np.where(exhausted, sizes[columns, level], remaining)
+
+        ladders = []
+        for k in range(t):
+            ladder = []
+            for indices, step_size in zip(step_indices, step_sizes):
+                index = indices[k]
+                if index < 0:
+                    continue
+                price = BETFAIR_PRICES[index]
+                if ladder and ladder[-1]["price"] == price:
+                    ladder[-1]["size"] += step_size[k]
+                else:
+                    ladder.append({"price": price, "size": step_size[k]})
+            for price_size in ladder:
+                price_size["size"] = round(float(price_size["size"]), 2)
+            ladders.append([ps for ps in ladder if ps["size"] > 0])
+        return ladders
+
+
+def calculate_virtual_ladders(
+    market_book: Union[dict[str, Any], "MarketBook"], max_depth: int = 3
+) -> dict[int, dict[str, list[dict[str, Union[int, float]]]]]:
+    """
+    Calculate the virtual (cross matched) ladders for each active runner in a market book. See VirtualLadderCalculator
+    for details and for efficiently calculating the virtual ladders of consecutive market books
+
+    :param market_book: A market book either as a dictionary or betfairlightweight MarketBook object
+    :param max_depth: The maximum number of virtual levels to calculate for each runner on each side
+    :return: A dictionary mapping the selection ID of each active runner to its virtual ladders. These are in the same
+        format as the "ex" field of a runner book except there is no "tradedVolume"
+    """
+    return VirtualLadderCalculator(max_depth=max_depth).update(market_book)
+
+
+class RollingWindow:
+    """
+    Maintains statistics of the values observed within a rolling window of publish time in amortised O(1) time per
+    observation. The count, sum, mean and variance are kept as running totals while the minimum and maximum are kept
+    using monotonic deques
+
+    :param length: The length of the window in milliseconds. An observation at publish time t remains in the window
+        until an observation or eviction at a publish time of t + length or later
+    """
+
+    __slots__ = (
+        "length",
+        "_observations",
+        "_minimums",
+        "_maximums",
+        "_shift",
+        "_sum",
+        "_sum_of_squares",
+    )
+
+    def __init__(self, length: int):
+        self.length = length
+        self._observations: deque[tuple[int, Union[int, float]]] = deque()
+        self._minimums: deque[tuple[int, Union[int, float]]] = deque()
+        self._maximums: deque[tuple[int, Union[int, float]]] = deque()
+        # Values are shifted by the first value observed to limit the loss of precision in the variance
+        self._shift = 0
+        self._sum = 0
+        self._sum_of_squares = 0
+
+    def append(self, publish_time: int, value: Union[int, float]) -> None:
+        self.evict(publish_time)
+        if not self._observations:
+            self._shift = value
+            self._sum = 0
+            self._sum_of_squares = 0
+        self._observations.append((publish_time, value))
+        shifted_value = value - self._shift
+        self._sum += shifted_value
+        self._sum_of_squares += shifted_value * shifted_value
+        while self._minimums and self._minimums[-1][1] >= value:
+            self._minimums.pop()
+        self._minimums.append((publish_time, value))
+        while self._maximums and self._maximums[-1][1] <= value:
+            self._maximums.pop()
+        self._maximums.append((publish_time, value))
+
+    def evict(self, publish_time: int) -> None:
+        """
+        Remove any observations which have fallen out of the window as of the given publish time
+
+        :param publish_time: The current publish time
+        """
+        cutoff = publish_time - self.length
+        observations = self._observations
+        while observations and observations[0][0] <= cutoff:
+            shifted_value = observations.popleft()[1] - self._shift
+            self._sum -= shifted_value
+            self._sum_of_squares -= shifted_value * shifted_value
+        while self._minimums and self._minimums[0][0] <= cutoff:
+            self._minimums.popleft()
+        while self._maximums and self._maximums[0][0] <= cutoff:
+            self._maximums.popleft()
+
+    @property
+    def count(self) -> int:
+        return len(self._observations)
+
+    @property
+    def sum(self) -> Union[int, float]:
+        return self._sum + self._shift * len(self._observations)
+
+    @property
+    def mean(self) -> Optional[float]:
+        if self._observations:
+            return self._shift + self._sum / len(self._observations)
+
+    @property
+    def variance(self) -> Optional[float]:
+        """
+        The sample variance of the values in the window or None if there are fewer than two
+        """
+        n = len(self._observations)
+        if n > 1:
+            return max(
+                0.0, (self._sum_of_squares - self._sum * self._sum / n) / (n - 1)
+            )
+
+    @property
+    def std(self) -> Optional[float]:
+        variance = self.variance
+        if variance is not None:
+            return sqrt(variance)
+
+    @property
+    def min(self) -> Optional[Union[int, float]]:
+        if self._minimums:
+            return self._minimums[0][1]
+
+    @property
+    def max(self) -> Optional[Union[int, float]]:
+        if self._maximums:
+            return self._maximums[0][1]
+
+
+def _count_update(runner: Union[dict[str, Any], "RunnerBook"]) -> int:
+    return 1
+
+
+class RollingWindowStatistics:
+    """
+    Maintains rolling window statistics of features of each runner over one or more windows of publish time, for
+    example the volatility of the mid price, the average weight of money or spread, or the number of updates. Consumes
+    consecutive market books, such as those generated by create_market_book_generator_from_prices_file or received from
+    the streaming API. A runner is only observed when it has changed since the previous market book so each update costs
+    amortised O(1) time per changed runner, feature and window. Windows are brought up to date with the latest publish
+    time of the market whenever they are retrieved
+
+    The default features are:
+
+      - mid_price: The mid price as calculated by get_mid_price
+      - weight_of_money: The order book imbalance as calculated by calculate_order_book_imbalance
+      - spread: The spread in ticks as calculated by get_spread
+      - updates: 1 for each update so the count of the window is the number of updates (ticks)
+
+    :param windows: The lengths of the windows in milliseconds
+    :param features: Optionally a mapping from feature name to a function taking a runner book and returning the value
+        of the feature or None if it is not available. Defaults to the features above
+    :param log_return_features: The names of features whose log returns - the log of the ratio of consecutive values -
+        should also be tracked, under the feature name suffixed with "_log_return". The standard deviation of the
+        mid_price_log_return windows gives the mid price volatility
+    """
+
+    def __init__(
+        self,
+        windows: Sequence[int],
+        features: Optional[
+            Mapping[str, Callable[[Union[dict[str, Any], "RunnerBook"]], Any]]
+        ] = None,
+        log_return_features: Sequence[str] = ("mid_price",),
+    ):
+        self.windows = tuple(windows)
+        if features is None:
+            features = {
+                "mid_price": get_mid_price,
+                "weight_of_money": calculate_order_book_imbalance,
+                "spread": get_spread,
+                "updates": _count_update,
+            }
+        self.features = dict(features)
+        self.log_return_features = tuple(log_return_features)
+        self._rolling_windows: dict[tuple[_RunnerKey, str], list[RollingWindow]] = {}
+        self._runners: dict[_RunnerKey, Any] = {}
+        self._previous_values: dict[tuple[_RunnerKey, str], Union[int, float]] = {}
+        self._latest_publish_times: dict[str, int] = {}
+
+    def process_market_book(
+        self, market_book: Union[dict[str, Any], "MarketBook"]
+    ) -> None:
+        """
+        Update the statistics with the next market book
+
+        :param market_book: A market book either as a dictionary or betfairlightweight MarketBook object
+        """
+        if _is_betfairlightweight_object(market_book, "MarketBook"):
+            runner_books = market_book.runners
+            market_book = market_book._data
+        else:
+            runner_books = None
+
+        market_id = market_book["marketId"]
+        publish_time = market_book["publishTime"]
+        self._latest_publish_times[market_id] = publish_time
+        for i, runner in enumerate(market_book.get("runners", [])):
+            key = (market_id, runner["selectionId"], runner.get("handicap", 0))
+            if self._runners.get(key) is runner:
+                continue
+            self._runners[key] = runner
+            if runner_books is not None:
+                runner = runner_books[i]
+            for name, feature in self.features.items():
+                value = feature(runner)
+                if value is None:
+                    continue
+                self._append(key, name, publish_time, value)
+                if name in self.log_return_features:
+                    previous_value = self._previous_values.get((key, name))
+                    self._previous_values[(key, name)] = value
+                    if previous_value is not None and previous_value > 0 and value > 0:
+                        self._append(
+                            key,
+                            f"{name}_log_return",
+                            publish_time,
+                            log(value / previous_value),
+                        )
+
+    def get_window(
+        self,
+        market_id: str,
+        selection_id: int,
+        feature: str,
+        window: int,
+        handicap: Union[int, float] = 0,
+    ) -> RollingWindow:
+        """
+        Get the rolling window of a feature of a runner as of the latest publish time processed for its market
+
+        :param market_id: The market ID of the runner
+        :param selection_id: The selection ID of the runner
+        :param feature: The name of the feature
+        :param window: The length of the window in milliseconds. Must be one of the windows given when this object was
+            created
+        :param handicap: The handicap of the runner
+        :return: The rolling window. If the feature has never been observed for the runner then an empty window
+        :raises: ValueError if window is not one of the windows given when this object was created
+        """
+        try:
+            i = self.windows.index(window)
+        except ValueError:
+            raise ValueError(f"{window} is not one of {self.windows}")
+
+        rolling_windows = self._rolling_windows.get(
+            ((market_id, selection_id, handicap), feature)
+        )
+        if rolling_windows is None:
+            return RollingWindow(window)
+        rolling_window = rolling_windows[i]
+        publish_time = self._latest_publish_times.get(market_id)
+        if publish_time is not None:
+            rolling_window.evict(publish_time)
+        return rolling_window
+
+    def _append(
+        self,
+        key: _RunnerKey,
+        name: str,
+        publish_time: int,
+        value: Union[int, float],
+    ) -> None:
+        rolling_windows = self._rolling_windows.get((key, name))
+        if rolling_windows is None:
+            rolling_windows = [RollingWindow(window) for window in self.windows]
+            self._rolling_windows[(key, name)] = rolling_windows
+        for rolling_window in rolling_windows:
+            rolling_window.append(publish_time, value)
+
+
+def calculate_book_percentage(
+    market_book: Union[dict[str, Any], "MarketBook"], side: Side
+) -> float:
+    implied_probabilities = []
+    for runner in iterate_active_runners(market_book):
+        best_price_size = get_best_price_size(runner, side)
+        if best_price_size is not None:
+            if _is_betfairlightweight_object(best_price_size, "PriceSize"):
+                best_price = best_price_size.price
+            else:
+                best_price = best_price_size["price"]
+        else:
+            best_price = None
+
+        if best_price is not None:
+            implied_probabilities.append(1.0 / best_price)
+        else:
+            if side is Side.BACK:
+                other_best_price_size = get_best_price_size(runner, side.other_side)
+                if other_best_price_size is not None:
+                    implied_probabilities.append(1.0)
+
+    return sum(implied_probabilities)
+
+
+def calculate_available_volume(
+    market_book: Union[dict[str, Any], "MarketBook"],
+    side: Side,
+    max_book_percentage: float,
+) -> float:
+    """
+    Calculate the available volume up to a maximum book_percentage value.
+
+    :param market_book: A market book either as a dictionary or betfairlightweight MarketBook object
+    :param side: Indicate whether to get the available volume on the back or lay side.
+    :param max_book_percentage: Maximum book_percentage value to use for calculating the volume.
+    :return: Available total volume.
+    """
+    available_volume = 0
+    for depth in itertools.count():
+        book_percentage = 0
+        size = 0
+        for runner in market_book["runners"]:
+            runner_price_size = get_price_size_by_depth(
+                runner=runner, side=side, depth=depth
+            )
+            if runner_price_size:
+                book_percentage += 1.0 / runner_price_size["price"]
+                size += runner_price_size["size"]
+            else:
+                return available_volume
+
+        if book_percentage <= max_book_percentage:
+            available_volume += size
+
+
+def calculate_market_book_diff(
+    current_market_book: Union[dict[str, Any], "MarketBook"],
+    previous_market_book: Union[dict[str, Any], "MarketBook"],
+) -> MarketBookDiff:
+    """
+    Calculate the size differences between amounts available to back, available to lay, and traded between two market books
+
+    :param current_market_book: The current market book to use in the comparison
+    :param previous_market_book: The previous market book to use in the comparison
+    :return: The complete set of size differences stored in a MarketBookDiff
+    """
+    if _is_betfairlightweight_object(current_market_book, "MarketBook"):
+        current_market_book = current_market_book._data
+    if _is_betfairlightweight_object(previous_market_book, "MarketBook"):
+        previous_market_book = previous_market_book._data
+
+    diff = {
+        (runner["selectionId"], runner["handicap"]): {ex_key: {} for ex_key in EX_KEYS}
+        for runner in current_market_book["runners"]
+    }
+
+    for current_runner in current_market_book["runners"]:
+        previous_runner = get_runner_book_from_market_book(
+            previous_market_book,
+            current_runner["selectionId"],
+            handicap=current_runner["handicap"],
+        )
+        if current_runner == previous_runner:
+            continue
+
+        for ex_key in EX_KEYS:
+            previous_prices = {
+                price_size["price"]: price_size["size"]
+                for price_size in previous_runner.get("ex", {}).get(ex_key, [])
+            }
+            current_prices = {
+                price_size["price"]: price_size["size"]
+                for price_size in current_runner.get("ex", {}).get(ex_key, [])
+            }
+            all_prices = set(itertools.chain(previous_prices, current_prices))
+
+            for price in all_prices:
+                previous_size = previous_prices.get(price, 0)
+                current_size = current_prices.get(price, 0)
+                delta = round(current_size - previous_size, 2)
+
+                diff[(current_runner["selectionId"], current_runner["handicap"])][
+                    ex_key
+                ][price] = delta
+
+    return MarketBookDiff(diff)
 
-    if isinstance(runner, dict):
-        name = runner.get("name")
-    else:
-        name = runner.name
+
+def calculate_order_book_imbalance(
+    runner_book: Union[dict[str, Any], "RunnerBook"]
+) -> Optional[float]:
+    best_back_price_size = get_best_price_size(runner_book, Side.BACK)
+    if best_back_price_size is not None:
+        best_lay_price_size = get_best_price_size(runner_book, Side.LAY)
+        if best_lay_price_size is not None:
+            if _is_betfairlightweight_object(best_back_price_size, "PriceSize"):
+                back_size = best_back_price_size.size
+                lay_size = best_lay_price_size.size
+            else:
+                back_size = best_back_price_size["size"]
+                lay_size = best_lay_price_size["size"]
+
+            numerator = back_size - lay_size
+            denominator = back_size + lay_size
+            return numerator / denominator
+
+
+def calculate_price_difference(a: Union[int, float], b: Union[int, float]) -> int:
+    """
+    Calculate the price difference between two prices as the number of steps on the Betfair price ladder. For example, the difference between 1.03 and 1.01 is 2. Conversely, the difference between 1.01 and 1.03 is -2
+
+    :param a: A valid Betfair price
+    :param b: A valid Betfair price
+    :return: The difference between a and b as the number of steps on the Betfair price ladder
+    :raises: As it is assumed a and b are already valid Betfair prices, an IndexError will be thrown when trying to look up an invalid price in the index map
+    """
+    a_index = BETFAIR_PRICE_TO_PRICE_INDEX_MAP[a]
+    b_index = BETFAIR_PRICE_TO_PRICE_INDEX_MAP[b]
+    return a_index - b_index
+
+
+def calculate_total_matched(
+    market_book: Union[dict[str, Any], "MarketBook"]
+) -> Union[int, float]:
+    """
+    Calculate the total matched on this market from the amounts matched on each runner at each price point. Useful for historic data where this field is not populated
+
+    :param market_book: A market book either as a dictionary or betfairlightweight MarketBook object
+    :return: The total matched on this market
+    """
+    if _is_betfairlightweight_object(market_book, "MarketBook"):
+        market_book = market_book._data
+
+    return sum(
+        ps["size"]
+        for r in market_book.get("runners", [])
+        for ps in r.get("ex", {}).get("tradedVolume", [])
+    )
+
+
+def convert_yards_to_metres(yards: Optional[Union[int, float]]) -> Optional[float]:
+    if yards is None:
+        return None
+
+    return yards * NUMBER_OF_METRES_IN_A_YARD
+
+
+def does_market_book_contain_runner_names(
+    market_book: Union[dict[str, Any], "MarketBook"]
+) -> bool:
+    if isinstance(market_book, dict):
+        market_definition = market_book["marketDefinition"]
+    else:
+        market_definition = market_book.market_definition
+        if market_definition is None:
+            return False
+
+    return does_market_definition_contain_runner_names(market_definition)
+
+
+def does_market_definition_contain_runner_names(
+    market_definition: Union[dict[str, Any], "MarketDefinition"]
+) -> bool:
+    if isinstance(market_definition, dict):
+        runners = market_definition.get("runners", [])
+    else:
+        runners = market_definition.runners
+
+    if len(runners) == 0:
+        return False
+
+    runner = runners[0]
+
+    if isinstance(runner, dict):
+        name = runner.get("name")
+    else:
+        name = runner.name
 
     return name is not None
 
 
 def filter_runners(
-    market_book: Union[dict[str, Any], MarketBook],
+    market_book: Union[dict[str, Any], "MarketBook"],
     status: str,
     excluded_selection_ids: Sequence[int],
-) -> Generator[Union[dict[str, Any], RunnerBook], None, None]:
+) -> Generator[Union[dict[str, Any], "RunnerBook"], None, None]:
     if isinstance(market_book, dict):
         runners = market_book["runners"]
     else:
@@ -1767,12 +3428,14 @@ def filter_runners(
 
 
 def get_runner_book_from_market_book(
-    market_book: Optional[Union[Mapping[str, Any], MarketBook]],
+    market_book: Optional[Union[Mapping[str, Any], "MarketBook"]],
     selection_id: Optional[int] = None,
     runner_name: Optional[str] = None,
     handicap: float = 0.0,
     return_type: Optional[type] = None,
-) -> Optional[Union[dict[str, Any], RunnerBook]]:
+    runner_index: Optional[RunnerIndex] = None,
+    should_copy: bool = True,
+) -> Optional[Union[dict[str, Any], "RunnerBook"]]:
     """
     Extract a runner book from the given market book. The runner can be identified either by ID or name
 
@@ -1781,6 +3444,8 @@ def get_runner_book_from_market_book(
     :param runner_name: Alternatively identify the runner book to extract by the runner's name
     :param handicap: The handicap of the desired runner book
     :param return_type: Optionally specify the return type to be either a dict or RunnerBook. If not given then the return type will reflect the type of market_book; if market_book is a dictionary then the return value is a dictionary. If market_book is a MarketBook object then the return value will be a RunnerBook object
+    :param runner_index: Optionally a RunnerIndex used to find the runner in O(1) time rather than scanning the market definition and runners. Worthwhile when the same runners are looked up on every update of a market
+    :param should_copy: Should a new dict or RunnerBook be constructed from the runner. If False then the runner held by market_book is returned as is: the underlying mapping if return_type is dict or the existing RunnerBook object if market_book is a MarketBook object and return_type is RunnerBook. Any changes made to the returned runner book will then be visible in market_book
     :returns: If market_book is None then None. Otherwise, the corresponding runner book if it can be found in the market book, otherwise None. The runner might not be found either because the given selection ID/runner name is not present in the market book or because the market book is missing some required fields such as the market definition. The type of the return value will depend on the return_type parameter
     :raises: ValueError if both selection_id and runner_name are given. Only one is required to uniquely identify the runner book
     """
@@ -1789,46 +3454,73 @@ def get_runner_book_from_market_book(
 
     if selection_id is not None and runner_name is not None:
         raise ValueError("Both selection_id and runner_name were given")
-    if return_type is not None and not (
-        return_type is dict or return_type is RunnerBook
-    ):
-        raise TypeError(
-            f"return_type must be either dict or RunnerBook ({return_type} given)"
-        )
+    if return_type is not None and return_type is not dict:
+        from betfairlightweight.resources.bettingresources import RunnerBook
+
+        if return_type is not RunnerBook:
+            raise TypeError(
+                f"return_type must be either dict or RunnerBook ({return_type} given)"
+            )
 
-    if isinstance(market_book, MarketBook):
+    if _is_betfairlightweight_object(market_book, "MarketBook"):
+        market_book_object = market_book
         market_book = market_book._data
-        return_type = return_type or RunnerBook
+        if return_type is None:
+            from betfairlightweight.resources.bettingresources import RunnerBook
+
+            return_type = RunnerBook
     else:
+        market_book_object = None
         return_type = return_type or dict
 
-    if selection_id is None:
-        for runner in market_book.get("marketDefinition", {}).get("runners", []):
-            if runner.get("name") == runner_name:
-                selection_id = runner.get("id")
-                break
+    if runner_index is not None:
+        position = runner_index.get_runner_position(
+            market_book,
+            selection_id=selection_id,
+            runner_name=runner_name,
+            handicap=handicap,
+        )
+        if position is None:
+            return
+        runner = market_book["runners"][position]
+    else:
         if selection_id is None:
+            for runner in market_book.get("marketDefinition", {}).get("runners", []):
+                if runner.get("name") == runner_name:
+                    selection_id = runner.get("id")
+                    break
+            if selection_id is None:
+                return
+
+        for position, runner in enumerate(market_book.get("runners", [])):
+            if (
+                runner.get("selectionId") == selection_id
+                and runner.get("handicap", 0) == handicap
+            ):
+                break
+        else:
             return
 
-    for runner in market_book.get("runners", []):
-        if (
-            runner.get("selectionId") == selection_id
-            and runner.get("handicap", 0) == handicap
-        ):
-            return return_type(**runner)
+    if should_copy:
+        return return_type(**runner)
+    if return_type is not dict:
+        if market_book_object is not None:
+            return market_book_object.runners[position]
+        return return_type(**runner)
+    return runner
 
 
 def get_best_price_size(
-    runner: Union[dict[str, Any], RunnerBook], side: Side
-) -> Optional[Union[dict[str, Union[int, float]], PriceSize]]:
-    if isinstance(runner, RunnerBook):
+    runner: Union[dict[str, Any], "RunnerBook"], side: Side
+) -> Optional[Union[dict[str, Union[int, float]], "PriceSize"]]:
+    if _is_betfairlightweight_object(runner, "RunnerBook"):
         return next(iter(getattr(runner.ex, side.ex_attribute)), None)
     else:
         return next(iter(runner.get("ex", {}).get(side.ex_key, [])), None)
 
 
 def get_mid_price(
-    runner: Union[dict[str, Any], RunnerBook]
+    runner: Union[dict[str, Any], "RunnerBook"]
 ) -> Optional[Union[int, float]]:
     best_back = get_best_price(runner, Side.BACK)
     best_lay = get_best_price(runner, Side.LAY)
@@ -1837,7 +3529,7 @@ def get_mid_price(
 
 
 def get_best_price(
-    runner: Union[dict[str, Any], RunnerBook], side: Side
+    runner: Union[dict[str, Any], "RunnerBook"], side: Side
 ) -> Optional[Union[int, float]]:
     """
     Get the best price available on a runner on side Side. This is a convenience function which retrieves the best price/size pair using get_best_price_size then returns the price field
@@ -1847,16 +3539,16 @@ def get_best_price(
     :return: The best price if one exists otherwise None
     """
     best_price_size = get_best_price_size(runner, side)
-    if isinstance(best_price_size, PriceSize):
+    if _is_betfairlightweight_object(best_price_size, "PriceSize"):
         return best_price_size.price
     elif isinstance(best_price_size, dict):
         return best_price_size["price"]
 
 
 def get_price_size_by_depth(
-    runner: Union[dict[str, Any], RunnerBook], side: Side, depth: int
-) -> Optional[Union[dict[str, Union[int, float]], PriceSize]]:
-    if isinstance(runner, RunnerBook):
+    runner: Union[dict[str, Any], "RunnerBook"], side: Side, depth: int
+) -> Optional[Union[dict[str, Union[int, float]], "PriceSize"]]:
+    if _is_betfairlightweight_object(runner, "RunnerBook"):
         available = getattr(runner.ex, side.ex_attribute)
     else:
         available = runner.get("ex", {}).get(side.ex_key, [])
@@ -1866,25 +3558,25 @@ def get_price_size_by_depth(
 
 
 def get_second_best_price_size(
-    runner: Union[dict[str, Any], RunnerBook], side: Side
-) -> Optional[Union[dict[str, Union[int, float]], PriceSize]]:
+    runner: Union[dict[str, Any], "RunnerBook"], side: Side
+) -> Optional[Union[dict[str, Union[int, float]], "PriceSize"]]:
     return get_price_size_by_depth(runner=runner, side=side, depth=1)
 
 
 def get_second_best_price(
-    runner: Union[dict[str, Any], RunnerBook], side: Side
+    runner: Union[dict[str, Any], "RunnerBook"], side: Side
 ) -> Optional[Union[int, float]]:
     second_best_price_size = get_second_best_price_size(runner, side)
-    if isinstance(second_best_price_size, PriceSize):
+    if _is_betfairlightweight_object(second_best_price_size, "PriceSize"):
         return second_best_price_size.price
     elif isinstance(second_best_price_size, dict):
         return second_best_price_size["price"]
 
 
 def iterate_price_sizes(
-    runner: Union[dict[str, Any], RunnerBook], side: Side
-) -> Iterator[Union[dict[str, Any], PriceSize]]:
-    if isinstance(runner, RunnerBook):
+    runner: Union[dict[str, Any], "RunnerBook"], side: Side
+) -> Iterator[Union[dict[str, Any], "PriceSize"]]:
+    if _is_betfairlightweight_object(runner, "RunnerBook"):
         _iter = iter(getattr(runner.ex, side.ex_attribute))
     else:
         _iter = iter(runner.get("ex", {}).get(side.ex_key, []))
@@ -1893,9 +3585,9 @@ def iterate_price_sizes(
 
 
 def iterate_prices(
-    runner: Union[dict[str, Any], RunnerBook], side: Side
+    runner: Union[dict[str, Any], "RunnerBook"], side: Side
 ) -> Generator[Union[int, float], None, None]:
-    if isinstance(runner, RunnerBook):
+    if _is_betfairlightweight_object(runner, "RunnerBook"):
         price_sizes = getattr(runner.ex, side.ex_attribute)
     else:
         price_sizes = runner.get("ex", {}).get(side.ex_key, [])
@@ -1910,7 +3602,7 @@ def iterate_prices(
 
 
 def is_market_contiguous(
-    runner: Union[dict[str, Any], RunnerBook],
+    runner: Union[dict[str, Any], "RunnerBook"],
     side: Side,
     max_depth: Optional[int] = None,
 ) -> Optional[bool]:
@@ -1942,7 +3634,7 @@ def is_market_contiguous(
 
 
 def get_best_price_with_rollup(
-    runner: Union[dict[str, Any], RunnerBook], side: Side, rollup: Union[int, float]
+    runner: Union[dict[str, Any], "RunnerBook"], side: Side, rollup: Union[int, float]
 ) -> Optional[Union[int, float]]:
     """
     Get the best price available on a runner on side Side when rolling up any volumes less than rollup
@@ -1966,7 +3658,7 @@ def get_best_price_with_rollup(
 
 
 def get_inside_best_price(
-    runner: Union[dict[str, Any], RunnerBook], side: Side
+    runner: Union[dict[str, Any], "RunnerBook"], side: Side
 ) -> Optional[Union[int, float]]:
     """
     Get the price one step up (side == Side.BACK) or down (side == Side.LAY) the Betfair price ladder from a runner's best available price
@@ -1980,7 +3672,7 @@ def get_inside_best_price(
 
 
 def get_outside_best_price(
-    runner: Union[dict[str, Any], RunnerBook], side: Side
+    runner: Union[dict[str, Any], "RunnerBook"], side: Side
 ) -> Optional[Union[int, float]]:
     """
     Get the price one step down (side == Side.BACK) or up (side == Side.LAY) the Betfair price ladder from a runner's best available price
@@ -1993,7 +3685,7 @@ def get_outside_best_price(
     return side.next_worse_price_map.get(best_price)
 
 
-def get_spread(runner: Union[dict[str, Any], RunnerBook]) -> Optional[int]:
+def get_spread(runner: Union[dict[str, Any], "RunnerBook"]) -> Optional[int]:
     """
     Get the spread - the difference between the best available to lay and best available to back prices - on a runner in terms of number of steps on the Betfair price ladder
 
@@ -2009,7 +3701,7 @@ def get_spread(runner: Union[dict[str, Any], RunnerBook]) -> Optional[int]:
     return calculate_price_difference(best_lay_price, best_back_price)
 
 
-def is_market_one_tick_wide(runner: Union[dict[str, Any], RunnerBook]) -> bool:
+def is_market_one_tick_wide(runner: Union[dict[str, Any], "RunnerBook"]) -> bool:
     spread = get_spread(runner)
     return spread == 1
 
@@ -2057,7 +3749,7 @@ def get_race_id_from_string(s: str) -> Optional[str]:
 
 
 def get_selection_id_to_runner_name_map_from_market_catalogue(
-    market_catalogue: Union[dict[str, Any], MarketCatalogue]
+    market_catalogue: Union[dict[str, Any], "MarketCatalogue"]
 ) -> dict[int, str]:
     if isinstance(market_catalogue, dict):
         runners = market_catalogue["runners"]
@@ -2077,7 +3769,7 @@ def get_selection_id_to_runner_name_map_from_market_catalogue(
 
 
 def get_bsp_from_market_definition(
-    market_definition: Union[dict[str, Any], MarketDefinition]
+    market_definition: Union[dict[str, Any], "MarketDefinition"]
 ) -> dict[int, Optional[Union[int, float]]]:
     """
     Extract a dictionary mapping selection ID to Betfair starting price from a market definition object. Only gives a
@@ -2114,7 +3806,7 @@ def get_bsp_from_prices_file(
 
 
 def get_winners_from_market_definition(
-    market_definition: Union[dict[str, Any], MarketDefinition]
+    market_definition: Union[dict[str, Any], "MarketDefinition"]
 ) -> list[int]:
     if isinstance(market_definition, dict):
         selection_ids = [
@@ -2148,14 +3840,10 @@ def get_final_market_definition_from_prices_file(
     :return: None if there are no market definitions in the file, otherwise the last one found, as a dictionary
     """
     import orjson
-    import smart_open
-
-    the_line = None
-    with smart_open.open(path_to_prices_file, "rb") as f:
-        for line in f:
-            if b"marketDefinition" in line:
-                the_line = line
 
+    the_line = _find_last_line(
+        path_to_prices_file, lambda line: b"marketDefinition" in line
+    )
     if the_line is not None:
         market_definition = orjson.loads(the_line)["mc"][0]["marketDefinition"]
         return market_definition
@@ -2186,6 +3874,141 @@ def get_all_market_definitions_from_prices_file(
     )
 
 
+def validate_prices_file(path_to_prices_file: Union[str, Path]) -> list[str]:
+    """
+    Strictly check the structure of every line of a prices file in a single pass, without constructing any market
+    books. The checks are that:
+
+      - Each line is valid JSON containing an "mcm" operation with an integer publish time which is not less than the
+        previous line's
+      - Each market change has a market ID and the first market change for each market has a market definition
+      - Market definitions have the fields betDelay, inPlay, marketTime, runners and status, and their runners have the
+        fields id and status
+      - Runner changes have an integer id and their ladders are lists of [price, size] or [level, price, size] lists of
+        numbers with non-negative sizes
+
+    :param path_to_prices_file: Where the Betfair prices file to be validated is located. This can be a local file, one stored in AWS S3, or any of the other options that can be handled by the smart_open package. The file can be compressed or uncompressed
+    :return: A description of every violation found, each prefixed by its line number. An empty list means the file is valid
+    """
+    import orjson
+    import smart_open
+
+    violations = []
+    market_ids = set()
+    previous_publish_time = None
+    with smart_open.open(path_to_prices_file, "rb") as f:
+        for line_number, line in enumerate(f, start=1):
+            prefix = f"line {line_number}"
+            if not line.strip():
+                continue
+            try:
+                message = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                violations.append(f"{prefix}: invalid JSON")
+                continue
+            if type(message) is not dict:
+                violations.append(f"{prefix}: not a JSON object")
+                continue
+            if message.get("op") != "mcm":
+                violations.append(f"{prefix}: op is {message.get('op')!r} not 'mcm'")
+            publish_time = message.get("pt")
+            if type(publish_time) is not int:
+                violations.append(f"{prefix}: pt is missing or not an integer")
+            else:
+                if (
+                    previous_publish_time is not None
+                    and publish_time < previous_publish_time
+                ):
+                    violations.append(
+                        f"{prefix}: pt {publish_time} is before the previous pt {previous_publish_time}"
+                    )
+                previous_publish_time = publish_time
+            mcs = message.get("mc")
+            if type(mcs) is not list:
+                violations.append(f"{prefix}: mc is missing or not a list")
+                continue
+            for i, mc in enumerate(mcs):
+                _validate_market_change(
+                    mc, f"{prefix}: mc[{i}]", market_ids, violations
+                )
+
+    return violations
+
+
+def _validate_market_change(
+    mc: Any, prefix: str, market_ids: set[str], violations: list[str]
+) -> None:
+    if type(mc) is not dict:
+        violations.append(f"{prefix} is not an object")
+        return
+    market_id = mc.get("id")
+    if type(market_id) is not str:
+        violations.append(f"{prefix}.id is missing or not a string")
+    market_definition = mc.get("marketDefinition")
+    if market_definition is not None:
+        if type(market_definition) is not dict:
+            violations.append(f"{prefix}.marketDefinition is not an object")
+        else:
+            missing_fields = (
+                _MARKET_DEFINITION_REQUIRED_FIELDS - market_definition.keys()
+            )
+            if missing_fields:
+                violations.append(
+                    f"{prefix}.marketDefinition is missing {sorted(missing_fields)}"
+                )
+            runners = market_definition.get("runners")
+            if type(runners) is list:
+                for j, runner in enumerate(runners):
+                    if type(runner) is not dict:
+                        violations.append(
+                            f"{prefix}.marketDefinition.runners[{j}] is not an object"
+                        )
+                    elif not runner.keys() >= _MARKET_DEFINITION_RUNNER_REQUIRED_FIELDS:
+                        violations.append(
+                            f"{prefix}.marketDefinition.runners[{j}] is missing {sorted(_MARKET_DEFINITION_RUNNER_REQUIRED_FIELDS - runner.keys())}"
+                        )
+            elif runners is not None:
+                violations.append(f"{prefix}.marketDefinition.runners is not a list")
+        market_ids.add(market_id)
+    elif market_id not in market_ids:
+        violations.append(
+            f"{prefix} is the first change for market {market_id} but has no marketDefinition"
+        )
+    rcs = mc.get("rc", [])
+    if type(rcs) is not list:
+        violations.append(f"{prefix}.rc is not a list")
+        return
+    for j, rc in enumerate(rcs):
+        rc_prefix = f"{prefix}.rc[{j}]"
+        if type(rc) is not dict:
+            violations.append(f"{rc_prefix} is not an object")
+            continue
+        if type(rc.get("id")) is not int:
+            violations.append(f"{rc_prefix}.id is missing or not an integer")
+        for ladder_keys, length in (
+            (_PRICE_SIZE_LADDER_KEYS, 2),
+            (_LEVEL_PRICE_SIZE_LADDER_KEYS, 3),
+        ):
+            for key in ladder_keys:
+                ladder = rc.get(key)
+                if ladder is None:
+                    continue
+                if type(ladder) is not list:
+                    violations.append(f"{rc_prefix}.{key} is not a list")
+                    continue
+                for k, level in enumerate(ladder):
+                    if (
+                        type(level) is not list
+                        or len(level) != length
+                        or not all(type(v) in (int, float) for v in level)
+                    ):
+                        violations.append(
+                            f"{rc_prefix}.{key}[{k}] is not a list of {length} numbers"
+                        )
+                    elif level[-1] < 0:
+                        violations.append(f"{rc_prefix}.{key}[{k}] has a negative size")
+
+
 def get_first_market_definition_from_prices_file(
     path_to_prices_file: Union[str, Path]
 ) -> Optional[dict[str, Any]]:
@@ -2257,8 +4080,55 @@ def get_inplay_bet_delay_from_prices_file(
             return market_book["marketDefinition"]["betDelay"]
 
 
+def get_first_market_books_from_prices_file(
+    path_to_prices_file: Union[str, Path],
+    predicates: Mapping[str, Callable[[Union["MarketBook", dict[str, Any]]], Any]],
+    lightweight: bool = True,
+    **kwargs,
+) -> dict[str, Optional[Union["MarketBook", dict[str, Any]]]]:
+    """
+    Find the first market book satisfying each of several predicates in a single pass over a Betfair prices file, for
+    example the first market book in play, the first with a book percentage below some threshold or the first in which
+    a runner has been removed. Once a predicate has been satisfied it is no longer evaluated and reading stops as soon
+    as every predicate has been satisfied. Predicates are evaluated in the order given and may be stateful or have side
+    effects, for example to act as callbacks
+
+    :param path_to_prices_file: Where the Betfair prices file to be processed is located. This can be a local file, one stored in AWS S3, or any of the other options that can be handled by the smart_open package. The file can be compressed or uncompressed
+    :param predicates: A mapping from name to a function taking a market book and returning a truthy value if the market book satisfies it
+    :param lightweight: Passed to StreamListener. When True, the returned market books are dicts. When false, the returned market books are betfairlightweight MarketBook objects
+    :param kwargs: Passed to StreamListener
+    :return: A dict mapping each predicate name to the first market book which satisfied it or None if no market book did
+    """
+    result = dict.fromkeys(predicates)
+    remaining_predicates = dict(predicates)
+    if not remaining_predicates:
+        return result
+
+    g = create_market_book_generator_from_prices_file(
+        path_to_prices_file=path_to_prices_file,
+        lightweight=lightweight,
+        **kwargs,
+    )
+    try:
+        for market_book in g:
+            satisfied_names = [
+                name
+                for name, predicate in remaining_predicates.items()
+                if predicate(market_book)
+            ]
+            for name in satisfied_names:
+                result[name] = market_book
+                del remaining_predicates[name]
+            if not remaining_predicates:
+                break
+    finally:
+        g.close()
+
+    return result
+
+
 def get_total_volume_traded_from_prices_file(
-    path_to_prices_file: Union[str, Path], deque_len: Optional[int] = 8
+    path_to_prices_file: Union[str, Path], deque_len: Optional[int] = None
 ) -> Optional[Union[int, float]]:
     """
     Working out the total volume traded on a market is surprisingly tricky given Betfair's shenanigans around the market
@@ -2267,47 +4137,61 @@ def get_total_volume_traded_from_prices_file(
     appears there is no consistency as to how many price stream updates are involved in this zeroing of data and so it's
     not as simple as having a rule such as "look at the second to last market book available".
 
-    If memory usage is not an issue then the most robust method would be to read the entire set of market books into
-    memory then iterate them in reverse order looking for the first market book that has a non-zero total volume traded.
-    However, in many use cases memory usage is a significant concern. For example, if you want to process tens of
-    thousands of markets and use parallel processing to speed this up then you end up needing to hold the entire set of
-    market books for multiple markets in memory simultaneously and, depending on the number of cores your machine has
-    and the number of parallel processes you use, it is easy to exhaust the total memory available.
-
-    The solution presented here is to use a deque
-    (https://docs.python.org/3/library/collections.html#collections.deque). Think of this as a limited length list
-    where when a new item is appended to the list, another item is removed for the start of the list. This is used when
-    reading the prices file to leave us with the X last market books which can then be iterated in reverse order to find
-    the last one which has a non-zero volume traded. Based on my own analysis of prices files I have settled on a
-    default maximum length of the deque of 8 - i.e. at most this function will store 8 market books in memory at any one
-    time. This is a trade-off between giving correct results and drastically cutting down on memory usage versus reading
-    the entire set of market books into memory. If memory usage is not of concern to you then you can simply set the
-    deque_len argument to None and the function will read the entire set of market books into memory ensuring
-    correctness. If you observe any prices files where a deque of length 8 doesn't give correct results then please
-    create a GitHub issue here: https://github.com/mberk/betfairutil/issues so I can investigate.
+    Rather than retaining market books, this function makes a single pass over the prices file keeping only running
+    scalars: the total volume traded, which is maintained from the traded volume changes in each update (see
+    TradedVolumeStatistics), the last non-zero total volume traded and whether all runners have been removed since then.
+    This gives the same answer as iterating the entire set of market books in reverse order looking for the first one
+    which has a non-zero volume traded, however many updates are involved in the zeroing, while using a constant amount
+    of memory with respect to the length of the file
 
     :param path_to_prices_file: Where the Betfair prices file to be processed is located. This can be a local file, one
         stored in AWS S3, or any of the other options that can be handled by the smart_open package. The file can be
         compressed or uncompressed
-    :param deque_len: The length of the deque used to limit memory usage when working out the total volume traded. See
-        discussion above. This can be set to None to use the entire set of market books which should ensure correctness
-        but dramatically increase memory usage
+    :param deque_len: Deprecated and ignored. Previously this limited the number of market books retained in memory at
+        the expense of correctness. A DeprecationWarning is issued if it is passed
     :return: The calculated total volume traded if it is available or None if the market was pulled by Betfair (i.e. all
         runners have a status of "REMOVED")
     """
-    g = create_market_book_generator_from_prices_file(path_to_prices_file)
-    market_books = deque(g, deque_len)
-    for market_book in reversed(market_books):
-        volume_traded = calculate_total_matched(market_book)
+    if deque_len is not None:
+        warnings.warn(
+            "deque_len is ignored as the total volume traded is now calculated without retaining market books and "
+            "will be removed in a future release",
+            DeprecationWarning,
+            stacklevel=2,
+        )
+    traded_volume_statistics = TradedVolumeStatistics()
+    last_non_zero_volume_traded = None
+    are_all_runners_removed = False
+    has_market_books = False
+    market_definition = None
+    is_market_definition_all_removed = False
+    for market_book in create_market_book_generator_from_prices_file(
+        path_to_prices_file
+    ):
+        has_market_books = True
+        traded_volume_statistics.process_market_book(market_book)
+        volume_traded = traded_volume_statistics.get_total_matched(
+            market_book["marketId"]
+        )
         if volume_traded > 0:
-            return volume_traded
-        if all(
-            runner["status"] == "REMOVED"
-            for runner in market_book["marketDefinition"]["runners"]
-        ):
-            return None
+            last_non_zero_volume_traded = volume_traded
+            are_all_runners_removed = False
+        else:
+            # The market definition is only re-examined when it has changed
+            if market_book["marketDefinition"] is not market_definition:
+                market_definition = market_book["marketDefinition"]
+                is_market_definition_all_removed = all(
+                    runner["status"] == "REMOVED"
+                    for runner in market_definition["runners"]
+                )
+            if is_market_definition_all_removed:
+                are_all_runners_removed = True
 
-    if len(market_books) > 0:
+    if are_all_runners_removed:
+        return None
+    if last_non_zero_volume_traded is not None:
+        return last_non_zero_volume_traded
+    if has_market_books:
         return 0
 
 
@@ -2327,6 +4211,10 @@ def get_bsp_from_race_result(
         result object
     :return: a dictionary mapping selection ID to Betfair starting price
     """
+    bsp = _get_race_card_or_result_field(race_result, "bsp")
+    if bsp is not _NOT_CACHED:
+        return dict(bsp)
+
     race_result = _load_json_object(race_result)
 
     bsp = {}
@@ -2351,12 +4239,11 @@ def get_winners_from_race_result(
         result object
     :return: a list of winning selection IDs
     """
-    if isinstance(race_result, (str, Path)):
-        import orjson
-        import smart_open
+    winning_selection_ids = _get_race_card_or_result_field(race_result, "winners")
+    if winning_selection_ids is not _NOT_CACHED:
+        return list(winning_selection_ids)
 
-        with smart_open.open(race_result, "r") as f:
-            race_result = orjson.loads(f.read())
+    race_result = _load_json_object(race_result)
 
     winning_selection_ids = []
     for runner in race_result["runners"]:
@@ -2380,6 +4267,10 @@ def get_race_distance_in_metres_from_race_card(
         containing the race card object
     :return: the race distance in metres
     """
+    distance_in_metres = _get_race_card_or_result_field(race_card, "distance_in_metres")
+    if distance_in_metres is not _NOT_CACHED:
+        return distance_in_metres
+
     race_card = _load_json_object(race_card)
     distance_in_yards = race_card["race"]["distance"]
     distance_in_metres = convert_yards_to_metres(distance_in_yards)
@@ -2387,6 +4278,10 @@ def get_race_distance_in_metres_from_race_card(
 
 
 def get_is_jump_from_race_card(race_card: Union[dict[str, Any], str, Path]) -> bool:
+    is_jump = _get_race_card_or_result_field(race_card, "is_jump")
+    if is_jump is not _NOT_CACHED:
+        return is_jump
+
     race_card = _load_json_object(race_card)
     race_type = race_card["race"]["raceType"]["full"]
     return race_type in ("Chase", "Hurdle")
@@ -2408,6 +4303,12 @@ def get_win_market_id_from_race_card(
         a string according to as_integer, if such a market can be found in the race card
         otherwise None
     """
+    market_id = _get_race_card_or_result_field(race_card, "win_market_id")
+    if market_id is not _NOT_CACHED:
+        if as_integer and market_id is not None:
+            market_id = int(market_id[2:])
+        return market_id
+
     race_card = _load_json_object(race_card)
     for market in race_card["race"]["markets"]:
         market_id = market["marketId"]
@@ -2417,6 +4318,142 @@ def get_win_market_id_from_race_card(
             return market_id
 
 
+def _summarise_race_card_or_result_file(path_to_file: str) -> dict[str, Any]:
+    o = _read_json_file(path_to_file)
+    if "race" in o:
+        return {
+            "win_market_id": get_win_market_id_from_race_card(o),
+            "distance_in_metres": get_race_distance_in_metres_from_race_card(o),
+            "is_jump": get_is_jump_from_race_card(o),
+        }
+    else:
+        return {
+            "bsp": get_bsp_from_race_result(o),
+            "winners": get_winners_from_race_result(o),
+        }
+
+
+def _try_summarise_race_card_or_result_file(
+    path_to_file: str,
+) -> tuple[Optional[dict[str, Any]], Optional[str]]:
+    # Errors are returned rather than raised so that one bad file does not fail a whole batch
+    try:
+        return _summarise_race_card_or_result_file(path_to_file), None
+    except (KeyError, TypeError, ValueError) as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+def build_race_card_and_result_index(
+    path_to_directory: Union[str, Path],
+    path_to_index_file: Optional[Union[str, Path]] = None,
+    pattern: str = "**/*.json*",
+    max_workers: Optional[int] = None,
+    should_use_processes: bool = False,
+) -> dict[str, dict[str, Any]]:
+    """
+    Scan a directory of race card and race result files scraped from the undocumented RaceCard endpoint and extract the
+    information provided by get_win_market_id_from_race_card, get_race_distance_in_metres_from_race_card,
+    get_is_jump_from_race_card, get_bsp_from_race_result and get_winners_from_race_result so that each file is only
+    parsed once. Files which cannot be parsed are skipped with a warning. If path_to_index_file is given then the
+    extracted information is saved there along with each file's modification time so that subsequent calls only parse
+    files which are new or have changed. By default, files are parsed in the calling process. As parsing is CPU bound,
+    large directories can be parsed in parallel using a process pool by setting should_use_processes to True. Where
+    processes are started by spawning, which is the default on Windows and macOS, this requires the calling script's
+    entry point to be protected by if __name__ == "__main__"
+
+    :param path_to_directory: The local directory containing the race card and race result files. Race cards are
+        distinguished from race results by the presence of a "race" key
+    :param path_to_index_file: Optionally where to persist the index between calls
+    :param pattern: The glob pattern, relative to path_to_directory, used to find the files. By default, all JSON
+        files including compressed ones
+    :param max_workers: Passed to the ProcessPoolExecutor used to parse the files if should_use_processes is True
+    :param should_use_processes: Should the files be parsed in parallel using a ProcessPoolExecutor
+    :return: A dictionary mapping race ID, as found in the file names, to a dictionary with the keys win_market_id,
+        distance_in_metres, is_jump, bsp and winners. Values are None where the corresponding race card or race result
+        file was not found. Files whose names do not contain a race ID are keyed by their path instead
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    paths_to_files = sorted(
+        str(path_to_file)
+        for path_to_file in Path(path_to_directory).glob(pattern)
+        if path_to_file.is_file()
+    )
+    if path_to_index_file is not None:
+        path_to_index_file = os.path.abspath(path_to_index_file)
+        paths_to_files = [
+            path_to_file
+            for path_to_file in paths_to_files
+            if os.path.abspath(path_to_file) != path_to_index_file
+        ]
+
+    saved_index = {}
+    if path_to_index_file is not None and os.path.exists(path_to_index_file):
+        with open(path_to_index_file, "rb") as f:
+            saved_index = pickle.load(f)
+
+    index = {}
+    paths_to_changed_files = []
+    for path_to_file in paths_to_files:
+        mtime_ns = os.stat(path_to_file).st_mtime_ns
+        entry = saved_index.get(path_to_file)
+        if entry is not None and entry[0] == mtime_ns:
+            index[path_to_file] = entry
+        else:
+            paths_to_changed_files.append((path_to_file, mtime_ns))
+
+    paths_to_parse = [path_to_file for path_to_file, _ in paths_to_changed_files]
+    if should_use_processes and paths_to_parse:
+        # Files are sent to the worker processes in chunks to limit the overhead of inter-process communication
+        chunksize = max(
+            1, len(paths_to_parse) // (4 * (max_workers or os.cpu_count() or 1))
+        )
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(
+                executor.map(
+                    _try_summarise_race_card_or_result_file,
+                    paths_to_parse,
+                    chunksize=chunksize,
+                )
+            )
+    else:
+        results = map(_try_summarise_race_card_or_result_file, paths_to_parse)
+    for (path_to_file, mtime_ns), (summary, error) in zip(
+        paths_to_changed_files, results
+    ):
+        if error is not None:
+            warnings.warn(f"Skipping {path_to_file}. {error}")
+        # Files which could not be parsed are indexed as None so they are not parsed again until they change
+        index[path_to_file] = (mtime_ns, summary)
+
+    if path_to_index_file is not None and (
+        paths_to_changed_files or index.keys() != saved_index.keys()
+    ):
+        with open(path_to_index_file, "wb") as f:
+            pickle.dump(index, f)
+
+    races = {}
+    for path_to_file, (_, summary) in index.items():
+        if summary is None:
+            continue
+        race_id = get_race_id_from_string(os.path.basename(path_to_file))
+        if race_id is None:
+            race_id = path_to_file
+        race = races.setdefault(
+            race_id,
+            {
+                "win_market_id": None,
+                "distance_in_metres": None,
+                "is_jump": None,
+                "bsp": None,
+                "winners": None,
+            },
+        )
+        race.update(summary)
+
+    return races
+
+
 def get_win_market_id_from_race_file(
     path_to_race_file: Union[str, Path],
 ) -> Optional[str]:
@@ -2426,7 +4463,7 @@ def get_win_market_id_from_race_file(
 
 def get_market_time_as_datetime(
     market_book_or_market_definition: Union[
-        dict[str, Any], MarketBook, MarketDefinition
+        dict[str, Any], "MarketBook", "MarketDefinition"
     ]
 ) -> datetime.datetime:
     """
@@ -2437,32 +4474,55 @@ def get_market_time_as_datetime(
         from which to extract the market (start) time
     :return: The market (start) time as a TIMEZONE AWARE datetime object
     """
-    if isinstance(market_book_or_market_definition, MarketBook):
+    if _is_betfairlightweight_object(market_book_or_market_definition, "MarketBook"):
         market_time_datetime = (
             market_book_or_market_definition.market_definition.market_time.replace(
                 tzinfo=datetime.timezone.utc
             )
         )
-    elif isinstance(market_book_or_market_definition, MarketDefinition):
+    elif _is_betfairlightweight_object(
+        market_book_or_market_definition, "MarketDefinition"
+    ):
         market_time_datetime = market_book_or_market_definition.market_time.replace(
             tzinfo=datetime.timezone.utc
         )
     else:
-        market_time_string = (
-            market_book_or_market_definition["marketDefinition"]["marketTime"]
-            if "marketDefinition" in market_book_or_market_definition
-            else market_book_or_market_definition["marketTime"]
+        market_time_datetime = _parse_market_time(
+            _get_market_time_string(market_book_or_market_definition)
         )
-        market_time_datetime = datetime.datetime.strptime(
-            market_time_string, "%Y-%m-%dT%H:%M:%S.000Z"
-        ).replace(tzinfo=datetime.timezone.utc)
 
     return market_time_datetime
 
 
+def _get_market_time_string(market_book_or_market_definition: dict[str, Any]) -> str:
+    return (
+        market_book_or_market_definition["marketDefinition"]["marketTime"]
+        if "marketDefinition" in market_book_or_market_definition
+        else market_book_or_market_definition["marketTime"]
+    )
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_market_time(market_time_string: str) -> datetime.datetime:
+    return datetime.datetime.strptime(
+        market_time_string, "%Y-%m-%dT%H:%M:%S.000Z"
+    ).replace(tzinfo=datetime.timezone.utc)
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_market_time_as_publish_time(market_time_string: str) -> int:
+    return _datetime_to_milliseconds(_parse_market_time(market_time_string))
+
+
+def _datetime_to_milliseconds(_datetime: datetime.datetime) -> int:
+    return (
+        _datetime - datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+    ) // datetime.timedelta(milliseconds=1)
+
+
 def get_seconds_to_market_time(
     market_book_or_market_definition: Union[
-        dict[str, Any], MarketBook, MarketDefinition
+        dict[str, Any], "MarketBook", "MarketDefinition"
     ],
     current_time: Optional[Union[int, datetime.datetime]] = None,
 ) -> float:
@@ -2480,14 +4540,33 @@ def get_seconds_to_market_time(
     :return: The number of seconds between the market time and current_time if provided, otherwise the number of seconds
         between the market time and the publish time of the market book
     """
+    if not (
+        _is_betfairlightweight_object(market_book_or_market_definition, "MarketBook")
+        or _is_betfairlightweight_object(
+            market_book_or_market_definition, "MarketDefinition"
+        )
+    ):
+        # Fast path avoiding datetime arithmetic: the parsed market time is cached by its string
+        if current_time is None:
+            current_time = market_book_or_market_definition["publishTime"]
+        if isinstance(current_time, int):
+            market_time = _parse_market_time_as_publish_time(
+                _get_market_time_string(market_book_or_market_definition)
+            )
+            return (market_time - current_time) / 1000
+
     market_time = get_market_time_as_datetime(market_book_or_market_definition)
 
     if current_time is None:
-        if isinstance(market_book_or_market_definition, MarketBook):
+        if _is_betfairlightweight_object(
+            market_book_or_market_definition, "MarketBook"
+        ):
             current_time = market_book_or_market_definition.publish_time.replace(
                 tzinfo=datetime.timezone.utc
             )
-        elif isinstance(market_book_or_market_definition, MarketDefinition):
+        elif _is_betfairlightweight_object(
+            market_book_or_market_definition, "MarketDefinition"
+        ):
             raise ValueError(
                 "current_time argument must be provided if market_book_or_market_definition is a market definition"
             )
@@ -2501,6 +4580,39 @@ def get_seconds_to_market_time(
     return seconds_to_market_time
 
 
+def calculate_seconds_to_market_time(
+    market_book_or_market_definition: Union[
+        dict[str, Any], "MarketBook", "MarketDefinition"
+    ],
+    publish_times: Sequence[int],
+) -> "np.ndarray":
+    """
+    A vectorised version of get_seconds_to_market_time: calculate the difference in seconds between the market (start)
+    time and each of many publish times at once. Requires numpy to be installed
+
+    :param market_book_or_market_definition: Either a market book either as a dictionary or betfairlightweight
+        MarketBook object or a market definition either as a dictionary or betfairlightweight MarketDefinition object
+    :param publish_times: A sequence or array of integer numbers of milliseconds since the Unix epoch
+    :return: A float array of the number of seconds between the market time and each publish time
+    """
+    import numpy as np
+
+    if _is_betfairlightweight_object(
+        market_book_or_market_definition, "MarketBook"
+    ) or _is_betfairlightweight_object(
+        market_book_or_market_definition, "MarketDefinition"
+    ):
+        market_time = _datetime_to_milliseconds(
+            get_market_time_as_datetime(market_book_or_market_definition)
+        )
+    else:
+        market_time = _parse_market_time_as_publish_time(
+            _get_market_time_string(market_book_or_market_definition)
+        )
+
+    return (market_time - np.asarray(publish_times, dtype=np.int64)) / 1000
+
+
 def decrement_price(price: Union[int, float]) -> Optional[Union[int, float]]:
     """
     Given a price return the next lower price on the Betfair price ladder
@@ -2528,13 +4640,17 @@ def is_market_book(x: Any) -> bool:
     :param x: The object to test
     :returns: True if x meets the above condition otherwise False
     """
-    if isinstance(x, MarketBook):
+    if _is_betfairlightweight_object(x, "MarketBook"):
         return True
-    try:
-        MarketBook(**x)
-        return True
-    except TypeError:
+    if not isinstance(x, Mapping):
         return False
+    runners = x.get("runners")
+    if type(runners) is not list:
+        return False
+    for runner in runners:
+        if not _is_runner_book_mapping(runner):
+            return False
+    return True
 
 
 def is_runner_book(x: Any) -> bool:
@@ -2544,13 +4660,16 @@ def is_runner_book(x: Any) -> bool:
     :param x: The object to test
     :returns: True if x meets the above condition otherwise False
     """
-    if isinstance(x, RunnerBook):
-        return True
-    try:
-        RunnerBook(**x)
+    if _is_betfairlightweight_object(x, "RunnerBook"):
         return True
-    except TypeError:
+    return _is_runner_book_mapping(x)
+
+
+def _is_runner_book_mapping(x: Any) -> bool:
+    if not isinstance(x, Mapping):
         return False
+    keys = x.keys()
+    return keys >= _RUNNER_BOOK_REQUIRED_FIELDS and keys <= _RUNNER_BOOK_FIELDS
 
 
 def is_price_the_same_or_better(
@@ -2587,15 +4706,15 @@ def is_price_worse(a: Union[int, float], b: Union[int, float], side: Side) -> bo
 
 
 def iterate_active_runners(
-    market_book: Union[dict[str, Any], MarketBook]
-) -> Generator[Union[dict[str, Any], RunnerBook], None, None]:
+    market_book: Union[dict[str, Any], "MarketBook"]
+) -> Generator[Union[dict[str, Any], "RunnerBook"], None, None]:
     for runner in filter_runners(market_book, "ACTIVE", []):
         yield runner
 
 
 def iterate_other_active_runners(
-    market_book: Union[dict[str, Any], MarketBook], selection_id: int
-) -> Generator[Union[dict[str, Any], RunnerBook], None, None]:
+    market_book: Union[dict[str, Any], "MarketBook"], selection_id: int
+) -> Generator[Union[dict[str, Any], "RunnerBook"], None, None]:
     for runner in iterate_active_runners(market_book):
         if runner["selectionId"] == selection_id:
             continue
@@ -2623,12 +4742,13 @@ def make_price_betfair_valid(
 
 
 def market_book_to_data_frame(
-    market_book: Union[dict[str, Any], MarketBook],
+    market_book: Union[dict[str, Any], "MarketBook"],
     should_output_runner_names: bool = False,
     should_output_runner_statuses: bool = False,
     should_format_publish_time: bool = False,
     max_depth: Optional[int] = None,
     _format: DataFrameFormatEnum = DataFrameFormatEnum.FULL_LADDER,
+    should_output_seconds_to_off: bool = False,
 ) -> "pd.DataFrame":
     """
     Construct a data frame representation of a market book. Each row is one point on the price ladder for a particular
@@ -2640,6 +4760,7 @@ def market_book_to_data_frame(
     :param should_format_publish_time: Should the publish time (if present in the market book) be output as is (an integer number of milliseconds) or as an ISO 8601 formatted string
     :param max_depth: Optionally limit the depth of the price ladder. Should only be used when format is DataFrameFormatEnum.FULL_LADDER
     :param _format: Controls the output of the data frame. Currently, there are two options: either the full price ladder (DataFrameFormatEnum.FULL_LADDER) or just the last price traded (DataFrameFormatEnum.LAST_PRICE_TRADED)
+    :param should_output_seconds_to_off: Should the data frame contain a seconds_to_off column. This requires the market book to have been generated from streaming data and contain a MarketDefinition
     :return: A data frame whose format is determined by the format parameter. In the case of DataFrameFormatEnum.FULL_LADDER format, each row is one point on the price ladder for a particular runner. The data frame has the following columns:
 
       - market_id: The Betfair market ID
@@ -2653,6 +4774,7 @@ def market_book_to_data_frame(
       - runner_status: (Optional): If should_output_runner_statuses is True then this column will be present
       - publish_time (Optional): If the market book was generated from streaming data (as opposed to calling the listMarketBook API endpoint) then the publish time of the market book. Otherwise this column will not be present
       - runner_name: (Optional): If should_output_runner_names is True then this column will be present. It will be populated if the market book was generated from streaming data (as opposed to calling the listMarketBook API endpoint) otherwise all entries will be None
+      - seconds_to_off: (Optional): If should_output_seconds_to_off is True then the number of seconds between the publish time and the market (start) time, as calculated by get_seconds_to_market_time
 
     In the case of DataFrameFormatEnum.LAST_PRICE_TRADED format, there is only one row per runner. The columns are as above except:
 
@@ -2665,7 +4787,7 @@ def market_book_to_data_frame(
 
     import pandas as pd
 
-    if isinstance(market_book, MarketBook):
+    if _is_betfairlightweight_object(market_book, "MarketBook"):
         market_book = market_book._data
 
     if _format == DataFrameFormatEnum.FULL_LADDER:
@@ -2726,6 +4848,9 @@ def market_book_to_data_frame(
             selection_id_to_runner_name_map.get
         )
 
+    if should_output_seconds_to_off:
+        df["seconds_to_off"] = get_seconds_to_market_time(market_book)
+
     return df
 
 
@@ -2746,8 +4871,9 @@ def prices_file_to_data_frame(
     max_depth: Optional[int] = None,
     market_definition_fields: dict[str, str] = None,
     market_type_filter: Optional[Sequence[str]] = None,
-    market_catalogues: Optional[Sequence[Union[dict[str, Any], MarketBook]]] = None,
+    market_catalogues: Optional[Sequence[Union[dict[str, Any], "MarketBook"]]] = None,
     _format: DataFrameFormatEnum = DataFrameFormatEnum.FULL_LADDER,
+    should_output_seconds_to_off: bool = False,
 ) -> "pd.DataFrame":
     """
     Read a Betfair prices file (either from the official historic data or data recorded from the streaming API in the same format) directly into a data frame
@@ -2762,6 +4888,7 @@ def prices_file_to_data_frame(
     :param market_type_filter: Optionally filter out market types which do not exist in the given sequence
     :param market_catalogues: Optionally provide a list of market catalogues, as either dicts or betfairlightweight MarketCatalogue objects, that can be used to add runner names to the data frame. Only makes sense when the prices file has been recorded from the streaming API
     :param _format: Controls the output of the data frame. Currently, there are two options: either the full price ladder (DataFrameFormatEnum.FULL_LADDER) or just the last price traded (DataFrameFormatEnum.LAST_PRICE_TRADED)
+    :param should_output_seconds_to_off: Should the data frame contain a seconds_to_off column, calculated from the integer publish time and the market time in effect at that publish time
     :return: A data frame whose format is determined by the format parameter. In the case of DataFrameFormatEnum.FULL_LADDER format, each row is one point on the price ladder for a particular runner at a particular publish time. The data frame has the following columns:
 
       - market_id: The Betfair market ID
@@ -2775,6 +4902,7 @@ def prices_file_to_data_frame(
       - runner_status: (Optional): If should_output_runner_statuses is True then this column will be present
       - publish_time: The publish time of the market book corresponding to this data point
       - runner_name: (Optional): If should_output_runner_names is True then this column will contain the name of the runner
+      - seconds_to_off: (Optional): If should_output_seconds_to_off is True then the number of seconds between the publish time and the market (start) time
 
     In the case of DataFrameFormatEnum.LAST_PRICE_TRADED format, there is one row per runner per publish time. The columns are as above except:
 
@@ -2813,6 +4941,7 @@ def prices_file_to_data_frame(
                 should_output_runner_statuses=should_output_runner_statuses,
                 max_depth=max_depth,
                 _format=_format,
+                should_output_seconds_to_off=should_output_seconds_to_off,
             )
             for mb in g()
             if (
@@ -2878,10 +5007,13 @@ def create_market_book_generator_from_prices_file(
     market_type_filter: Optional[Sequence[str]] = None,
     **kwargs,
 ) -> Generator[
-    Union[MarketBook, dict[str, Any]], None, list[Union[MarketBook, dict[str, Any]]]
+    Union["MarketBook", dict[str, Any]], None, list[Union["MarketBook", dict[str, Any]]]
 ]:
     from unittest.mock import patch
 
+    from betfairlightweight import APIClient
+    from betfairlightweight import StreamListener
+
     open_mocker = _OpenMocker(path_to_prices_file)
 
     trading = APIClient(username="", password="", app_key="")
@@ -2911,7 +5043,35 @@ def create_market_book_generator_from_prices_file(
                 ):
                     yield market_book
 
-    return stream.listener.snap()
+    return stream.listener.snap()
+
+
+def create_trade_generator_from_prices_file(
+    path_to_prices_file: Union[str, Path],
+    market_type_filter: Optional[Sequence[str]] = None,
+    **kwargs,
+) -> Generator[dict[str, Any], None, None]:
+    """
+    Creates a generator of the individual trades that can be inferred from a Betfair prices file. Betfair only publishes
+    the cumulative volume traded at each price so each trade is the increase in that volume between consecutive
+    updates. The trades are calculated as the file is read using a TradeTape so no market books are retained
+
+    :param path_to_prices_file: Where the Betfair prices file to be processed is located. This can be a local file, one
+        stored in AWS S3, or any of the other options that can be handled by the smart_open package. The file can be
+        compressed or uncompressed
+    :param market_type_filter: Optionally filter out market books with a market type which does not exist in the given
+        sequence
+    :param kwargs: Other arguments passed to the betfairlightweight StreamListener
+    :return: A generator yielding trades as dictionaries. See TradeTape for the format of each trade
+    """
+    trade_tape = TradeTape()
+    for market_book in create_market_book_generator_from_prices_file(
+        path_to_prices_file,
+        lightweight=True,
+        market_type_filter=market_type_filter,
+        **kwargs,
+    ):
+        yield from trade_tape.process_market_book(market_book)
 
 
 def get_market_books_from_prices_file(
@@ -2919,14 +5079,15 @@ def get_market_books_from_prices_file(
     publish_times: Sequence[int],
     lightweight: bool = True,
     **kwargs,
-) -> dict[int, Optional[Union[MarketBook, dict[str, Any]]]]:
+) -> dict[int, Optional[Union["MarketBook", dict[str, Any]]]]:
     """Extract the market books corresponding to the given publish times from a Betfair prices file
 
     The market books are extracted as a list of tuples of publish time and market book. If a publish time does not
     exactly appear in the prices file then the most recent market book prior to it will be returned. Any given publish
     times which come before the first market book in the prices file will have None paired with them. This function is
     far more memory efficient than using read_prices_file and bisect functions. Currently only intended to be used with
-    prices files that contain data for a single Betfair market
+    prices files that contain data for a single Betfair market. For many markets or files see
+    get_market_books_from_prices_files
 
     :param path_to_prices_file:
         Where the Betfair prices file to be processed is located. This can be a local file, one stored in AWS S3, or any
@@ -2950,115 +5111,609 @@ def get_market_books_from_prices_file(
         **kwargs,
     )
 
-    market_book = None
     previous_market_book = None
     result = {}
     _publish_times = sorted(publish_times)
-    for market_book in g:
-        if len(_publish_times) == 0:
-            break
-
-        while _publish_times[0] < market_book["publishTime"]:
-            result[_publish_times[0]] = previous_market_book
-            _publish_times.pop(0)
-            if len(_publish_times) == 0:
+    i = 0
+    try:
+        for market_book in g:
+            publish_time = get_publish_time_from_object(market_book)
+            while i < len(_publish_times) and _publish_times[i] < publish_time:
+                result[_publish_times[i]] = previous_market_book
+                i += 1
+            if i == len(_publish_times):
                 break
 
-        previous_market_book = market_book
+            previous_market_book = market_book
+    finally:
+        g.close()
 
     # Add any leftover publish times after the last market book
-    for pt in _publish_times:
-        result[pt] = market_book
+    for pt in _publish_times[i:]:
+        result[pt] = previous_market_book
     return result
 
 
+def get_market_books_from_prices_files(
+    paths_to_prices_files: Mapping[str, Union[str, Path]],
+    queries: Iterable[tuple[str, int]],
+    features: Optional[
+        Mapping[str, Callable[[Union["MarketBook", dict[str, Any]]], Any]]
+    ] = None,
+    lightweight: bool = True,
+    **kwargs,
+) -> Union[
+    dict[tuple[str, int], Optional[Union["MarketBook", dict[str, Any]]]],
+    dict[str, list[Any]],
+]:
+    """
+    Extract the market books corresponding to many (market ID, publish time) queries across many Betfair prices files.
+    The queries are grouped by file and each file is read once, with a pointer into each market's sorted publish times
+    being advanced as the market books go by, and reading stops as soon as every query for the file has been answered.
+    As with get_market_books_from_prices_file, if a publish time does not exactly appear in the prices file then the most
+    recent market book prior to it is used and any publish times which come before the first market book for the market
+    are paired with None
+
+    :param paths_to_prices_files: A mapping from market ID to where the Betfair prices file containing the market is
+        located. Several market IDs can map to the same file, for example an event-level official historic data file,
+        in which case the file is still only read once. Each file can be a local file, one stored in AWS S3, or any of
+        the other options that can be handled by the smart_open package and can be compressed or uncompressed
+    :param queries: The (market ID, publish time) pairs of interest
+    :param features: Optionally a mapping from column name to a function taking a market book and returning the value
+        of the column. If given then, rather than the market books themselves, only these values are retained, which is
+        far more memory efficient for large numbers of queries. Each function is called once per distinct market book
+    :param lightweight: Passed to StreamListener. When True, the market books are dicts. When false, the market books
+        are betfairlightweight MarketBook objects
+    :param kwargs: Passed to StreamListener
+    :return: If features is None, a dict mapping each (market ID, publish time) query to the corresponding market book
+        if there is one otherwise None. Otherwise, a dict of columns with one entry per query, in the order the queries
+        were given: market_id, publish_time, then one column for each of the features whose values are None if there is
+        no corresponding market book
+    :raises: ValueError if a query refers to a market ID which does not appear in paths_to_prices_files
+    """
+    queries = list(queries)
+
+    # Group the query indices by file and then by market
+    indices_by_file = {}
+    for i, (market_id, _) in enumerate(queries):
+        try:
+            path_to_prices_file = paths_to_prices_files[market_id]
+        except KeyError:
+            raise ValueError(f"No prices file given for market {market_id}")
+        indices_by_file.setdefault(path_to_prices_file, {}).setdefault(
+            market_id, []
+        ).append(i)
+
+    if features is None:
+        snapshot = None
+    else:
+        functions = tuple(features.values())
+
+        def snapshot(
+            market_book: Optional[Union["MarketBook", dict[str, Any]]]
+        ) -> Optional[tuple[Any, ...]]:
+            if market_book is not None:
+                return tuple(f(market_book) for f in functions)
+
+    results = [None] * len(queries)
+    for path_to_prices_file, indices_by_market_id in indices_by_file.items():
+        for indices in indices_by_market_id.values():
+            indices.sort(key=lambda j: queries[j][1])
+        pointers = dict.fromkeys(indices_by_market_id, 0)
+        # The most recent market book for each market, or its features, along with whether the latter have been calculated
+        previous_results = {
+            market_id: (None, True) for market_id in indices_by_market_id
+        }
+        number_of_unfinished_markets = len(indices_by_market_id)
+
+        g = create_market_book_generator_from_prices_file(
+            path_to_prices_file=path_to_prices_file,
+            lightweight=lightweight,
+            **kwargs,
+        )
+        try:
+            for market_book in g:
+                market_id = (
+                    market_book.market_id
+                    if _is_betfairlightweight_object(market_book, "MarketBook")
+                    else market_book["marketId"]
+                )
+                indices = indices_by_market_id.get(market_id)
+                if indices is None or pointers[market_id] == len(indices):
+                    continue
+
+                publish_time = get_publish_time_from_object(market_book)
+                i = pointers[market_id]
+                if queries[indices[i]][1] < publish_time:
+                    previous_result, is_resolved = previous_results[market_id]
+                    if not is_resolved:
+                        previous_result = snapshot(previous_result)
+                    while i < len(indices) and queries[indices[i]][1] < publish_time:
+                        results[indices[i]] = previous_result
+                        i += 1
+                    pointers[market_id] = i
+                    if i == len(indices):
+                        number_of_unfinished_markets -= 1
+                        if number_of_unfinished_markets == 0:
+                            break
+
+                previous_results[market_id] = (market_book, snapshot is None)
+        finally:
+            g.close()
+
+        # Add any leftover publish times after the last market book
+        for market_id, indices in indices_by_market_id.items():
+            previous_result, is_resolved = previous_results[market_id]
+            if not is_resolved:
+                previous_result = snapshot(previous_result)
+            for i in indices[pointers[market_id] :]:
+                results[i] = previous_result
+
+    if features is None:
+        return dict(zip(queries, results))
+
+    columns = {
+        "market_id": [market_id for market_id, _ in queries],
+        "publish_time": [publish_time for _, publish_time in queries],
+    }
+    for j, name in enumerate(features):
+        columns[name] = [None if result is None else result[j] for result in results]
+    return columns
+
+
 def get_minimum_book_percentage_market_books_from_prices_file(
     path_to_prices_file: Union[str, Path],
     publish_time_windows: Sequence[tuple[int, int]],
     lightweight: bool = True,
     **kwargs,
-) -> dict[tuple[int, int], Optional[Union[MarketBook, dict[str, Any]]]]:
+) -> dict[tuple[int, int], Optional[Union["MarketBook", dict[str, Any]]]]:
+    """
+    For each publish time window, extract the market book with the minimum back book percentage from a Betfair prices
+    file. See get_windowed_market_books_from_prices_file for details
+    """
+    return get_windowed_market_books_from_prices_file(
+        path_to_prices_file,
+        publish_time_windows,
+        metric="back_book_percentage",
+        selector=WindowSelectorEnum.MIN,
+        lightweight=lightweight,
+        **kwargs,
+    )
+
+
+_MARKET_BOOK_METRICS = {
+    "back_book_percentage": functools.partial(
+        calculate_book_percentage, side=Side.BACK
+    ),
+    "lay_book_percentage": functools.partial(calculate_book_percentage, side=Side.LAY),
+    "total_matched": calculate_total_matched,
+}
+
+
+def get_windowed_market_books_from_prices_file(
+    path_to_prices_file: Union[str, Path],
+    publish_time_windows: Sequence[tuple[int, int]],
+    metric: Union[
+        str,
+        Callable[[Union["MarketBook", dict[str, Any]]], Optional[Union[int, float]]],
+    ] = "back_book_percentage",
+    selector: WindowSelectorEnum = WindowSelectorEnum.MIN,
+    lightweight: bool = True,
+    **kwargs,
+) -> dict[tuple[int, int], Optional[Union["MarketBook", dict[str, Any]]]]:
+    """
+    For each of many, possibly overlapping, publish time windows, select one market book from a Betfair prices file in a
+    single pass. The market books considered for a window are those in effect at some point during it: the most recent
+    market book at the start of the window and every market book published up to and including the end of the window.
+    Windows are activated as the market books go by and held in a heap ordered by their ends, while the candidates for
+    the minimum or maximum are held in a monotonic stack, so each market book costs amortised O(1) time in addition to
+    O(log n) per window. Reading stops as soon as every window has ended. Currently only intended to be used with prices
+    files that contain data for a single Betfair market
+
+    :param path_to_prices_file: Where the Betfair prices file to be processed is located. This can be a local file, one stored in AWS S3, or any of the other options that can be handled by the smart_open package. The file can be compressed or uncompressed
+    :param publish_time_windows: The (start, end) publish times of the windows of interest. The start of each window must be before its end
+    :param metric: Either a function taking a market book and returning the value to minimise or maximise, or None to exclude the market book, or the name of a built-in metric: back_book_percentage, lay_book_percentage or total_matched. Ignored when selector is WindowSelectorEnum.FIRST or WindowSelectorEnum.LAST
+    :param selector: Whether to select the market book with the minimum or maximum metric value in each window, where ties are resolved in favour of the earliest market book, or the first or last market book in effect during each window
+    :param lightweight: Passed to StreamListener. When True, the returned market books are dicts. When false, the returned market books are betfairlightweight MarketBook objects
+    :param kwargs: Passed to StreamListener
+    :return: A dict mapping each window to the selected market book, or None if there is no market book in effect during the window (or none with a metric value)
+    :raises: ValueError if metric is the name of an unknown built-in metric
+    """
     for window in publish_time_windows:
         assert window[0] < window[1]
 
+    if isinstance(metric, str):
+        try:
+            metric = _MARKET_BOOK_METRICS[metric]
+        except KeyError:
+            raise ValueError(f"{metric} is not one of {list(_MARKET_BOOK_METRICS)}")
+    sign = -1 if selector == WindowSelectorEnum.MAX else 1
+    should_use_metric = selector in (WindowSelectorEnum.MIN, WindowSelectorEnum.MAX)
+
+    result = {window: None for window in publish_time_windows}
+    # Windows yet to start, with the earliest start last, and started windows as a heap of (end, start, start index)
+    pending_windows = sorted(result, reverse=True)
+    active_windows = []
+    # The number of active windows with each start index, in the order they started
+    start_index_counts = {}
+    start_indices = deque()
+    # The monotonic stack of candidate market books. Entries before head have been discarded
+    candidate_indices = []
+    candidate_keys = []
+    candidate_market_books = []
+    head = 0
+
+    def select(start_index: int) -> Optional[Union["MarketBook", dict[str, Any]]]:
+        i = bisect_left(candidate_indices, start_index, lo=head)
+        if i < len(candidate_indices):
+            return candidate_market_books[i]
+
     g = create_market_book_generator_from_prices_file(
         path_to_prices_file=path_to_prices_file,
         lightweight=lightweight,
         **kwargs,
     )
-
-    market_book = None
+    index = 0
     previous_market_book = None
-    previous_market_book_book_percentage = None
-    result = {window: None for window in publish_time_windows}
-    current_best_book_percentages = {window: None for window in publish_time_windows}
-    _publish_time_windows = sorted(publish_time_windows, key=lambda x: x[0])
-    for market_book in g:
-        if len(_publish_time_windows) == 0:
-            break
-
-        while _publish_time_windows[0][1] < market_book["publishTime"]:
-            if result[_publish_time_windows[0]] is None:
-                result[_publish_time_windows[0]] = previous_market_book
-            _publish_time_windows.pop(0)
-            if len(_publish_time_windows) == 0:
+    try:
+        for market_book in g:
+            publish_time = get_publish_time_from_object(market_book)
+
+            # The market book in effect at the start of these windows is the previous one, if there is one
+            start_index = max(index - 1, 0)
+            while pending_windows and pending_windows[-1][0] < publish_time:
+                window = pending_windows.pop()
+                heapq.heappush(active_windows, (window[1], window[0], start_index))
+                start_index_counts[start_index] = (
+                    start_index_counts.get(start_index, 0) + 1
+                )
+                if not start_indices or start_indices[-1] != start_index:
+                    start_indices.append(start_index)
+                if selector == WindowSelectorEnum.FIRST:
+                    if previous_market_book is not None:
+                        result[window] = previous_market_book
+                    elif window[1] >= publish_time:
+                        result[window] = market_book
+
+            while active_windows and active_windows[0][0] < publish_time:
+                end, start, window_start_index = heapq.heappop(active_windows)
+                start_index_counts[window_start_index] -= 1
+                if should_use_metric:
+                    result[(start, end)] = select(window_start_index)
+                elif selector == WindowSelectorEnum.LAST:
+                    result[(start, end)] = previous_market_book
+
+            if not pending_windows and not active_windows:
                 break
 
-        if len(_publish_time_windows) == 0:
-            break
+            if should_use_metric:
+                # Discard candidates which can no longer be selected by any window
+                while start_indices and start_index_counts[start_indices[0]] == 0:
+                    del start_index_counts[start_indices.popleft()]
+                minimum_start_index = start_indices[0] if start_indices else index
+                head = bisect_left(candidate_indices, minimum_start_index, lo=head)
+                if head > 1024 and 2 * head > len(candidate_indices):
+                    del candidate_indices[:head]
+                    del candidate_keys[:head]
+                    del candidate_market_books[:head]
+                    head = 0
+
+                value = metric(market_book)
+                if value is not None:
+                    key = sign * value
+                    while len(candidate_keys) > head and candidate_keys[-1] > key:
+                        candidate_indices.pop()
+                        candidate_keys.pop()
+                        candidate_market_books.pop()
+                    candidate_indices.append(index)
+                    candidate_keys.append(key)
+                    candidate_market_books.append(market_book)
+
+            previous_market_book = market_book
+            index += 1
+    finally:
+        g.close()
+
+    # The last market book remains in effect for any windows which have not ended
+    start_index = max(index - 1, 0)
+    for window in pending_windows:
+        heapq.heappush(active_windows, (window[1], window[0], start_index))
+        if selector == WindowSelectorEnum.FIRST:
+            result[window] = previous_market_book
+    for end, start, window_start_index in active_windows:
+        if should_use_metric:
+            result[(start, end)] = select(window_start_index)
+        elif selector == WindowSelectorEnum.LAST:
+            result[(start, end)] = previous_market_book
 
-        for window in _publish_time_windows:
-            if window[0] < market_book["publishTime"]:
-                if previous_market_book_book_percentage is not None and (
-                    current_best_book_percentages[window] is None
-                    or current_best_book_percentages[window]
-                    > previous_market_book_book_percentage
-                ):
-                    result[window] = previous_market_book
-                    current_best_book_percentages[window] = (
-                        previous_market_book_book_percentage
-                    )
+    return result
 
-        previous_market_book = market_book
-        previous_market_book_book_percentage = calculate_book_percentage(
-            previous_market_book,
-            Side.BACK,
-        )
 
-    # Add any leftover publish times after the last market book
-    last_market_book_book_percentage = calculate_book_percentage(market_book, Side.BACK)
+def _create_line_generator(
+    path_to_file: Union[str, Path], prefetch: int = 0
+) -> Generator[bytes, None, None]:
+    """
+    Read the lines of a file, optionally reading (and decompressing) ahead in a background thread so that this overlaps
+    with the processing of the lines. Closing the generator stops the background thread
 
-    for window in _publish_time_windows:
-        if (
-            current_best_book_percentages[window] is None
-            or current_best_book_percentages[window] > last_market_book_book_percentage
-        ):
-            result[window] = market_book
+    :param path_to_file: The file to read. This can be a local file, one stored in AWS S3, or any of the other options that can be handled by the smart_open package. The file can be compressed or uncompressed
+    :param prefetch: The maximum number of lines to read ahead. If 0 then the file is read in the calling thread
+    :return: A generator of the lines of the file as bytes
+    """
+    import smart_open
 
-    return result
+    if prefetch <= 0:
+        with smart_open.open(path_to_file, "rb") as f:
+            yield from f
+        return
+
+    import queue
+    import threading
+
+    # Lines are passed between the threads in chunks to limit the overhead of the queue
+    chunk_size = min(prefetch, 1024)
+    chunks = queue.Queue(maxsize=max(prefetch // chunk_size, 1))
+    stopped = threading.Event()
+
+    def put(item: Any) -> bool:
+        while not stopped.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read() -> None:
+        try:
+            with smart_open.open(path_to_file, "rb") as f:
+                chunk = []
+                for line in f:
+                    chunk.append(line)
+                    if len(chunk) == chunk_size:
+                        if not put(chunk):
+                            return
+                        chunk = []
+                if chunk and not put(chunk):
+                    return
+            put(None)
+        except Exception as e:
+            put(e)
+
+    thread = threading.Thread(target=read, daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield from chunk
+    finally:
+        stopped.set()
 
 
 def create_race_change_generator_from_race_file(
     path_to_race_file: Union[str, Path],
+    prefetch: int = 0,
 ) -> Generator[dict[str, Any], None, None]:
-    from unittest.mock import patch
+    """
+    Read the race changes from a Betfair race file (recorded from the race stream). The race file is parsed directly
+    rather than via betfairlightweight but the race changes are the same as betfairlightweight generates when processing
+    the file as a historical stream in lightweight mode: after each line, the latest state of every race seen so far is
+    yielded
+
+    :param path_to_race_file: Where the Betfair race file to be processed is located. This can be a local file, one stored in AWS S3, or any of the other options that can be handled by the smart_open package. The file can be compressed or uncompressed
+    :param prefetch: The maximum number of lines to read ahead in a background thread. If 0 then the file is read in the calling thread
+    :return: A generator of race changes as dicts. Closing the generator stops reading the file. Lines which are not
+        valid JSON or which have race changes but no publish time are skipped with a warning
+    """
+    # The latest state of each race, keyed by market ID, with the runner changes keyed by selection ID
+    races: dict[str, dict[str, Any]] = {}
+    g = _create_line_generator(path_to_race_file, prefetch=prefetch)
+    try:
+        for line in g:
+            if not line.strip():
+                continue
+            message = _parse_race_stream_line(line)
+            if message is not None:
+                _update_races(races, message)
+                yield from _iterate_race_changes(races)
+    finally:
+        g.close()
+
+
+def _parse_race_stream_line(line: bytes) -> Optional[dict[str, Any]]:
+    # Like betfairlightweight, lines which cannot be processed are skipped rather than ending the whole file
+    import orjson
 
-    open_mocker = _OpenMocker(path_to_race_file)
+    try:
+        message = orjson.loads(line)
+    except orjson.JSONDecodeError:
+        message = None
+    if type(message) is not dict:
+        warnings.warn(f"Skipping race stream line which is not a JSON object: {line!r}")
+        return None
+    if message.get("rc") and message.get("pt") is None:
+        warnings.warn(f"Skipping race stream line without a publish time: {line!r}")
+        return None
+    return message
+
+
+def _update_races(races: dict[str, dict[str, Any]], message: dict[str, Any]) -> None:
+    for update in message.get("rc", []):
+        race = races.get(update["mid"])
+        if race is None:
+            race = {
+                "mid": update["mid"],
+                "id": update.get("id"),
+                "rpc": None,
+                "rrc": {},
+            }
+            races[update["mid"]] = race
+        race["pt"] = message["pt"]
+        race["streaming_update"] = update
+        if "rpc" in update:
+            race["rpc"] = update["rpc"]
+        for runner_update in update.get("rrc", []):
+            race["rrc"][runner_update["id"]] = runner_update
+
+
+def _iterate_race_changes(
+    races: dict[str, dict[str, Any]]
+) -> Generator[dict[str, Any], None, None]:
+    for race in races.values():
+        yield {
+            "pt": race["pt"],
+            "mid": race["mid"],
+            "id": race["id"],
+            "rpc": race["rpc"],
+            "rrc": list(race["rrc"].values()),
+            "streaming_update": race["streaming_update"],
+            "streaming_unique_id": 0,
+            "streaming_snap": True,
+        }
 
-    trading = APIClient(username="", password="", app_key="")
-    stream = trading.streaming.create_historical_generator_stream(
-        file_path=path_to_race_file,
-        listener=StreamListener(max_latency=None, lightweight=True, update_clk=False),
-        operation="raceSubscription",
-    )
-    with patch("builtins.open", open_mocker.open):
-        g = stream.get_generator()
-        for rcs in g():
-            for rc in rcs:
-                yield rc
 
+def _copy_races(races: dict[str, dict[str, Any]]) -> dict[str, dict[str, Any]]:
+    return {
+        market_id: {**race, "rrc": dict(race["rrc"])}
+        for market_id, race in races.items()
+    }
+
+
+class RaceFileIndex:
+    """
+    An index of a Betfair race file, built in a single pass, for repeatedly looking up race changes by gate name or
+    publish time as get_race_change_from_race_file does. The first race change after each gate is stored directly.
+    Checkpoints - the file offset and the state of the races - are stored at regular intervals of lines along with the
+    latest publish time before them, so that a publish time lookup can binary search for the checkpoint to seek to and
+    then only read from there. Seeking is fastest for uncompressed local files. Compressed files are seekable but
+    seeking requires decompressing from the start of the file
+
+    :param path_to_race_file: Where the Betfair race file to be indexed is located. This can be a local file, one stored in AWS S3, or any of the other options that can be handled by the smart_open package. The file can be compressed or uncompressed
+    :param checkpoint_interval: The number of lines between checkpoints. Smaller intervals make lookups by publish time faster at the expense of memory
+    """
+
+    def __init__(
+        self, path_to_race_file: Union[str, Path], checkpoint_interval: int = 1000
+    ):
+        import smart_open
+
+        self.path_to_race_file = path_to_race_file
+        self.checkpoint_interval = checkpoint_interval
+        self._gates: dict[str, dict[str, Any]] = {}
+        # Parallel lists of the latest publish time before each checkpoint, the file offset and the state of the races
+        self._checkpoint_publish_times: list[Union[int, float]] = []
+        self._checkpoint_offsets: list[int] = []
+        self._checkpoint_races: list[dict[str, dict[str, Any]]] = []
+
+        races = {}
+        latest_publish_time = -float("inf")
+        with smart_open.open(path_to_race_file, "rb") as f:
+            line_number = 0
+            while True:
+                offset = f.tell()
+                line = f.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                if line_number % checkpoint_interval == 0:
+                    self._checkpoint_publish_times.append(latest_publish_time)
+                    self._checkpoint_offsets.append(offset)
+                    self._checkpoint_races.append(_copy_races(races))
+                line_number += 1
+                message = _parse_race_stream_line(line)
+                if message is None:
+                    continue
+                _update_races(races, message)
+                for race_change in _iterate_race_changes(races):
+                    latest_publish_time = max(latest_publish_time, race_change["pt"])
+                    gate_name = (race_change.get("rpc") or {}).get("g")
+                    if gate_name is not None and gate_name not in self._gates:
+                        self._gates[gate_name] = race_change
+
+    def get_race_change_by_gate_name(self, gate_name: str) -> Optional[dict[str, Any]]:
+        """
+        Get the first race change after entering the given gate
+
+        :param gate_name: The Gmax gate name to search for, for example "1f"
+        :return: The first race change whose race progress change has the given gate name or None if there is none
+        """
+        return self._gates.get(gate_name)
+
+    def get_race_change_by_publish_time(
+        self, publish_time: int
+    ) -> Optional[dict[str, Any]]:
+        """
+        Get the first race change with a publish time at or after the given publish time
+
+        :param publish_time: The Betfair publish time to search for
+        :return: The first race change meeting the search criterion or None if there is none
+        """
+        return self.get_race_changes_by_publish_time([publish_time])[publish_time]
+
+    def get_race_changes_by_publish_time(
+        self, publish_times: Sequence[int]
+    ) -> dict[int, Optional[dict[str, Any]]]:
+        """
+        Get the first race change with a publish time at or after each of many publish times. The publish times are
+        answered in ascending order in a single forward pass over the file, seeking ahead to a later checkpoint whenever
+        that skips lines
+
+        :param publish_times: The Betfair publish times to search for
+        :return: A dict mapping each publish time to the first race change meeting the search criterion or None if
+            there is none
+        """
+        import smart_open
+
+        result = {}
+        with smart_open.open(self.path_to_race_file, "rb") as f:
+            # The number of non-blank lines read since the start of the file
+            line_number = 0
+
+            def iterate_race_changes_from_checkpoint(
+                checkpoint: int,
+            ) -> Generator[dict[str, Any], None, None]:
+                nonlocal line_number
+                f.seek(self._checkpoint_offsets[checkpoint])
+                line_number = checkpoint * self.checkpoint_interval
+                races = _copy_races(self._checkpoint_races[checkpoint])
+                for line in f:
+                    if not line.strip():
+                        continue
+                    line_number += 1
+                    message = _parse_race_stream_line(line)
+                    if message is not None:
+                        _update_races(races, message)
+                        yield from _iterate_race_changes(races)
+
+            race_changes = None
+            race_change = None
+            for publish_time in sorted(set(publish_times)):
+                # Seek to the last checkpoint before which every race change was published before publish_time if that
+                # skips lines
+                checkpoint = max(
+                    bisect_left(self._checkpoint_publish_times, publish_time) - 1, 0
+                )
+                if (
+                    race_changes is None
+                    or checkpoint * self.checkpoint_interval > line_number
+                ):
+                    race_changes = iterate_race_changes_from_checkpoint(checkpoint)
+                    race_change = None
+                while race_change is None or race_change["pt"] < publish_time:
+                    race_change = next(race_changes, None)
+                    if race_change is None:
+                        break
+                result[publish_time] = race_change
+
+        return result
 
-def get_publish_time_from_object(o: Union[dict[str, Any], MarketBook]) -> int:
+
+def get_publish_time_from_object(o: Union[dict[str, Any], "MarketBook"]) -> int:
     _data = getattr(o, "_data", o)
     return _data.get("publishTime", _data.get("pt"))
 
@@ -3069,7 +5724,7 @@ def create_combined_market_book_and_race_change_generator(
     lightweight: bool = True,
     market_type_filter: Optional[Sequence[str]] = None,
     **kwargs,
-) -> Generator[tuple[bool, Union[MarketBook, dict[str, Any]]], None, None]:
+) -> Generator[tuple[bool, Union["MarketBook", dict[str, Any]]], None, None]:
     """
     Creates a generator for reading a Betfair prices file and a scraped race stream file simultaneously. The market book
     and race change objects will be interleaved and returned from the generator in publish time order. The generator
@@ -3091,6 +5746,135 @@ def create_combined_market_book_and_race_change_generator(
     :return: A generator yielding pairs of a boolean and an object. The boolean indicates whether the object is a market
         book (True) or a race change (False)
     """
+    g = create_combined_generator_from_files(
+        paths_to_prices_files=[path_to_prices_file],
+        paths_to_race_files=[path_to_race_file],
+        lightweight=lightweight,
+        market_type_filter=market_type_filter,
+        **kwargs,
+    )
+    try:
+        for _, _is_market_book, _object in g:
+            yield _is_market_book, _object
+    finally:
+        g.close()
+
+
+def create_combined_generator_from_files(
+    paths_to_prices_files: Iterable[Union[str, Path]] = (),
+    paths_to_race_files: Iterable[Union[str, Path]] = (),
+    lightweight: bool = True,
+    market_type_filter: Optional[Sequence[str]] = None,
+    **kwargs,
+) -> Generator[
+    tuple[Union[str, Path], bool, Union["MarketBook", dict[str, Any]]], None, None
+]:
+    """
+    Creates a generator for reading any number of Betfair prices files and scraped race stream files simultaneously,
+    for example all of the files for a meeting or a day. The market book and race change objects will be interleaved
+    and returned from the generator in publish time order using a k-way merge. Each object's publish time is computed
+    once when it is read and only one pending object per file is held in memory. Where publish times are equal, market
+    books come before race changes and otherwise objects are returned in the order that their files were given
+
+    :param paths_to_prices_files: Where the Betfair prices files to be processed are located. These can be local files,
+        ones stored in AWS S3, or any of the other options that can be handled by the smart_open package. The files can
+        be compressed or uncompressed
+    :param paths_to_race_files: Where the scraped race stream files to be processed are located. These can be local
+        files, ones stored in AWS S3, or any of the other options that can be handled by the smart_open package. The
+        files can be compressed or uncompressed
+    :param lightweight: Passed to the betfairlightweight StreamListener used to read the Betfair prices files. When
+        True, the market books will be dicts. When False, the market books will be betfairlightweight MarketBook
+        objects
+    :param market_type_filter: Optionally filter out market books with a market type which does not exist in the given
+        sequence
+    :param kwargs: Other arguments passed to the betfairlightweight StreamListener
+    :return: A generator yielding triples of the path to the file the object was read from, a boolean indicating
+        whether the object is a market book (True) or a race change (False), and the object itself
+    """
+    sources = [
+        (
+            path_to_prices_file,
+            True,
+            create_market_book_generator_from_prices_file(
+                path_to_prices_file=path_to_prices_file,
+                lightweight=lightweight,
+                market_type_filter=market_type_filter,
+                **kwargs,
+            ),
+            (
+                operator.itemgetter("publishTime")
+                if lightweight
+                else get_publish_time_from_object
+            ),
+        )
+        for path_to_prices_file in paths_to_prices_files
+    ]
+    sources.extend(
+        (
+            path_to_race_file,
+            False,
+            create_race_change_generator_from_race_file(path_to_race_file),
+            operator.itemgetter("pt"),
+        )
+        for path_to_race_file in paths_to_race_files
+    )
+
+    try:
+        # Heap entries are (publish time, source index, object). The source index is unique among pending entries so
+        # the objects themselves are never compared
+        heap = []
+        for index, (_, _, g, get_publish_time) in enumerate(sources):
+            _object = next(g, None)
+            if _object is not None:
+                heap.append((get_publish_time(_object), index, _object))
+        heapq.heapify(heap)
+
+        while heap:
+            _, index, _object = heap[0]
+            source, _is_market_book, g, get_publish_time = sources[index]
+            yield source, _is_market_book, _object
+            _object = next(g, None)
+            if _object is None:
+                heapq.heappop(heap)
+            else:
+                heapq.heapreplace(heap, (get_publish_time(_object), index, _object))
+    finally:
+        for _, _, g, _ in sources:
+            g.close()
+
+
+def create_as_of_market_book_and_race_change_generator(
+    path_to_prices_file: Union[str, Path],
+    path_to_race_file: Union[str, Path],
+    lightweight: bool = True,
+    market_type_filter: Optional[Sequence[str]] = None,
+    **kwargs,
+) -> Generator[
+    tuple[Union["MarketBook", dict[str, Any]], Optional[dict[str, Any]], Optional[int]],
+    None,
+    None,
+]:
+    """
+    Creates a generator for reading a Betfair prices file and a scraped race stream file simultaneously which pairs each
+    market book with the most recent race change published at or before it, so that consumers do not need to keep
+    track of the latest race change themselves
+
+    :param path_to_prices_file: Where the Betfair prices file to be processed is located. This can be a local file, one
+        stored in AWS S3, or any of the other options that can be handled by the smart_open package. The file can be
+        compressed or uncompressed
+    :param path_to_race_file: Where the scraped race stream file to be processed is located. This can be a local file,
+        one stored in AWS S3, or any of the other options that can be handled by the smart_open package. The file can be
+        compressed or uncompressed
+    :param lightweight: Passed to the betfairlightweight StreamListener used to read the Betfair prices file. When True,
+        the market books will be dicts. When False, the market books will be betfairlightweight MarketBook objects
+    :param market_type_filter: Optionally filter out market books with a market type which does not exist in the given
+        sequence. Generally only makes sense when the Betfair prices file contains multiple market types, such as
+        the case of event-level official historic data files
+    :param kwargs: Other arguments passed to the betfairlightweight StreamListener
+    :return: A generator yielding a tuple for each market book of the market book, the most recent race change (or None
+        if there has not been one yet) and the number of milliseconds between the publish times of the race change and
+        the market book (or None if there is no race change)
+    """
     market_book_generator = create_market_book_generator_from_prices_file(
         path_to_prices_file=path_to_prices_file,
         lightweight=lightweight,
@@ -3100,11 +5884,106 @@ def create_combined_market_book_and_race_change_generator(
     race_change_generator = create_race_change_generator_from_race_file(
         path_to_race_file
     )
-    yield from heapq.merge(
-        ((True, mb) for mb in market_book_generator),
-        ((False, rc) for rc in race_change_generator),
-        key=lambda x: get_publish_time_from_object(x[1]),
-    )
+    race_change = None
+    try:
+        next_race_change = next(race_change_generator, None)
+        for market_book in market_book_generator:
+            publish_time = get_publish_time_from_object(market_book)
+            while (
+                next_race_change is not None and next_race_change["pt"] <= publish_time
+            ):
+                race_change = next_race_change
+                next_race_change = next(race_change_generator, None)
+            yield market_book, race_change, (
+                None if race_change is None else publish_time - race_change["pt"]
+            )
+    finally:
+        market_book_generator.close()
+        race_change_generator.close()
+
+
+def join_race_arrays_to_publish_times(
+    publish_times: Union[Sequence[int], "np.ndarray"],
+    race_arrays: tuple[dict[int, dict[str, "np.ndarray"]], dict[str, "np.ndarray"]],
+    selection_ids: Optional[Union[Sequence[int], "np.ndarray"]] = None,
+) -> dict[str, "np.ndarray"]:
+    """
+    As-of join the arrays generated by race_file_to_arrays onto publish times, for example the publish time column of a
+    data frame of market book features, using a vectorised binary search (searchsorted) rather than materialising and
+    merging data frames. Each publish time is matched with the most recent race progress change and, if selection_ids
+    is given, the most recent runner change for the corresponding horse, published at or before it. Requires numpy to
+    be installed
+
+    :param publish_times: The publish times onto which to join, for example a data frame's publish_time column
+    :param race_arrays: The tuple of runner and race arrays returned by race_file_to_arrays
+    :param selection_ids: Optionally the selection ID corresponding to each publish time, for example a data frame's
+        selection_id column. If given then the runner arrays are also joined
+    :return: A dict of arrays the same length as publish_times which can be assigned to a data frame, for example using
+        df.assign(**columns). The race progress arrays are prefixed with "race_", for example race_progress, and
+        race_staleness is the number of milliseconds since the matched race progress change. If selection_ids is given
+        then the runner arrays are included under their own names, for example speed, along with staleness. Where there
+        is no match, numeric values are NaN and the gate is None
+    """
+    import numpy as np
+
+    publish_times = np.asarray(publish_times, dtype=np.int64)
+    runner_arrays, race_progress_arrays = race_arrays
+
+    def join(
+        indices: "np.ndarray",
+        right_publish_times: "np.ndarray",
+        right_arrays: Mapping[str, "np.ndarray"],
+    ) -> dict[str, "np.ndarray"]:
+        left_publish_times = publish_times[indices]
+        matches = (
+            np.searchsorted(right_publish_times, left_publish_times, side="right") - 1
+        )
+        is_matched = matches >= 0
+        matches = np.maximum(matches, 0)
+        joined = {}
+        for name, array in right_arrays.items():
+            if len(array) == 0:
+                values = np.full(
+                    len(indices), None if array.dtype == object else np.nan
+                )
+            elif array.dtype == object:
+                values = np.where(is_matched, array[matches], None)
+            else:
+                values = np.where(is_matched, array[matches].astype(np.float64), np.nan)
+            joined[name] = values
+        joined["staleness"] = np.where(
+            is_matched, left_publish_times - joined["publish_time"], np.nan
+        )
+        return joined
+
+    columns = {
+        f"race_{name}": array
+        for name, array in join(
+            np.arange(len(publish_times)),
+            race_progress_arrays["publish_time"],
+            race_progress_arrays,
+        ).items()
+        if name != "publish_time"
+    }
+
+    if selection_ids is not None:
+        selection_ids = np.asarray(selection_ids)
+        for name in (
+            "feed_time",
+            *(name for _, name in _RACE_RUNNER_CHANGE_ARRAY_FIELDS),
+            "staleness",
+        ):
+            columns[name] = np.full(len(publish_times), np.nan)
+        for selection_id, arrays in runner_arrays.items():
+            indices = np.flatnonzero(selection_ids == selection_id)
+            if len(indices) > 0:
+                for name, values in join(
+                    indices, arrays["publish_time"], arrays
+                ).items():
+                    if name in columns:
+                        columns[name][indices] = values
+
+    return columns
 
 
 def read_prices_file(
@@ -3112,10 +5991,10 @@ def read_prices_file(
     lightweight: bool = True,
     market_type_filter: Optional[Sequence[str]] = None,
     market_catalogues: Optional[
-        Sequence[Union[dict[str, Any], MarketCatalogue]]
+        Sequence[Union[dict[str, Any], "MarketCatalogue"]]
     ] = None,
     **kwargs,
-) -> Union[list[MarketBook], list[dict[str, Any]]]:
+) -> Union[list["MarketBook"], list[dict[str, Any]]]:
     """
     Read a Betfair prices file (either from the official historic data or data recorded from the streaming API in the same format) into memory as a list of dicts or betfairlightweight MarketBook objects
 
@@ -3169,10 +6048,246 @@ def read_race_file(path_to_race_file: Union[str, Path]) -> list[dict[str, Any]]:
     return race_changes
 
 
+_RACE_RUNNER_CHANGE_ARRAY_FIELDS = (
+    ("lat", "lat"),
+    ("long", "long"),
+    ("spd", "speed"),
+    ("prg", "progress"),
+    ("sfq", "stride_frequency"),
+)
+_RACE_PROGRESS_CHANGE_ARRAY_FIELDS = (
+    ("st", "sectional_time"),
+    ("rt", "running_time"),
+    ("spd", "speed"),
+    ("prg", "progress"),
+)
+
+
+def race_file_to_arrays(
+    path_to_race_file: Union[str, Path],
+    prefetch: int = 0,
+    market_id: Optional[str] = None,
+) -> tuple[dict[int, dict[str, "np.ndarray"]], dict[str, "np.ndarray"]]:
+    """
+    Read a Betfair race file once into dense arrays, one element per update, rather than a dict per horse per update.
+    The arrays describe a single race so if the file contains more than one race then market_id must be given to select
+    one. Requires numpy to be installed
+
+    :param path_to_race_file: Where the Betfair race file to be processed is located. This can be a local file, one stored in AWS S3, or any of the other options that can be handled by the smart_open package. The file can be compressed or uncompressed
+    :param prefetch: The maximum number of lines to read ahead in a background thread. If 0 then the file is read in the calling thread
+    :param market_id: Optionally only read the race changes for the race with this market ID (mid)
+    :return: A tuple of two items. The first is a dict mapping each selection ID to a dict of arrays built from its runner changes (rrc), with one element per runner change:
+
+      - publish_time: The publish time of the message containing the runner change
+      - feed_time: The feed time (ft) of the runner change
+      - lat: The latitude of the runner
+      - long: The longitude of the runner
+      - speed: The speed (spd) of the runner in metres per second
+      - progress: The distance remaining (prg) for the runner in metres
+      - stride_frequency: The stride frequency (sfq) of the runner in hertz
+
+    The second is a dict of arrays built from the race progress changes (rpc), with one element per race progress change:
+
+      - publish_time, feed_time, speed and progress: As above but for the leader
+      - sectional_time: The sectional time (st) in seconds
+      - running_time: The running time (rt) in seconds
+      - gate: The name (g) of the last gate passed by the leader, as an array of objects
+      - jumps_remaining: The number of jumps remaining as calculated by get_number_of_jumps_remaining
+
+    Missing numeric values are NaN
+    :raises: ValueError if market_id is not given and the file contains race changes for more than one market ID
+    """
+    from array import array
+
+    import numpy as np
+
+    nan = float("nan")
+    runner_columns: dict[int, dict[str, array]] = {}
+    race_columns = {
+        "publish_time": array("q"),
+        "feed_time": array("q"),
+        **{name: array("d") for _, name in _RACE_PROGRESS_CHANGE_ARRAY_FIELDS},
+        "jumps_remaining": array("d"),
+    }
+    gates = []
+    should_filter = market_id is not None
+    g = _create_line_generator(path_to_race_file, prefetch=prefetch)
+    try:
+        for line in g:
+            if not line.strip():
+                continue
+            message = _parse_race_stream_line(line)
+            if message is None:
+                continue
+            publish_time = message.get("pt")
+            for rc in message.get("rc", []):
+                if market_id is None:
+                    market_id = rc.get("mid")
+                elif rc.get("mid") != market_id:
+                    if should_filter:
+                        continue
+                    raise ValueError(
+                        f"{path_to_race_file} contains more than one race ({market_id} and {rc.get('mid')}). "
+                        f"Use market_id to select one"
+                    )
+                rpc = rc.get("rpc")
+                if rpc is not None:
+                    race_columns["publish_time"].append(publish_time)
+                    race_columns["feed_time"].append(rpc["ft"])
+                    for key, name in _RACE_PROGRESS_CHANGE_ARRAY_FIELDS:
+                        value = rpc.get(key)
+                        race_columns[name].append(nan if value is None else value)
+                    jumps_remaining = get_number_of_jumps_remaining(rc)
+                    race_columns["jumps_remaining"].append(
+                        nan if jumps_remaining is None else jumps_remaining
+                    )
+                    gates.append(rpc.get("g"))
+                for rrc in rc.get("rrc", []):
+                    columns = runner_columns.get(rrc["id"])
+                    if columns is None:
+                        columns = {
+                            "publish_time": array("q"),
+                            "feed_time": array("q"),
+                            **{
+                                name: array("d")
+                                for _, name in _RACE_RUNNER_CHANGE_ARRAY_FIELDS
+                            },
+                        }
+                        runner_columns[rrc["id"]] = columns
+                    columns["publish_time"].append(publish_time)
+                    columns["feed_time"].append(rrc["ft"])
+                    for key, name in _RACE_RUNNER_CHANGE_ARRAY_FIELDS:
+                        value = rrc.get(key)
+                        columns[name].append(nan if value is None else value)
+    finally:
+        g.close()
+
+    def to_numpy(column: array) -> "np.ndarray":
+        # Wraps the array's buffer without copying it
+        return np.frombuffer(
+            column, dtype=np.int64 if column.typecode == "q" else np.float64
+        )
+
+    runner_arrays = {
+        selection_id: {name: to_numpy(column) for name, column in columns.items()}
+        for selection_id, columns in runner_columns.items()
+    }
+    race_arrays = {name: to_numpy(column) for name, column in race_columns.items()}
+    race_arrays["gate"] = np.array(gates, dtype=object)
+    return runner_arrays, race_arrays
+
+
+def race_file_to_rankings(
+    path_to_race_file: Union[str, Path],
+    prefetch: int = 0,
+    market_id: Optional[str] = None,
+) -> dict[str, "np.ndarray"]:
+    """
+    Calculate the position of every horse at every race change in a Betfair race file in a single pass, as columnar
+    arrays with one row per race change (as generated by create_race_change_generator_from_race_file) and one column per
+    horse. The leader is found with a minimum rather than a sort and the ranking is vectorised over the whole race.
+    The arrays describe a single race so if the file contains more than one race then market_id must be given to select
+    one. Requires numpy to be installed
+
+    :param path_to_race_file: Where the Betfair race file to be processed is located. This can be a local file, one stored in AWS S3, or any of the other options that can be handled by the smart_open package. The file can be compressed or uncompressed
+    :param prefetch: The maximum number of lines to read ahead in a background thread. If 0 then the file is read in the calling thread
+    :param market_id: Optionally only use the race changes for the race with this market ID (mid)
+    :return: A dict of arrays:
+
+      - publish_time: The publish time of each race change
+      - selection_id: The selection ID of each horse, in ascending order
+      - progress: The latest distance remaining (prg) of each horse as of each race change
+      - distance_behind_leader: The distance in metres between each horse and the leader
+      - rank: The position of each horse where the leader is 1 and tied horses share the best position
+      - is_leader: Whether each horse is in the lead, as get_race_leaders would give
+
+    progress, distance_behind_leader and rank are NaN for horses not yet present in the race change or whose runner
+    change has no progress
+    :raises: ValueError if market_id is not given and the file contains race changes for more than one market ID
+    """
+    from array import array
+
+    import numpy as np
+
+    nan = float("nan")
+    should_filter = market_id is not None
+    publish_times = array("q")
+    rows = array("q")
+    columns = array("q")
+    distances_remaining = array("d")
+    column_indices: dict[int, int] = {}
+    row = 0
+    for race_change in create_race_change_generator_from_race_file(
+        path_to_race_file, prefetch=prefetch
+    ):
+        if market_id is None:
+            market_id = race_change["mid"]
+        elif race_change["mid"] != market_id:
+            if should_filter:
+                continue
+            raise ValueError(
+                f"{path_to_race_file} contains more than one race ({market_id} and {race_change['mid']}). "
+                f"Use market_id to select one"
+            )
+        publish_times.append(race_change["pt"])
+        for rrc in race_change["rrc"]:
+            column = column_indices.get(rrc["id"])
+            if column is None:
+                column = len(column_indices)
+                column_indices[rrc["id"]] = column
+            rows.append(row)
+            columns.append(column)
+            distance_remaining = rrc.get("prg")
+            distances_remaining.append(
+                nan if distance_remaining is None else distance_remaining
+            )
+        row += 1
+
+    # Order the columns by selection ID
+    selection_ids = np.array(sorted(column_indices), dtype=np.int64)
+    column_order = np.empty(len(column_indices), dtype=np.int64)
+    column_order[list(column_indices.values())] = np.searchsorted(
+        selection_ids, list(column_indices)
+    )
+    progress = np.full((len(publish_times), len(column_indices)), np.nan)
+    progress[
+        np.frombuffer(rows, dtype=np.int64),
+        column_order[np.frombuffer(columns, dtype=np.int64)],
+    ] = np.frombuffer(distances_remaining, dtype=np.float64)
+
+    # fmin ignores NaN and gives NaN only when every horse is missing
+    leader_progress = np.fmin.reduce(progress, axis=1, initial=np.inf)
+    leader_progress[np.isinf(leader_progress)] = np.nan
+    distance_behind_leader = progress - leader_progress[:, np.newaxis]
+
+    # Sort each row, with missing horses last, and give tied horses the position of the first of them
+    order = np.argsort(progress, axis=1, kind="stable")
+    sorted_progress = np.take_along_axis(progress, order, axis=1)
+    positions = np.broadcast_to(np.arange(progress.shape[1]), progress.shape)
+    is_new_position = np.ones(progress.shape, dtype=bool)
+    is_new_position[:, 1:] = sorted_progress[:, 1:] != sorted_progress[:, :-1]
+    sorted_rank = (
+        np.maximum.accumulate(np.where(is_new_position, positions, 0), axis=1) + 1
+    ).astype(np.float64)
+    rank = np.empty(progress.shape)
+    np.put_along_axis(rank, order, sorted_rank, axis=1)
+    rank[np.isnan(progress)] = np.nan
+
+    return {
+        "publish_time": np.frombuffer(publish_times, dtype=np.int64),
+        "selection_id": selection_ids,
+        "progress": progress,
+        "distance_behind_leader": distance_behind_leader,
+        "rank": rank,
+        "is_leader": distance_behind_leader == 0,
+    }
+
+
 def get_race_change_from_race_file(
     path_to_race_file: Union[str, Path],
     gate_name: Optional[str] = None,
     publish_time: Optional[int] = None,
+    race_file_index: Optional[RaceFileIndex] = None,
 ) -> Optional[dict[str, Any]]:
     """
     Search a recorded race file for the first update after the given criterion. You can search EITHER by the gate name,
@@ -3183,11 +6298,19 @@ def get_race_change_from_race_file(
     :param path_to_race_file: The path to the recorded race file to search
     :param gate_name: The Gmax gate name to search for, for example "1f"
     :param publish_time: The Betfair publish time to search for
+    :param race_file_index: Optionally a RaceFileIndex of the race file. If given then the race change is looked up
+        using the index rather than by scanning the file from the start. Worthwhile when searching the same race file
+        many times
     :return: The first race change meeting the search criterion
     :raises: AssertionError unless exactly one of gate_name and publish_time is not None
     """
     assert not (gate_name is not None and publish_time is not None)
 
+    if race_file_index is not None:
+        if gate_name is not None:
+            return race_file_index.get_race_change_by_gate_name(gate_name)
+        return race_file_index.get_race_change_by_publish_time(publish_time)
+
     g = create_race_change_generator_from_race_file(path_to_race_file)
     if gate_name is not None:
         for race_change in g:
@@ -3200,11 +6323,12 @@ def get_race_change_from_race_file(
 
 
 def remove_bet_from_runner_book(
-    runner_book: Union[dict[str, Any], RunnerBook],
+    runner_book: Union[dict[str, Any], "RunnerBook"],
     price: Union[int, float],
     size: Union[int, float],
     available_side: Side,
-) -> Union[dict[str, Any], RunnerBook]:
+    copy_mode: CopyModeEnum = CopyModeEnum.DEEP_COPY,
+) -> Union[dict[str, Any], "RunnerBook"]:
     """
     Create a new runner book with a bet removed from the order book
 
@@ -3212,52 +6336,95 @@ def remove_bet_from_runner_book(
     :param price: The price of the bet
     :param size: The size of the bet
     :param available_side: The side of the order book that the bet appears on
-    :return: A new runner book with the bet removed. The type of the return value will reflect the type of runner_book. If the given price is not available on the given side then the new runner book will be identical to runner_book
+    :param copy_mode: Controls how the new runner book is created. See remove_bets_from_runner_book for details
+    :return: A new runner book with the bet removed, or runner_book itself if copy_mode is CopyModeEnum.IN_PLACE. The type of the return value will reflect the type of runner_book. If the given price is not available on the given side then the new runner book will be identical to runner_book
     :raises: ValueError if size is greater than the size present in the order book
     """
-    runner_book = pickle.loads(pickle.dumps(runner_book))
+    return remove_bets_from_runner_book(
+        runner_book, [(price, size, available_side)], copy_mode=copy_mode
+    )
+
+
+def remove_bets_from_runner_book(
+    runner_book: Union[dict[str, Any], "RunnerBook"],
+    bets: Sequence[tuple[Union[int, float], Union[int, float], Side]],
+    copy_mode: CopyModeEnum = CopyModeEnum.DEEP_COPY,
+) -> Union[dict[str, Any], "RunnerBook"]:
+    """
+    Create a new runner book with many bets removed from the order book. Bets at the same price on the same side are combined and each side of the order book is processed in a single pass
+
+    :param runner_book: The runner book from which the bets are going to be removed either as a dictionary or betfairlightweight RunnerBook object
+    :param bets: The bets to remove as (price, size, available side) tuples where the available side is the side of the order book that the bet appears on
+    :param copy_mode: Controls how the new runner book is created. CopyModeEnum.DEEP_COPY creates a completely independent copy of runner_book. CopyModeEnum.STRUCTURAL_SHARING only copies the runner book and ex objects themselves and replaces the lists for the sides bets are removed from. All other lists and price sizes are shared with runner_book so must not be modified. CopyModeEnum.IN_PLACE replaces the lists for the sides bets are removed from within runner_book itself and returns it. The original lists and price sizes are never modified
+    :return: A new runner book with the bets removed, or runner_book itself if copy_mode is CopyModeEnum.IN_PLACE. The type of the return value will reflect the type of runner_book. Bets at prices which are not available on the given side are ignored
+    :raises: ValueError if the total size of the bets at a price is greater than the size present in the order book. runner_book is left unchanged in this case
+    """
+    sizes_to_remove = {}
+    for price, size, available_side in bets:
+        side_sizes_to_remove = sizes_to_remove.setdefault(available_side, {})
+        side_sizes_to_remove[price] = side_sizes_to_remove.get(price, 0) + size
+    # Sizes are in units of 0.01 so summing them should not introduce floating point error
+    for side_sizes_to_remove in sizes_to_remove.values():
+        for price, size in side_sizes_to_remove.items():
+            side_sizes_to_remove[price] = round(size, 2)
+
+    if copy_mode is CopyModeEnum.DEEP_COPY:
+        runner_book = pickle.loads(pickle.dumps(runner_book))
+    elif copy_mode is CopyModeEnum.STRUCTURAL_SHARING:
+        if isinstance(runner_book, dict):
+            runner_book = {**runner_book, "ex": dict(runner_book["ex"])}
+        else:
+            runner_book = copy.copy(runner_book)
+            runner_book.ex = copy.copy(runner_book.ex)
+
     if isinstance(runner_book, dict):
         ex = runner_book["ex"]
-        price_sizes = ex[available_side.ex_key]
         assignment_fun = dict.__setitem__
-        assignment_field = available_side.ex_key
     else:
         ex = runner_book.ex
-        price_sizes = getattr(ex, available_side.ex_attribute)
         assignment_fun = setattr
-        assignment_field = available_side.ex_attribute
 
-    if len(price_sizes) == 0:
-        return runner_book
+    new_price_sizes_by_field = []
+    for available_side, side_sizes_to_remove in sizes_to_remove.items():
+        if isinstance(runner_book, dict):
+            price_sizes = ex[available_side.ex_key]
+            assignment_field = available_side.ex_key
+        else:
+            price_sizes = getattr(ex, available_side.ex_attribute)
+            assignment_field = available_side.ex_attribute
 
-    if isinstance(price_sizes[0], dict):
-        constructor = dict
-        accessor_fun = dict.__getitem__
-    else:
-        constructor = PriceSize
-        accessor_fun = getattr
-
-    # Validation.
-    for price_size in price_sizes:
-        _price = accessor_fun(price_size, "price")
-        _size = accessor_fun(price_size, "size")
-        if _price == price and _size < size:
-            raise ValueError(
-                f"size = {size} but only {_size} available to {available_side.ex_key} at {_price}"
-            )
+        if len(price_sizes) == 0:
+            continue
 
-    new_price_sizes = [
-        constructor(
-            price=accessor_fun(price_size, "price"),
-            size=accessor_fun(price_size, "size")
-            - (size if accessor_fun(price_size, "price") == price else 0),
-        )
-        for price_size in price_sizes
-        if accessor_fun(price_size, "price") != price
-        or accessor_fun(price_size, "size") != size
-    ]
+        if isinstance(price_sizes[0], dict):
+            constructor = dict
+            accessor_fun = dict.__getitem__
+        else:
+            from betfairlightweight.resources.bettingresources import PriceSize
+
+            constructor = PriceSize
+            accessor_fun = getattr
+
+        new_price_sizes = []
+        for price_size in price_sizes:
+            _price = accessor_fun(price_size, "price")
+            size = side_sizes_to_remove.get(_price)
+            if size is None:
+                new_price_sizes.append(price_size)
+                continue
+            _size = accessor_fun(price_size, "size")
+            if _size < size:
+                raise ValueError(
+                    f"size = {size} but only {_size} available to {available_side.ex_key} at {_price}"
+                )
+            if _size != size:
+                new_price_sizes.append(
+                    constructor(price=_price, size=round(_size - size, 2))
+                )
+        new_price_sizes_by_field.append((assignment_field, new_price_sizes))
 
-    assignment_fun(ex, assignment_field, new_price_sizes)
+    for assignment_field, new_price_sizes in new_price_sizes_by_field:
+        assignment_fun(ex, assignment_field, new_price_sizes)
     return runner_book
 
 
@@ -3314,6 +6481,59 @@ def calculate_haversine_distance_between_runners(
     return 2 * _AVERAGE_EARTH_RADIUS_IN_METERS * asin(sqrt(d))
 
 
+def calculate_haversine_distance_matrix(
+    rc: dict[str, Any]
+) -> tuple[list[int], "np.ndarray"]:
+    """
+    Given a race change object, calculate the approximate distance in metres between every pair of horses using the
+    haversine formula, as calculate_haversine_distance_between_runners would for each pair. Requires numpy to be
+    installed
+
+    :param rc: A Betfair race change object as a Python dictionary
+    :return: A tuple of two items. The first is the selection IDs of the horses in the order they appear in the rrc
+        objects. The second is a square array whose entry [i, j] is the distance between the ith and jth horses
+    """
+    import numpy as np
+
+    rrcs = rc.get("rrc") or []
+    latitudes = np.array([rrc["lat"] for rrc in rrcs], dtype=np.float64)
+    longitudes = np.array([rrc["long"] for rrc in rrcs], dtype=np.float64)
+    return [rrc["id"] for rrc in rrcs], calculate_haversine_distance_matrices(
+        latitudes, longitudes
+    )
+
+
+def calculate_haversine_distance_matrices(
+    latitudes: "np.ndarray", longitudes: "np.ndarray"
+) -> "np.ndarray":
+    """
+    Calculate the approximate distance in metres between every pair of horses at every point in time using the haversine
+    formula and numpy broadcasting. Requires numpy to be installed
+
+    :param latitudes: An array of latitudes in degrees whose last axis indexes the horses, for example of shape (number
+        of times, number of horses). Missing positions can be NaN
+    :param longitudes: An array of longitudes in degrees of the same shape as latitudes
+    :return: An array of distances with an extra axis, for example of shape (number of times, number of horses, number
+        of horses), whose entry [..., i, j] is the distance between the ith and jth horses. Distances involving a missing
+        position are NaN
+    """
+    import numpy as np
+
+    latitudes = np.radians(np.asarray(latitudes, dtype=np.float64))
+    longitudes = np.radians(np.asarray(longitudes, dtype=np.float64))
+    delta_latitude = latitudes[..., :, np.newaxis] - latitudes[..., np.newaxis, :]
+    delta_longitude = longitudes[..., :, np.newaxis] - longitudes[..., np.newaxis, :]
+    cos_latitudes = np.cos(latitudes)
+    d = (
+        np.sin(delta_latitude * 0.5) ** 2
+        + cos_latitudes[..., :, np.newaxis]
+        * cos_latitudes[..., np.newaxis, :]
+        * np.sin(delta_longitude * 0.5) ** 2
+    )
+
+    return 2 * _AVERAGE_EARTH_RADIUS_IN_METERS * np.arcsin(np.sqrt(d))
+
+
 def get_number_of_jumps_remaining(rc: dict[str, Any]) -> Optional[int]:
     """
     Given a race change object, work out how many jumps there are between the _leader_ and the
@@ -3340,14 +6560,10 @@ def get_race_leaders(rc: dict[str, Any]) -> set[int]:
     :return: A set containing the selection IDs corresponding to the horses which are in the
         lead. The size of the set may exceed 1 if multiple horses are tied for the lead
     """
-    distances_remaining = sorted(rrc["prg"] for rrc in (rc.get("rrc") or []))
-    if len(distances_remaining) > 0:
-        leader_distance_remaining = distances_remaining[0]
-        return {
-            rrc["id"]
-            for rrc in (rc.get("rrc") or [])
-            if rrc["prg"] == leader_distance_remaining
-        }
+    rrcs = rc.get("rrc") or []
+    if len(rrcs) > 0:
+        leader_distance_remaining = min(rrc["prg"] for rrc in rrcs)
+        return {rrc["id"] for rrc in rrcs if rrc["prg"] == leader_distance_remaining}
     else:
         return set()
 
@@ -3360,3 +6576,47 @@ def virtualise_two_runner_price(
         return raw_price
     virtual_price = make_price_betfair_valid(raw_price, side.other_side)
     return virtual_price
+
+
+# Imported names which star imports exported before __all__ was defined. They remain exported for backwards
+# compatibility
+_LEGACY_STAR_EXPORTS = frozenset(
+    {
+        "Any",
+        "Generator",
+        "Iterator",
+        "Mapping",
+        "Optional",
+        "Path",
+        "Sequence",
+        "TYPE_CHECKING",
+        "Union",
+        "asin",
+        "bisect_left",
+        "bisect_right",
+        "cos",
+        "datetime",
+        "deque",
+        "enum",
+        "examples",
+        "heapq",
+        "itertools",
+        "pickle",
+        "radians",
+        "re",
+        "sin",
+        "sqrt",
+    }
+)
+
+# Defined last so that star imports include every public function, class and constant along with the attributes which
+# are imported lazily
+__all__ = sorted(
+    {
+        name
+        for name in globals()
+        if not name.startswith("_") and name not in _IMPORTED_NAMES
+    }
+    | _LAZY_ATTRIBUTE_MODULES.keys()
+    | _LEGACY_STAR_EXPORTS
+)
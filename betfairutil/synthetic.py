@@ -0,0 +1,593 @@
+import datetime
+import random
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Any, Generator, Optional, Union
+
+from betfairutil import BETFAIR_PRICES
+from betfairutil import BETFAIR_PRICE_TO_PRICE_INDEX_MAP
+from betfairutil import Side
+from betfairutil import _datetime_to_milliseconds
+from betfairutil import make_price_betfair_valid
+
+_SYNTHETIC_EVENT_ID = "31945198"
+_SYNTHETIC_MARKET_TYPES = (("WIN", 1), ("PLACE", 3))
+_NUMBER_OF_METRES_IN_A_FURLONG = 201.168
+
+
+def _create_synthetic_market_definition(
+    market_index: int,
+    selection_ids: Sequence[int],
+    market_time: datetime.datetime,
+    status: str,
+    in_play: bool,
+    version: int,
+    runner_statuses: Optional[Sequence[str]] = None,
+    bsps: Optional[Sequence[float]] = None,
+) -> dict[str, Any]:
+    market_type, number_of_winners = _SYNTHETIC_MARKET_TYPES[
+        market_index % len(_SYNTHETIC_MARKET_TYPES)
+    ]
+    market_time_string = market_time.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+    runners = []
+    for i, selection_id in enumerate(selection_ids):
+        runner = {
+            "id": selection_id,
+            "name": f"Runner {i + 1}",
+            "sortPriority": i + 1,
+            "status": "ACTIVE" if runner_statuses is None else runner_statuses[i],
+        }
+        if bsps is not None:
+            runner["bsp"] = bsps[i]
+        runners.append(runner)
+    return {
+        "betDelay": 1 if in_play else 0,
+        "bettingType": "ODDS",
+        "bspMarket": True,
+        "bspReconciled": bsps is not None,
+        "complete": True,
+        "countryCode": "GB",
+        "crossMatching": True,
+        "discountAllowed": True,
+        "eventId": _SYNTHETIC_EVENT_ID,
+        "eventName": "Synthetic Park 3rd Apr",
+        "eventTypeId": "7",
+        "inPlay": in_play,
+        "marketBaseRate": 5,
+        "marketTime": market_time_string,
+        "marketType": market_type,
+        "name": f"{market_type} {market_index}",
+        "numberOfActiveRunners": len(selection_ids),
+        "numberOfWinners": number_of_winners,
+        "openDate": market_time_string,
+        "persistenceEnabled": True,
+        "regulators": ["MR_INT"],
+        "runners": runners,
+        "runnersVoidable": False,
+        "status": status,
+        "suspendTime": market_time_string,
+        "timezone": "Europe/London",
+        "turnInPlayEnabled": True,
+        "venue": "Synthetic Park",
+        "version": version,
+    }
+
+
+def _create_synthetic_runner_change(
+    rng: random.Random,
+    selection_id: int,
+    index: int,
+    ladder_depth: int,
+    ladder: dict[float, str],
+) -> dict[str, Any]:
+    """
+    Create a runner change which moves a runner's ladder so that its best back price is BETFAIR_PRICES[index] and
+    its best lay price is the next price up, with random sizes. Price points which are no longer part of the ladder are
+    removed by setting their size to 0
+
+    :param rng: The random number generator used for the sizes
+    :param selection_id: The selection ID of the runner
+    :param index: The index in BETFAIR_PRICES of the new best back price
+    :param ladder_depth: The number of price points on each side of the ladder
+    :param ladder: A dict mapping each price currently on the ladder to either "atb" or "atl". Updated in place
+    :return: The runner change
+    """
+    new_ladder = {}
+    for depth in range(ladder_depth):
+        new_ladder[BETFAIR_PRICES[index - depth]] = "atb"
+        new_ladder[BETFAIR_PRICES[index + 1 + depth]] = "atl"
+    rc = {"id": selection_id, "atb": [], "atl": []}
+    for price, key in ladder.items():
+        if new_ladder.get(price) != key:
+            rc[key].append([price, 0])
+    for price, key in new_ladder.items():
+        rc[key].append([price, round(rng.uniform(2, 1000), 2)])
+    ladder.clear()
+    ladder.update(new_ladder)
+    return rc
+
+
+def _get_synthetic_speed(strength: float) -> float:
+    return 15.5 + 1.5 * strength
+
+
+def _get_synthetic_race_distance(
+    strengths: Sequence[float], inplay_seconds: float
+) -> float:
+    # Choose the distance so that the winner finishes after roughly 90% of the in play period
+    return _get_synthetic_speed(max(strengths)) * inplay_seconds * 0.9
+
+
+def _simulate_synthetic_race(
+    strengths: Sequence[float],
+    inplay_seconds: float,
+    race_updates_per_second: float,
+    seed: int,
+) -> Generator[tuple[float, list[float], list[float], list[float]], None, None]:
+    """
+    Simulate a race between runners whose speeds are determined by their strengths plus noise
+
+    :param strengths: The strength of each runner in [0, 1)
+    :param inplay_seconds: The maximum length of the race in seconds
+    :param race_updates_per_second: The number of race changes per second
+    :param seed: The seed for the random number generator
+    :return: A generator yielding, for each race change, the running time along with lists of each runner's speed,
+        distance remaining in metres and finishing time in seconds (infinity if it has not finished yet). The generator
+        stops once every runner has finished
+    """
+    rng = random.Random(seed)
+    base_speeds = [_get_synthetic_speed(strength) for strength in strengths]
+    distance = _get_synthetic_race_distance(strengths, inplay_seconds)
+    distances_remaining = [distance] * len(strengths)
+    finishing_times = [float("inf")] * len(strengths)
+    interval = 1.0 / race_updates_per_second
+    running_time = 0.0
+    while running_time <= inplay_seconds and max(distances_remaining) > 0:
+        speeds = []
+        for i, base_speed in enumerate(base_speeds):
+            if distances_remaining[i] > 0:
+                speed = round(base_speed + rng.uniform(-0.5, 0.5), 2)
+                if distances_remaining[i] <= speed * interval:
+                    finishing_times[i] = (
+                        running_time - interval + distances_remaining[i] / speed
+                    )
+                    distances_remaining[i] = 0.0
+                else:
+                    distances_remaining[i] -= speed * interval
+            else:
+                speed = 0.0
+            speeds.append(speed)
+        yield running_time, speeds, distances_remaining, finishing_times
+        running_time += interval
+
+
+def _get_synthetic_finishing_order(
+    strengths: Sequence[float],
+    inplay_seconds: float,
+    race_updates_per_second: float,
+    seed: int,
+) -> list[int]:
+    finishing_times = [float("inf")] * len(strengths)
+    distances_remaining = [0.0] * len(strengths)
+    for _, _, distances_remaining, finishing_times in _simulate_synthetic_race(
+        strengths, inplay_seconds, race_updates_per_second, seed
+    ):
+        pass
+    return sorted(
+        range(len(strengths)),
+        key=lambda i: (distances_remaining[i], finishing_times[i]),
+    )
+
+
+def _generate_synthetic_race_file(
+    path_to_race_file: Union[str, Path],
+    market_id: str,
+    selection_ids: Sequence[int],
+    strengths: Sequence[float],
+    off_publish_time: int,
+    inplay_seconds: float,
+    race_updates_per_second: float,
+    seed: int,
+) -> None:
+    import orjson
+    import smart_open
+
+    race_id = f"{_SYNTHETIC_EVENT_ID}.1400"
+    distance = _get_synthetic_race_distance(strengths, inplay_seconds)
+    number_of_furlongs_remaining = int(distance // _NUMBER_OF_METRES_IN_A_FURLONG)
+    gate_name = ""
+    sectional_time = 0.0
+
+    with smart_open.open(path_to_race_file, "wb") as f:
+        for clk, (
+            running_time,
+            speeds,
+            distances_remaining,
+            finishing_times,
+        ) in enumerate(
+            _simulate_synthetic_race(
+                strengths, inplay_seconds, race_updates_per_second, seed
+            )
+        ):
+            publish_time = off_publish_time + int(running_time * 1000)
+            rrc = []
+            for i, selection_id in enumerate(selection_ids):
+                progress = distance - distances_remaining[i]
+                rrc.append(
+                    {
+                        "ft": publish_time,
+                        "id": selection_id,
+                        "lat": round(51.5 + progress / 111_000, 7),
+                        "long": round(-0.1 + i * 1e-5, 7),
+                        "spd": speeds[i],
+                        "prg": round(distances_remaining[i], 1),
+                        "sfq": round(2.0 + speeds[i] / 40, 2) if speeds[i] > 0 else 0.0,
+                    }
+                )
+            leader_distance_remaining = min(distances_remaining)
+            while (
+                number_of_furlongs_remaining > 0
+                and leader_distance_remaining
+                <= number_of_furlongs_remaining * _NUMBER_OF_METRES_IN_A_FURLONG
+            ):
+                gate_name = f"{number_of_furlongs_remaining}f"
+                sectional_time = running_time
+                number_of_furlongs_remaining -= 1
+            if leader_distance_remaining == 0 and gate_name != "Finish":
+                gate_name = "Finish"
+                sectional_time = running_time
+            f.write(
+                orjson.dumps(
+                    {
+                        "op": "rcm",
+                        "clk": str(clk),
+                        "pt": publish_time,
+                        "rc": [
+                            {
+                                "id": race_id,
+                                "mid": market_id,
+                                "rpc": {
+                                    "ft": publish_time,
+                                    "g": gate_name,
+                                    "st": round(sectional_time, 2),
+                                    "rt": round(running_time, 2),
+                                    "spd": max(speeds),
+                                    "prg": round(leader_distance_remaining, 1),
+                                    "ord": [
+                                        selection_ids[i]
+                                        for i in sorted(
+                                            range(len(selection_ids)),
+                                            key=lambda i: (
+                                                distances_remaining[i],
+                                                finishing_times[i],
+                                            ),
+                                        )
+                                    ],
+                                    "J": [],
+                                },
+                                "rrc": rrc,
+                            }
+                        ],
+                    }
+                )
+            )
+            f.write(b"\n")
+
+
+def generate_synthetic_prices_file(
+    path_to_prices_file: Union[str, Path],
+    path_to_race_file: Optional[Union[str, Path]] = None,
+    number_of_markets: int = 1,
+    number_of_runners: int = 10,
+    ladder_depth: int = 3,
+    updates_per_second: float = 5.0,
+    pre_off_seconds: float = 600.0,
+    should_go_inplay: bool = True,
+    inplay_seconds: float = 120.0,
+    number_of_suspensions: int = 0,
+    should_zero_on_close: bool = True,
+    race_updates_per_second: float = 1.0,
+    market_time: Optional[datetime.datetime] = None,
+    seed: int = 0,
+) -> None:
+    """
+    Write a synthetic Betfair prices file, and optionally a matching race file, for benchmarking and load testing. The
+    output is deterministic given the seed and is written a line at a time so files ranging from kilobytes to
+    gigabytes can be generated in constant memory. The prices file can be read by
+    create_market_book_generator_from_prices_file and passes validate_prices_file.
+
+    Every market is in the same horse racing event. Markets alternate between WIN and PLACE market types. Each runner
+    has a hidden strength which determines its starting price, the direction its price moves in play, its speed in the
+    race and therefore the result. Before the off, one randomly chosen runner in one randomly chosen market has its best
+    prices randomly walk one tick and a trade matched at either its best back or best lay price in each update. The
+    closing sequence is a suspension, optionally followed by an update zeroing every ladder and traded volume as
+    Betfair does, and finally a market definition with the result and BSPs
+
+    :param path_to_prices_file: Where to write the prices file. As with the other functions in this package, this can be
+        any path that can be handled by the smart_open package and the file is compressed according to its extension,
+        for example ".gz" or ".bz2"
+    :param path_to_race_file: Optionally where to write a race file, in the format recorded from the race stream,
+        covering the in play period of the markets. Requires should_go_inplay to be True
+    :param number_of_markets: The number of markets in the prices file. Values above 1 produce an event-level file
+    :param number_of_runners: The number of runners in each market
+    :param ladder_depth: The number of price points on each side of each runner's ladder
+    :param updates_per_second: The mean number of price updates per second. The time between updates is exponentially
+        distributed
+    :param pre_off_seconds: How many seconds before the market time the prices file starts
+    :param should_go_inplay: Should the markets be suspended and then turn in play at the market time
+    :param inplay_seconds: How many seconds the markets are in play before closing. Ignored if should_go_inplay is False
+    :param number_of_suspensions: The number of two second suspensions at random times during the in play period, or
+        the pre-off period if should_go_inplay is False
+    :param should_zero_on_close: Should the ladders and traded volumes be zeroed when the markets close
+    :param race_updates_per_second: The number of race changes per second in the race file
+    :param market_time: The market time. Defaults to 2022-04-03 14:00 UTC
+    :param seed: The seed for the random number generator
+    :return: None
+    :raises: ValueError if path_to_race_file is given but should_go_inplay is False, or ladder_depth is not positive
+    """
+    import orjson
+    import smart_open
+
+    if path_to_race_file is not None and not should_go_inplay:
+        raise ValueError(
+            "A race file can only be generated for markets which go in play"
+        )
+    if ladder_depth <= 0:
+        raise ValueError(f"ladder_depth must be positive ({ladder_depth} given)")
+
+    rng = random.Random(seed)
+    market_time = market_time or datetime.datetime(
+        2022, 4, 3, 14, tzinfo=datetime.timezone.utc
+    )
+    off_publish_time = _datetime_to_milliseconds(market_time)
+    start_publish_time = off_publish_time - int(pre_off_seconds * 1000)
+    end_publish_time = off_publish_time + (
+        int(inplay_seconds * 1000) if should_go_inplay else 0
+    )
+
+    market_ids = [f"1.{200_000_000 + i}" for i in range(number_of_markets)]
+    selection_ids = [10_000_000 + 1_000 * i for i in range(number_of_runners)]
+    strengths = [rng.random() for _ in range(number_of_runners)]
+    race_seed = rng.getrandbits(64)
+    if should_go_inplay:
+        finishing_order = _get_synthetic_finishing_order(
+            strengths, inplay_seconds, race_updates_per_second, race_seed
+        )
+    else:
+        finishing_order = sorted(
+            range(number_of_runners), key=lambda i: strengths[i], reverse=True
+        )
+
+    min_index = ladder_depth - 1
+    max_index = len(BETFAIR_PRICES) - 1 - ladder_depth
+    total_strength = sum(s**2 for s in strengths) or 1.0
+    indices = []
+    for market_index in range(number_of_markets):
+        number_of_winners = _SYNTHETIC_MARKET_TYPES[
+            market_index % len(_SYNTHETIC_MARKET_TYPES)
+        ][1]
+        market_indices = []
+        for strength in strengths:
+            probability = min(
+                number_of_winners * max(strength**2, 0.01) / total_strength, 0.99
+            )
+            price = make_price_betfair_valid(1.0 / probability, Side.BACK)
+            market_indices.append(
+                min(max(BETFAIR_PRICE_TO_PRICE_INDEX_MAP[price], min_index), max_index)
+            )
+        indices.append(market_indices)
+    ladders = [[{} for _ in range(number_of_runners)] for _ in range(number_of_markets)]
+    traded = [[{} for _ in range(number_of_runners)] for _ in range(number_of_markets)]
+
+    # Events are (publish time, status, in play) tuples which apply to every market
+    events = []
+    if should_go_inplay:
+        events.append((off_publish_time, "SUSPENDED", True))
+        events.append((off_publish_time + 1000, "OPEN", True))
+        suspension_start, suspension_end = off_publish_time + 1000, end_publish_time
+    else:
+        suspension_start, suspension_end = start_publish_time, end_publish_time
+    for _ in range(number_of_suspensions):
+        publish_time = rng.randrange(
+            suspension_start, max(suspension_end - 2000, suspension_start + 1)
+        )
+        events.append((publish_time, "SUSPENDED", None))
+        events.append((publish_time + 2000, "OPEN", None))
+    events.sort(key=lambda event: event[0])
+
+    clk = 0
+    version = 1
+
+    def write(f, publish_time: int, mc: list[dict[str, Any]]) -> None:
+        nonlocal clk
+        clk += 1
+        f.write(
+            orjson.dumps({"op": "mcm", "clk": str(clk), "pt": publish_time, "mc": mc})
+        )
+        f.write(b"\n")
+
+    status, in_play = "OPEN", False
+    event_position = 0
+    publish_time = start_publish_time
+    with smart_open.open(path_to_prices_file, "wb") as f:
+        write(
+            f,
+            publish_time,
+            [
+                {
+                    "id": market_id,
+                    "img": True,
+                    "marketDefinition": _create_synthetic_market_definition(
+                        market_index,
+                        selection_ids,
+                        market_time,
+                        status,
+                        in_play,
+                        version,
+                    ),
+                    "rc": [
+                        _create_synthetic_runner_change(
+                            rng,
+                            selection_ids[runner_index],
+                            indices[market_index][runner_index],
+                            ladder_depth,
+                            ladders[market_index][runner_index],
+                        )
+                        for runner_index in range(number_of_runners)
+                    ],
+                }
+                for market_index, market_id in enumerate(market_ids)
+            ],
+        )
+
+        while True:
+            publish_time += max(int(rng.expovariate(updates_per_second) * 1000), 1)
+            while event_position < len(events) and events[event_position][0] <= min(
+                publish_time, end_publish_time
+            ):
+                event_publish_time, status, event_in_play = events[event_position]
+                if event_in_play is not None:
+                    in_play = event_in_play
+                version += 1
+                write(
+                    f,
+                    event_publish_time,
+                    [
+                        {
+                            "id": market_id,
+                            "marketDefinition": _create_synthetic_market_definition(
+                                market_index,
+                                selection_ids,
+                                market_time,
+                                status,
+                                in_play,
+                                version,
+                            ),
+                        }
+                        for market_index, market_id in enumerate(market_ids)
+                    ],
+                )
+                event_position += 1
+            if publish_time >= end_publish_time:
+                break
+            if status != "OPEN":
+                continue
+
+            market_index = rng.randrange(number_of_markets)
+            runner_index = rng.randrange(number_of_runners)
+            if in_play:
+                # In play, prices drift towards the result: the stronger runners shorten and the weaker ones lengthen
+                rank = finishing_order.index(runner_index)
+                step = -1 if rng.random() < 1 - rank / number_of_runners else 1
+            else:
+                step = rng.choice((-1, 0, 1))
+            index = min(
+                max(indices[market_index][runner_index] + step, min_index), max_index
+            )
+            indices[market_index][runner_index] = index
+            rc = _create_synthetic_runner_change(
+                rng,
+                selection_ids[runner_index],
+                index,
+                ladder_depth,
+                ladders[market_index][runner_index],
+            )
+            price = BETFAIR_PRICES[index + rng.randint(0, 1)]
+            runner_traded = traded[market_index][runner_index]
+            runner_traded[price] = round(
+                runner_traded.get(price, 0) + rng.uniform(2, 100), 2
+            )
+            rc["trd"] = [[price, runner_traded[price]]]
+            rc["ltp"] = price
+            rc["tv"] = round(sum(runner_traded.values()), 2)
+            write(f, publish_time, [{"id": market_ids[market_index], "rc": [rc]}])
+
+        version += 1
+        write(
+            f,
+            end_publish_time,
+            [
+                {
+                    "id": market_id,
+                    "marketDefinition": _create_synthetic_market_definition(
+                        market_index,
+                        selection_ids,
+                        market_time,
+                        "SUSPENDED",
+                        in_play,
+                        version,
+                    ),
+                }
+                for market_index, market_id in enumerate(market_ids)
+            ],
+        )
+        if should_zero_on_close:
+            write(
+                f,
+                end_publish_time + 1000,
+                [
+                    {
+                        "id": market_id,
+                        "rc": [
+                            {
+                                "id": selection_ids[runner_index],
+                                **{
+                                    key: [
+                                        [price, 0]
+                                        for price, side_key in ladders[market_index][
+                                            runner_index
+                                        ].items()
+                                        if side_key == key
+                                    ]
+                                    for key in ("atb", "atl")
+                                },
+                                "trd": [
+                                    [price, 0]
+                                    for price in traded[market_index][runner_index]
+                                ],
+                                "tv": 0,
+                            }
+                            for runner_index in range(number_of_runners)
+                        ],
+                    }
+                    for market_index, market_id in enumerate(market_ids)
+                ],
+            )
+        version += 1
+        mc = []
+        for market_index, market_id in enumerate(market_ids):
+            number_of_winners = _SYNTHETIC_MARKET_TYPES[
+                market_index % len(_SYNTHETIC_MARKET_TYPES)
+            ][1]
+            winners = set(finishing_order[:number_of_winners])
+            mc.append(
+                {
+                    "id": market_id,
+                    "marketDefinition": _create_synthetic_market_definition(
+                        market_index,
+                        selection_ids,
+                        market_time,
+                        "CLOSED",
+                        in_play,
+                        version,
+                        runner_statuses=[
+                            "WINNER" if runner_index in winners else "LOSER"
+                            for runner_index in range(number_of_runners)
+                        ],
+                        bsps=[BETFAIR_PRICES[index] for index in indices[market_index]],
+                    ),
+                }
+            )
+        write(f, end_publish_time + 2000, mc)
+
+    if path_to_race_file is not None:
+        _generate_synthetic_race_file(
+            path_to_race_file,
+            market_id=market_ids[0],
+            selection_ids=selection_ids,
+            strengths=strengths,
+            off_publish_time=off_publish_time,
+            inplay_seconds=inplay_seconds,
+            race_updates_per_second=race_updates_per_second,
+            seed=race_seed,
+        )
@@ -30,5 +30,6 @@ setup(
     extras_require={
         "files": ["betfairlightweight>=2.12.0", "orjson", "smart_open"],
         "data_frames": ["pandas"],
+        "arrays": ["numpy"],
     },
 )
@@ -1,9 +1,15 @@
 import datetime
+import io
 import json
+import os
+from collections import deque
 from copy import deepcopy
+from math import log
 from pathlib import Path
 from typing import Any
+from typing import Optional
 
+import numpy as np
 import pandas as pd
 import pytest
 import smart_open
@@ -13,14 +19,26 @@ from betfairlightweight.resources import MarketDefinition
 from betfairlightweight.resources import RunnerBook
 from pyrsistent import pmap
 
+from betfairutil import _create_reverse_line_generator
+from betfairutil import build_race_card_and_result_index
 from betfairutil import calculate_available_volume
 from betfairutil import calculate_book_percentage
 from betfairutil import calculate_haversine_distance_between_runners
+from betfairutil import calculate_haversine_distance_matrices
+from betfairutil import calculate_haversine_distance_matrix
 from betfairutil import calculate_market_book_diff
 from betfairutil import calculate_order_book_imbalance
+from betfairutil import calculate_seconds_to_market_time
 from betfairutil import calculate_total_matched
+from betfairutil import clear_race_card_and_result_cache
 from betfairutil import convert_yards_to_metres
+from betfairutil import CopyModeEnum
+from betfairutil import create_as_of_market_book_and_race_change_generator
+from betfairutil import create_combined_generator_from_files
 from betfairutil import create_combined_market_book_and_race_change_generator
+from betfairutil import create_market_book_generator_from_prices_file
+from betfairutil import create_race_change_generator_from_race_file
+from betfairutil import create_trade_generator_from_prices_file
 from betfairutil import DataFrameFormatEnum
 from betfairutil import datetime_to_publish_time
 from betfairutil import does_market_book_contain_runner_names
@@ -28,23 +46,27 @@ from betfairutil import does_market_definition_contain_runner_names
 from betfairutil import EX_KEYS
 from betfairutil import filter_runners
 from betfairutil import get_all_market_definitions_from_prices_file
+from betfairutil import get_best_price
 from betfairutil import get_best_price_with_rollup
 from betfairutil import get_bsp_from_market_definition
 from betfairutil import get_bsp_from_prices_file
 from betfairutil import get_bsp_from_race_result
 from betfairutil import get_event_id_from_string
 from betfairutil import get_final_market_definition_from_prices_file
+from betfairutil import get_first_market_books_from_prices_file
 from betfairutil import get_first_market_definition_from_prices_file
 from betfairutil import get_inplay_publish_time_from_prices_file
 from betfairutil import get_inplay_bet_delay_from_prices_file
 from betfairutil import get_is_jump_from_race_card
 from betfairutil import get_market_books_from_prices_file
+from betfairutil import get_market_books_from_prices_files
 from betfairutil import get_market_id_from_string
 from betfairutil import get_market_time_as_datetime
 from betfairutil import get_mid_price
 from betfairutil import get_minimum_book_percentage_market_books_from_prices_file
 from betfairutil import get_number_of_jumps_remaining
 from betfairutil import get_pre_event_volume_traded_from_prices_file
+from betfairutil import get_publish_time_from_object
 from betfairutil import get_race_change_from_race_file
 from betfairutil import get_race_distance_in_metres_from_race_card
 from betfairutil import get_race_id_from_string
@@ -57,20 +79,37 @@ from betfairutil import get_selection_id_to_runner_name_map_from_market_catalogu
 from betfairutil import get_total_volume_traded_from_prices_file
 from betfairutil import get_win_market_id_from_race_card
 from betfairutil import get_win_market_id_from_race_file
+from betfairutil import get_windowed_market_books_from_prices_file
 from betfairutil import get_winners_from_market_definition
 from betfairutil import get_winners_from_prices_file
 from betfairutil import get_winners_from_race_result
 from betfairutil import is_market_book
 from betfairutil import is_runner_book
 from betfairutil import iterate_other_active_runners
+from betfairutil import join_race_arrays_to_publish_times
 from betfairutil import market_book_to_data_frame
 from betfairutil import prices_file_to_csv_file
+from betfairutil import prices_file_to_data_frame
 from betfairutil import publish_time_to_datetime
+from betfairutil import race_file_to_arrays
+from betfairutil import race_file_to_rankings
+from betfairutil import RaceFileIndex
 from betfairutil import random_from_market_id
 from betfairutil import read_prices_file
 from betfairutil import read_race_file
 from betfairutil import remove_bet_from_runner_book
+from betfairutil import remove_bets_from_runner_book
+from betfairutil import RollingWindow
+from betfairutil import RollingWindowStatistics
+from betfairutil import RunnerIndex
+from betfairutil import set_race_card_and_result_cache_size
 from betfairutil import Side
+from betfairutil import SimulatedMatchingEngine
+from betfairutil import TradedVolumeStatistics
+from betfairutil import TradeTape
+from betfairutil import validate_prices_file
+from betfairutil import WindowSelectorEnum
+from betfairutil.synthetic import generate_synthetic_prices_file
 
 
 @pytest.fixture
@@ -281,7 +320,15 @@ def write_to_prices_file(
     rc: list[dict[str, Any]],
     path_to_prices_file: Path,
     mode: str,
+    img: bool = False,
 ) -> None:
+    mc = {
+        "id": "1.123",
+        "marketDefinition": market_definition,
+        "rc": rc,
+    }
+    if img:
+        mc["img"] = True
     with smart_open.open(path_to_prices_file, mode) as f:
         f.write(
             json.dumps(
@@ -289,13 +336,7 @@ def write_to_prices_file(
                     "op": "mcm",
                     "clk": 0,
                     "pt": publish_time,
-                    "mc": [
-                        {
-                            "id": "1.123",
-                            "marketDefinition": market_definition,
-                            "rc": rc,
-                        }
-                    ],
+                    "mc": [mc],
                 }
             )
         )
@@ -351,6 +392,75 @@ def path_to_prices_file_with_inplay_transition(
     return path_to_prices_file
 
 
+@pytest.fixture
+def path_to_prices_file_with_trades(
+    market_book: dict[str, Any], market_definition: dict[str, Any], tmp_path: Path
+):
+    path_to_prices_file = tmp_path / f"1.123-trades.json.gz"
+    write_to_prices_file(
+        publish_time=market_book["publishTime"],
+        market_definition=market_definition,
+        rc=[
+            {"id": 123, "atb": [[1.98, 10]], "atl": [[2.0, 10]]},
+            {"id": 456, "atb": [[1.98, 10]], "atl": [[2.0, 10]]},
+        ],
+        path_to_prices_file=path_to_prices_file,
+        mode="w",
+    )
+    write_to_prices_file(
+        publish_time=market_book["publishTime"] + 50,
+        market_definition=market_definition,
+        rc=[{"id": 123, "atl": [[2.0, 6]], "trd": [[2.0, 4]]}],
+        path_to_prices_file=path_to_prices_file,
+        mode="a",
+    )
+    write_to_prices_file(
+        publish_time=market_book["publishTime"] + 100,
+        market_definition=market_definition,
+        rc=[
+            {"id": 123, "atb": [[1.98, 7]], "trd": [[1.98, 3], [2.0, 5]]},
+            {"id": 456, "trd": [[1.99, 2]]},
+        ],
+        path_to_prices_file=path_to_prices_file,
+        mode="a",
+    )
+    # Betfair zeroes the traded volume as the market closes
+    write_to_prices_file(
+        publish_time=market_book["publishTime"] + 150,
+        market_definition=market_definition,
+        rc=[{"id": 123, "trd": []}, {"id": 456, "trd": []}],
+        path_to_prices_file=path_to_prices_file,
+        mode="a",
+    )
+
+    return path_to_prices_file
+
+
+@pytest.fixture
+def path_to_prices_file_with_reimage(
+    market_book: dict[str, Any], market_definition: dict[str, Any], tmp_path: Path
+):
+    path_to_prices_file = tmp_path / "1.123-reimage.json.gz"
+    write_to_prices_file(
+        publish_time=market_book["publishTime"],
+        market_definition=market_definition,
+        rc=[{"id": 123, "trd": [[2.0, 10]]}],
+        path_to_prices_file=path_to_prices_file,
+        mode="w",
+    )
+    # Betfair can resend the entire market state, replacing rather than updating the cache
+    write_to_prices_file(
+        publish_time=market_book["publishTime"] + 50,
+        market_definition=market_definition,
+        rc=[{"id": 123, "trd": [[3.0, 5]]}],
+        path_to_prices_file=path_to_prices_file,
+        mode="a",
+        img=True,
+    )
+
+    return path_to_prices_file
+
+
 @pytest.fixture
 def path_to_prices_file_with_turn_in_play_disabled(
     market_book: dict[str, Any], market_definition: dict[str, Any], tmp_path: Path
@@ -545,6 +655,115 @@ def test_get_runner_book_from_market_book(market_book: dict[str, Any]):
     assert get_runner_book_from_market_book(market_book, selection_id=123) is None
 
 
+def test_get_runner_book_from_market_book_with_runner_index(
+    market_book: dict[str, Any]
+):
+    runner_index = RunnerIndex()
+    for _ in range(2):
+        assert (
+            get_runner_book_from_market_book(
+                market_book, selection_id=456, runner_index=runner_index
+            )
+            == market_book["runners"][1]
+        )
+        assert (
+            get_runner_book_from_market_book(
+                market_book, runner_name="bar", runner_index=runner_index
+            )["selectionId"]
+            == 456
+        )
+    assert (
+        get_runner_book_from_market_book(
+            market_book, selection_id=789, runner_index=runner_index
+        )
+        is None
+    )
+    assert (
+        get_runner_book_from_market_book(
+            market_book, runner_name="alice", runner_index=runner_index
+        )
+        is None
+    )
+    assert (
+        get_runner_book_from_market_book(
+            market_book, selection_id=456, handicap=1.0, runner_index=runner_index
+        )
+        is None
+    )
+
+    runner_book = get_runner_book_from_market_book(
+        market_book, selection_id=456, runner_index=runner_index, should_copy=False
+    )
+    assert runner_book is market_book["runners"][1]
+    runner_book = get_runner_book_from_market_book(
+        market_book, selection_id=456, should_copy=False
+    )
+    assert runner_book is market_book["runners"][1]
+
+    _market_book = MarketBook(**market_book)
+    runner_book = get_runner_book_from_market_book(
+        _market_book, selection_id=456, runner_index=runner_index, should_copy=False
+    )
+    assert runner_book is _market_book.runners[1]
+    runner_book = get_runner_book_from_market_book(
+        _market_book,
+        selection_id=456,
+        return_type=dict,
+        runner_index=runner_index,
+        should_copy=False,
+    )
+    assert runner_book is market_book["runners"][1]
+
+    # The runners are reordered and the market definition changes
+    next_market_book = deepcopy(market_book)
+    next_market_book["runners"].reverse()
+    next_market_book["marketDefinition"]["runners"].reverse()
+    assert (
+        get_runner_book_from_market_book(
+            next_market_book, selection_id=456, runner_index=runner_index
+        )
+        == next_market_book["runners"][0]
+    )
+    assert (
+        get_runner_book_from_market_book(
+            next_market_book, runner_name="foo", runner_index=runner_index
+        )
+        == next_market_book["runners"][1]
+    )
+
+    runner_index.clear(market_book["marketId"])
+    runner_index.clear()
+    assert (
+        get_runner_book_from_market_book(
+            market_book, runner_name="foo", runner_index=runner_index
+        )
+        == market_book["runners"][0]
+    )
+
+    # The runners are modified in place
+    market_book["runners"].reverse()
+    assert (
+        get_runner_book_from_market_book(
+            market_book, selection_id=456, runner_index=runner_index
+        )
+        == market_book["runners"][0]
+    )
+    market_book["runners"].append({**market_book["runners"][0], "selectionId": 789})
+    assert (
+        get_runner_book_from_market_book(
+            market_book, selection_id=789, runner_index=runner_index
+        )["selectionId"]
+        == 789
+    )
+    market_book["marketDefinition"]["runners"].append({"id": 789, "name": "alice"})
+    assert (
+        get_runner_book_from_market_book(
+            market_book, runner_name="alice", runner_index=runner_index
+        )["selectionId"]
+        == 789
+    )
+
+
 def test_get_best_price_with_rollup(market_book: dict[str, Any]):
     runner_book = get_runner_book_from_market_book(market_book, 123)
     runner_book["ex"]["availableToBack"].append({"price": 1.97, "size": 1})
@@ -625,6 +844,74 @@ def test_get_win_market_id_from_race_card(
     )
 
 
+def test_import_is_lazy():
+    import subprocess
+    import sys
+
+    code = (
+        "import sys; import betfairutil; "
+        "print(sorted(m for m in "
+        "('betfairlightweight', 'betfairutil.examples', 'betfairutil.synthetic') "
+        "if m in sys.modules))"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, check=True, text=True
+    ).stdout
+    assert output.strip() == "[]"
+
+    import betfairutil
+
+    assert betfairutil.MarketBook is MarketBook
+    assert (
+        betfairutil.EXAMPLE_RUNNER_BOOK is betfairutil.EXAMPLE_MARKET_BOOK["runners"][0]
+    )
+    assert "MarketBook" in dir(betfairutil)
+    with pytest.raises(AttributeError):
+        betfairutil.NOT_AN_ATTRIBUTE
+
+    namespace = {}
+    exec("from betfairutil import *", namespace)
+    assert namespace["EXAMPLE_MARKET_BOOK"] is betfairutil.EXAMPLE_MARKET_BOOK
+    assert namespace["read_prices_file"] is read_prices_file
+    assert "_read_json_file" not in namespace
+    assert "generate_synthetic_prices_file" not in namespace
+    # Names exported before __all__ was defined are still exported
+    assert namespace["deque"] is deque
+    assert namespace["examples"] is betfairutil.examples
+
+
+def test_open_mocker_without_importing_smart_open_first(path_to_prices_file: Path):
+    import subprocess
+    import sys
+
+    # smart_open is first imported while builtins.open is patched
+    code = "\n".join(
+        [
+            "import sys",
+            "from unittest.mock import patch",
+            "import betfairutil",
+            "assert 'smart_open' not in sys.modules",
+            f"open_mocker = betfairutil._OpenMocker({str(path_to_prices_file)!r})",
+            "with patch('builtins.open', open_mocker.open):",
+            f"    print(len(open({str(path_to_prices_file)!r}, 'rb').readlines()))",
+        ]
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, check=True, text=True
+    ).stdout
+    assert output.strip() == "1"
+
+    code = (
+        "import sys; import betfairutil; "
+        "assert 'smart_open' not in sys.modules; "
+        f"print(len(betfairutil.read_prices_file({str(path_to_prices_file)!r})))"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, check=True, text=True
+    ).stdout
+    assert output.strip() == "1"
+
+
 def test_is_market_book(
     market_book: dict[str, Any],
     market_catalogue: dict[str, Any],
@@ -637,6 +924,9 @@ def test_is_market_book(
     assert is_market_book(MarketBook(**market_book))
     assert not is_market_book(MarketBook(**market_book).runners[0])
 
+    market_book["runners"][0]["runnerName"] = "Foo"
+    assert not is_market_book(market_book)
+
 
 def test_is_runner_book(
     market_book: dict[str, Any],
@@ -650,6 +940,50 @@ def test_is_runner_book(
     assert is_runner_book(market_book["runners"][0])
     assert is_runner_book(MarketBook(**market_book).runners[0])
 
+    del market_book["runners"][0]["status"]
+    assert not is_runner_book(market_book["runners"][0])
+
+
+def test_validate_prices_file(
+    path_to_prices_file: Path, market_definition: dict[str, Any], tmp_path: Path
+):
+    assert validate_prices_file(path_to_prices_file) == []
+
+    path_to_invalid_prices_file = tmp_path / "1.456.json"
+    with open(path_to_invalid_prices_file, "w") as f:
+        f.write(json.dumps({"op": "mcm", "pt": 2, "mc": [{"id": "1.456"}]}) + "\n")
+        f.write("not json\n")
+        del market_definition["betDelay"]
+        f.write(
+            json.dumps(
+                {
+                    "op": "mcm",
+                    "pt": 1,
+                    "mc": [
+                        {
+                            "id": "1.456",
+                            "marketDefinition": market_definition,
+                            "rc": [
+                                {"id": "123", "atb": [[1.98, -1]]},
+                                {"id": 456, "batl": [[1.98, 1]]},
+                            ],
+                        }
+                    ],
+                }
+            )
+            + "\n"
+        )
+
+    assert validate_prices_file(path_to_invalid_prices_file) == [
+        "line 1: mc[0] is the first change for market 1.456 but has no marketDefinition",
+        "line 2: invalid JSON",
+        "line 3: pt 1 is before the previous pt 2",
+        "line 3: mc[0].marketDefinition is missing ['betDelay']",
+        "line 3: mc[0].rc[0].id is missing or not an integer",
+        "line 3: mc[0].rc[0].atb[0] has a negative size",
+        "line 3: mc[0].rc[1].batl[0] is not a list of 3 numbers",
+    ]
+
 
 def test_iterate_other_active_runners(market_book: dict[str, Any]):
     assert next(iterate_other_active_runners(market_book, 123))["selectionId"] == 456
@@ -677,6 +1011,24 @@ def test_market_book_to_data_frame(market_book: dict[str, Any]):
     assert df["runner_name"].iloc[0] == "foo"
     assert df["runner_name"].iloc[1] == "bar"
 
+    df = market_book_to_data_frame(
+        dict(market_book, publishTime=market_book["publishTime"] - 1500),
+        should_output_seconds_to_off=True,
+    )
+    assert df["seconds_to_off"].tolist() == [1.5, 1.5]
+
+
+def test_prices_file_to_data_frame_with_seconds_to_off(
+    market_book: dict[str, Any], path_to_prices_file_with_trades: Path
+):
+    df = prices_file_to_data_frame(
+        path_to_prices_file_with_trades, should_output_seconds_to_off=True
+    )
+    assert (
+        df["seconds_to_off"] == (market_book["publishTime"] - df["publish_time"]) / 1000
+    ).all()
+    assert df["seconds_to_off"].min() == -0.15
+
 
 def test_prices_file_to_csv_file(
     market_definition: dict[str, Any],
@@ -794,6 +1146,172 @@ def test_read_race_file(race_change: dict[str, Any], path_to_race_file: Path):
     assert rcs[0] == race_change
 
 
+@pytest.mark.parametrize("prefetch", [0, 1, 2048])
+def test_create_race_change_generator_from_race_file(
+    race_change: dict[str, Any], tmp_path: Path, prefetch: int
+):
+    from unittest.mock import patch
+
+    from betfairlightweight import APIClient
+    from betfairlightweight import StreamListener
+
+    path_to_race_file = tmp_path / "31945198.2354.jsonl.gz"
+    other_race_change = {
+        "id": "31945198.2355",
+        "mid": "1.207120594",
+        "rpc": {"ft": 1670024521900, "g": "1f", "prg": 1000},
+    }
+    with smart_open.open(path_to_race_file, "w") as f:
+        for i in range(3000):
+            rc = [deepcopy(race_change)]
+            rc[0]["rrc"][0]["ft"] += i
+            if i % 2:
+                del rc[0]["rpc"]
+            if i == 1500:
+                rc.append(other_race_change)
+            f.write(
+                json.dumps({"op": "rcm", "clk": i, "pt": 1670024521800 + i, "rc": rc})
+            )
+            f.write("\n")
+        f.write(json.dumps({"op": "rcm", "clk": 3000, "pt": 1670024525000}))
+        f.write("\n")
+
+    # The race changes should be the same as betfairlightweight generates
+    trading = APIClient(username="", password="", app_key="")
+    stream = trading.streaming.create_historical_generator_stream(
+        file_path=path_to_race_file,
+        listener=StreamListener(max_latency=None, lightweight=True, update_clk=False),
+        operation="raceSubscription",
+    )
+    with patch("builtins.open", smart_open.open):
+        expected_race_changes = [rc for rcs in stream.get_generator()() for rc in rcs]
+
+    race_changes = list(
+        create_race_change_generator_from_race_file(
+            path_to_race_file, prefetch=prefetch
+        )
+    )
+    assert race_changes == expected_race_changes
+
+    g = create_race_change_generator_from_race_file(
+        path_to_race_file, prefetch=prefetch
+    )
+    assert next(g) == expected_race_changes[0]
+    g.close()
+
+
+def test_create_race_change_generator_from_race_file_with_bad_lines(
+    race_change: dict[str, Any], path_to_race_file: Path
+):
+    with smart_open.open(path_to_race_file, "a") as f:
+        f.write('{"op": "rcm", "pt": \n')
+        f.write(json.dumps({"op": "rcm", "rc": [race_change]}))
+        f.write("\n")
+
+    with pytest.warns(UserWarning):
+        race_changes = list(
+            create_race_change_generator_from_race_file(path_to_race_file)
+        )
+    assert len(race_changes) == 1
+    with pytest.warns(UserWarning):
+        runner_arrays, race_arrays = race_file_to_arrays(path_to_race_file)
+    assert len(race_arrays["publish_time"]) == 1
+
+
+def test_race_file_to_arrays(race_change: dict[str, Any], path_to_race_file: Path):
+    publish_time = race_change["rpc"]["ft"]
+    with smart_open.open(path_to_race_file, "a") as f:
+        f.write(
+            json.dumps(
+                {
+                    "op": "rcm",
+                    "clk": 1,
+                    "pt": publish_time + 100,
+                    "rc": [
+                        {
+                            "id": race_change["id"],
+                            "mid": race_change["mid"],
+                            "rpc": {
+                                "ft": publish_time + 100,
+                                "g": "1f",
+                                "prg": 1000,
+                                "J": [{"L": 500}, {"L": 1050}],
+                            },
+                            "rrc": [
+                                {
+                                    "ft": publish_time + 150,
+                                    "id": 50749188,
+                                    "prg": 1001.5,
+                                    "spd": 15.2,
+                                    "sfq": 2.1,
+                                },
+                                {"ft": publish_time + 150, "id": 123, "prg": 1000},
+                            ],
+                        }
+                    ],
+                }
+            )
+        )
+        f.write("\n")
+
+    runner_arrays, race_arrays = race_file_to_arrays(path_to_race_file)
+
+    assert set(runner_arrays) == {50749188, 123}
+    arrays = runner_arrays[50749188]
+    assert arrays["publish_time"].tolist() == [publish_time, publish_time + 100]
+    assert arrays["feed_time"].tolist() == [
+        race_change["rrc"][0]["ft"],
+        publish_time + 150,
+    ]
+    assert arrays["progress"].tolist() == [1106.4, 1001.5]
+    np.testing.assert_array_equal(arrays["speed"], [np.nan, 15.2])
+    np.testing.assert_array_equal(arrays["stride_frequency"], [np.nan, 2.1])
+    np.testing.assert_array_equal(arrays["lat"], [40.3955184, np.nan])
+    assert runner_arrays[123]["progress"].tolist() == [1000]
+
+    assert race_arrays["publish_time"].tolist() == [publish_time, publish_time + 100]
+    assert race_arrays["progress"].tolist() == [1106.4, 1000]
+    assert race_arrays["gate"].tolist() == ["", "1f"]
+    np.testing.assert_array_equal(race_arrays["jumps_remaining"], [np.nan, 1])
+    np.testing.assert_array_equal(race_arrays["sectional_time"], [0, np.nan])
+
+    # A second race in the same file
+    with smart_open.open(path_to_race_file, "a") as f:
+        f.write(
+            json.dumps(
+                {
+                    "op": "rcm",
+                    "clk": 2,
+                    "pt": publish_time + 200,
+                    "rc": [
+                        {
+                            "id": "other",
+                            "mid": "1.999",
+                            "rpc": {"ft": publish_time + 200, "prg": 2000},
+                            "rrc": [{"ft": publish_time + 200, "id": 789, "prg": 2000}],
+                        }
+                    ],
+                }
+            )
+        )
+        f.write("\n")
+
+    with pytest.raises(ValueError):
+        race_file_to_arrays(path_to_race_file)
+
+    runner_arrays, race_arrays = race_file_to_arrays(
+        path_to_race_file, market_id=race_change["mid"]
+    )
+    assert set(runner_arrays) == {50749188, 123}
+    assert race_arrays["progress"].tolist() == [1106.4, 1000]
+
+    runner_arrays, race_arrays = race_file_to_arrays(
+        path_to_race_file, market_id="1.999"
+    )
+    assert set(runner_arrays) == {789}
+    assert race_arrays["progress"].tolist() == [2000]
+
+
 def test_remove_bet_from_runner_book(market_book: dict[str, Any]):
     runner_book = market_book["runners"][0]
     with pytest.raises(ValueError):
@@ -848,6 +1366,88 @@ def test_remove_bet_from_runner_book(market_book: dict[str, Any]):
     assert new_runner_book.ex.available_to_back[0]["size"] == 0.25
 
 
+@pytest.mark.parametrize("use_runner_book_objects", [False, True])
+def test_remove_bet_from_runner_book_copy_modes(
+    market_book: dict[str, Any], use_runner_book_objects: bool
+):
+    def get_available_to_back(runner_book):
+        if use_runner_book_objects:
+            return [(ps.price, ps.size) for ps in runner_book.ex.available_to_back]
+        return [
+            (ps["price"], ps["size"]) for ps in runner_book["ex"]["availableToBack"]
+        ]
+
+    def get_ex(runner_book):
+        return runner_book.ex if use_runner_book_objects else runner_book["ex"]
+
+    def make_runner_book():
+        runner_book = deepcopy(market_book["runners"][0])
+        runner_book["ex"]["availableToLay"].append({"price": 2.0, "size": 3})
+        return RunnerBook(**runner_book) if use_runner_book_objects else runner_book
+
+    runner_book = make_runner_book()
+    new_runner_book = remove_bet_from_runner_book(
+        runner_book,
+        price=1.98,
+        size=0.5,
+        available_side=Side.BACK,
+        copy_mode=CopyModeEnum.STRUCTURAL_SHARING,
+    )
+    assert new_runner_book is not runner_book
+    assert get_available_to_back(new_runner_book) == [(1.98, 0.5)]
+    assert get_available_to_back(runner_book) == [(1.98, 1)]
+    if use_runner_book_objects:
+        assert new_runner_book.ex.available_to_lay is runner_book.ex.available_to_lay
+    else:
+        assert (
+            new_runner_book["ex"]["availableToLay"]
+            is runner_book["ex"]["availableToLay"]
+        )
+
+    runner_book = make_runner_book()
+    original_ex = get_ex(runner_book)
+    new_runner_book = remove_bet_from_runner_book(
+        runner_book,
+        price=1.98,
+        size=0.5,
+        available_side=Side.BACK,
+        copy_mode=CopyModeEnum.IN_PLACE,
+    )
+    assert new_runner_book is runner_book
+    assert get_ex(runner_book) is original_ex
+    assert get_available_to_back(runner_book) == [(1.98, 0.5)]
+
+    runner_book = make_runner_book()
+    new_runner_book = remove_bets_from_runner_book(
+        runner_book,
+        [(1.98, 0.25, Side.BACK), (1.98, 0.75, Side.BACK), (2.0, 1, Side.LAY)],
+    )
+    assert get_available_to_back(new_runner_book) == []
+    if use_runner_book_objects:
+        assert new_runner_book.ex.available_to_lay[0].size == 2
+    else:
+        assert new_runner_book["ex"]["availableToLay"][0]["size"] == 2
+    assert get_available_to_back(runner_book) == [(1.98, 1)]
+
+    with pytest.raises(ValueError):
+        remove_bets_from_runner_book(
+            runner_book,
+            [(2.0, 1, Side.LAY), (1.98, 0.75, Side.BACK), (1.98, 0.75, Side.BACK)],
+            copy_mode=CopyModeEnum.IN_PLACE,
+        )
+    assert get_available_to_back(runner_book) == [(1.98, 1)]
+
+    # 0.1 + 2.7 + 0.2 is slightly more than 3 in floating point arithmetic
+    new_runner_book = remove_bets_from_runner_book(
+        runner_book,
+        [(2.0, 0.1, Side.LAY), (2.0, 2.7, Side.LAY), (2.0, 0.2, Side.LAY)],
+    )
+    if use_runner_book_objects:
+        assert new_runner_book.ex.available_to_lay == []
+    else:
+        assert new_runner_book["ex"]["availableToLay"] == []
+
+
 def test_random_from_market_id():
     with pytest.raises(ValueError):
         random_from_market_id(-1)
@@ -875,6 +1475,41 @@ def test_get_final_market_definition_from_prices_file(
     assert final_market_definition is None
 
 
+@pytest.mark.parametrize("suffix", [".json", ".json.gz"])
+def test_get_final_market_definition_from_prices_file_reads_tail(
+    market_book: dict[str, Any],
+    market_definition: dict[str, Any],
+    tmp_path: Path,
+    suffix: str,
+):
+    path_to_prices_file = tmp_path / f"1.123{suffix}"
+    for i, status in enumerate(["OPEN", "SUSPENDED", "CLOSED"]):
+        write_to_prices_file(
+            publish_time=market_book["publishTime"] + i,
+            market_definition=dict(market_definition, status=status),
+            rc=[{"id": 123, "atb": [[1.98, 1]]}],
+            path_to_prices_file=path_to_prices_file,
+            mode="w" if i == 0 else "a",
+        )
+    with smart_open.open(path_to_prices_file, "a") as f:
+        f.write(json.dumps({"op": "mcm", "clk": 0, "pt": 0, "mc": [{"id": "1.123"}]}))
+
+    final_market_definition = get_final_market_definition_from_prices_file(
+        path_to_prices_file
+    )
+    assert final_market_definition["status"] == "CLOSED"
+
+
+def test_create_reverse_line_generator():
+    lines = [b"a" * 10, b"", b"b" * 100, b"c", b"d" * 7]
+    f = io.BytesIO(b"\r\n".join(lines))
+
+    for block_size in [1, 3, 8, 1 << 16]:
+        assert list(_create_reverse_line_generator(f, block_size)) == [
+            line for line in reversed(lines) if line
+        ]
+
+
 def test_get_pre_event_volume_traded_from_prices_file(
     path_to_prices_file_with_inplay_transition: Path,
     path_to_prices_file_with_turn_in_play_disabled: Path,
@@ -933,20 +1568,141 @@ def test_get_race_change_from_race_file(
     )
 
 
-def test_get_market_books_from_prices_file(
-    market_definition: dict[str, Any],
-    market_book: dict[str, Any],
-    market_catalogue: dict[str, Any],
-    tmp_path: Path,
-):
-    del market_definition["runners"][0]["name"]
-    del market_definition["runners"][1]["name"]
-    path_to_prices_file = tmp_path / f"1.123.json.gz"
-    with smart_open.open(path_to_prices_file, "w") as f:
-        f.write(
-            json.dumps(
-                {
-                    "op": "mcm",
+@pytest.mark.parametrize("suffix", [".jsonl", ".jsonl.gz"])
+def test_race_file_index(race_change: dict[str, Any], tmp_path: Path, suffix: str):
+    path_to_race_file = tmp_path / f"31945198.2354{suffix}"
+    publish_time = race_change["rpc"]["ft"]
+    gate_names = ["", "4f", "3f", "2f", "1f"]
+    with smart_open.open(path_to_race_file, "w") as f:
+        for i in range(20):
+            rc = deepcopy(race_change)
+            rc["rpc"]["g"] = gate_names[i // 4]
+            rc["rrc"][0]["prg"] -= i
+            if i % 3 == 0:
+                rc["rrc"].append({"ft": publish_time + 100 * i, "id": i, "prg": 1000})
+            if i == 10:
+                rc["mid"] = "1.207120594"
+            # Publish times are not necessarily unique
+            f.write(
+                json.dumps(
+                    {"op": "rcm", "pt": publish_time + 100 * (i // 2), "rc": [rc]}
+                )
+            )
+            f.write("\n")
+            if i == 5:
+                f.write(json.dumps({"op": "rcm", "pt": publish_time + 250}))
+                f.write("\n\n")
+
+    publish_times = list(range(publish_time - 100, publish_time + 1100, 50))
+    for checkpoint_interval in [1, 3, 1000]:
+        race_file_index = RaceFileIndex(
+            path_to_race_file, checkpoint_interval=checkpoint_interval
+        )
+        for gate_name in gate_names + ["5f"]:
+            assert get_race_change_from_race_file(
+                path_to_race_file, gate_name=gate_name, race_file_index=race_file_index
+            ) == get_race_change_from_race_file(path_to_race_file, gate_name=gate_name)
+        expected = {
+            pt: get_race_change_from_race_file(path_to_race_file, publish_time=pt)
+            for pt in publish_times
+        }
+        assert race_file_index.get_race_changes_by_publish_time(publish_times) == (
+            expected
+        )
+        for pt in publish_times[::5]:
+            assert (
+                get_race_change_from_race_file(
+                    path_to_race_file, publish_time=pt, race_file_index=race_file_index
+                )
+                == expected[pt]
+            )
+
+
+def test_race_file_to_rankings(race_change: dict[str, Any], tmp_path: Path):
+    path_to_race_file = tmp_path / "31945198.2354.jsonl"
+    publish_time = race_change["rpc"]["ft"]
+    with open(path_to_race_file, "w") as f:
+        for i, rrc in enumerate(
+            [
+                [(789, 1100)],
+                [(456, 1105), (123, 1099)],
+                [(789, 1090), (123, 1090), (456, 1095)],
+            ]
+        ):
+            rc = {
+                "id": race_change["id"],
+                "mid": race_change["mid"],
+                "rrc": [
+                    {"ft": publish_time + i, "id": id_, "prg": prg} for id_, prg in rrc
+                ],
+            }
+            f.write(json.dumps({"op": "rcm", "pt": publish_time + i, "rc": [rc]}))
+            f.write("\n")
+
+    rankings = race_file_to_rankings(path_to_race_file)
+    assert rankings["publish_time"].tolist() == [publish_time + i for i in range(3)]
+    assert rankings["selection_id"].tolist() == [123, 456, 789]
+    np.testing.assert_array_equal(
+        rankings["progress"],
+        [[np.nan, np.nan, 1100], [1099, 1105, 1100], [1090, 1095, 1090]],
+    )
+    np.testing.assert_array_equal(
+        rankings["distance_behind_leader"],
+        [[np.nan, np.nan, 0], [0, 6, 1], [0, 5, 0]],
+    )
+    np.testing.assert_array_equal(
+        rankings["rank"], [[np.nan, np.nan, 1], [1, 3, 2], [1, 3, 1]]
+    )
+    for is_leader, rc in zip(rankings["is_leader"], read_race_file(path_to_race_file)):
+        assert set(rankings["selection_id"][is_leader]) == get_race_leaders(rc)
+
+    # A runner change without progress and a second race in the same file
+    with open(path_to_race_file, "a") as f:
+        rc = {
+            "id": race_change["id"],
+            "mid": race_change["mid"],
+            "rrc": [{"ft": publish_time + 3, "id": 456}],
+        }
+        other_rc = {
+            "id": "other",
+            "mid": "1.999",
+            "rrc": [{"ft": publish_time + 3, "id": 999, "prg": 500}],
+        }
+        f.write(json.dumps({"op": "rcm", "pt": publish_time + 3, "rc": [rc, other_rc]}))
+        f.write("\n")
+
+    with pytest.raises(ValueError):
+        race_file_to_rankings(path_to_race_file)
+
+    rankings = race_file_to_rankings(path_to_race_file, market_id=race_change["mid"])
+    assert rankings["selection_id"].tolist() == [123, 456, 789]
+    np.testing.assert_array_equal(rankings["progress"][-1], [1090, np.nan, 1090])
+    np.testing.assert_array_equal(rankings["rank"][-1], [1, np.nan, 1])
+
+    rankings = race_file_to_rankings(path_to_race_file, market_id="1.999")
+    assert rankings["selection_id"].tolist() == [999]
+    assert rankings["publish_time"].tolist() == [publish_time + 3]
+
+    with open(path_to_race_file, "w"):
+        pass
+    rankings = race_file_to_rankings(path_to_race_file)
+    assert rankings["rank"].shape == (0, 0)
+
+
+def test_get_market_books_from_prices_file(
+    market_definition: dict[str, Any],
+    market_book: dict[str, Any],
+    market_catalogue: dict[str, Any],
+    tmp_path: Path,
+):
+    del market_definition["runners"][0]["name"]
+    del market_definition["runners"][1]["name"]
+    path_to_prices_file = tmp_path / f"1.123.json.gz"
+    with smart_open.open(path_to_prices_file, "w") as f:
+        f.write(
+            json.dumps(
+                {
+                    "op": "mcm",
                     "clk": 0,
                     "pt": market_book["publishTime"],
                     "mc": [
@@ -978,6 +1734,48 @@ def test_get_market_books_from_prices_file(
     )
 
 
+def test_get_market_books_from_prices_files(
+    market_book: dict[str, Any], path_to_prices_file_with_trades: Path
+):
+    publish_time = market_book["publishTime"]
+    paths_to_prices_files = {"1.123": path_to_prices_file_with_trades}
+    queries = [
+        ("1.123", publish_time + 75),
+        ("1.123", publish_time - 1),
+        ("1.123", publish_time + 1000),
+        ("1.123", publish_time + 50),
+    ]
+
+    market_books = get_market_books_from_prices_files(paths_to_prices_files, queries)
+    assert market_books[queries[0]]["publishTime"] == publish_time + 50
+    assert market_books[queries[1]] is None
+    assert market_books[queries[2]]["publishTime"] == publish_time + 150
+    assert market_books[queries[3]]["publishTime"] == publish_time + 50
+    assert get_market_books_from_prices_file(
+        path_to_prices_file_with_trades, [pt for _, pt in queries]
+    ) == {pt: market_books[(market_id, pt)] for market_id, pt in queries}
+
+    calls = []
+
+    def total_matched(mb: MarketBook) -> float:
+        calls.append(mb.publish_time_epoch)
+        return calculate_total_matched(mb)
+
+    columns = get_market_books_from_prices_files(
+        paths_to_prices_files,
+        queries + [("1.123", publish_time + 99)],
+        features={"total_matched": total_matched},
+        lightweight=False,
+    )
+    assert columns["market_id"] == ["1.123"] * 5
+    assert columns["publish_time"] == [pt for _, pt in queries] + [publish_time + 99]
+    assert columns["total_matched"] == [4, None, 0, 4, 4]
+    assert calls == [publish_time + 50, publish_time + 150]
+
+    with pytest.raises(ValueError):
+        get_market_books_from_prices_files(paths_to_prices_files, [("1.456", 0)])
+
+
 def test_get_minimum_book_percentage_market_books_from_prices_file(
     market_definition: dict[str, Any],
     market_book: dict[str, Any],
@@ -1058,6 +1856,444 @@ def test_get_minimum_book_percentage_market_books_from_prices_file(
     )
 
 
+@pytest.mark.parametrize("selector", list(WindowSelectorEnum))
+def test_get_windowed_market_books_from_prices_file(
+    market_book: dict[str, Any],
+    market_definition: dict[str, Any],
+    tmp_path: Path,
+    selector: WindowSelectorEnum,
+):
+    publish_time = market_book["publishTime"]
+    path_to_prices_file = tmp_path / "1.123.json"
+    prices = [1.98, 2.0, 1.99, 2.02, 1.98, 2.1, 1.95, 2.0]
+    for i, price in enumerate(prices):
+        write_to_prices_file(
+            publish_time=publish_time + 100 * i,
+            market_definition=market_definition,
+            rc=[{"id": 123, "atb": [[price, 1]]}],
+            path_to_prices_file=path_to_prices_file,
+            mode="w" if i == 0 else "a",
+        )
+    market_books = read_prices_file(path_to_prices_file)
+
+    def metric(mb: dict[str, Any]) -> Optional[float]:
+        return get_best_price(mb["runners"][0], Side.BACK)
+
+    windows = [
+        (publish_time + start, publish_time + start + length)
+        for start in range(-150, 900, 50)
+        for length in [1, 50, 100, 250, 1000]
+    ]
+    actual = get_windowed_market_books_from_prices_file(
+        path_to_prices_file, windows, metric=metric, selector=selector
+    )
+
+    for start, end in windows:
+        candidates = [
+            mb
+            for i, mb in enumerate(market_books)
+            if mb["publishTime"] <= end
+            and (
+                i == len(market_books) - 1 or market_books[i + 1]["publishTime"] > start
+            )
+        ]
+        if not candidates:
+            expected = None
+        elif selector == WindowSelectorEnum.MIN:
+            expected = min(candidates, key=metric)
+        elif selector == WindowSelectorEnum.MAX:
+            expected = max(candidates, key=metric)
+        elif selector == WindowSelectorEnum.FIRST:
+            expected = candidates[0]
+        else:
+            expected = candidates[-1]
+        assert actual[(start, end)] == expected, (start, end)
+
+    with pytest.raises(ValueError):
+        get_windowed_market_books_from_prices_file(
+            path_to_prices_file, windows, metric="foo"
+        )
+
+
+def test_create_trade_generator_from_prices_file(
+    market_book: dict[str, Any], path_to_prices_file_with_trades: Path
+):
+    publish_time = market_book["publishTime"]
+    expected_trades = [
+        {
+            "market_id": "1.123",
+            "selection_id": 123,
+            "handicap": 0,
+            "price": 2.0,
+            "size": 4,
+            "publish_time": publish_time + 50,
+            "aggressor_side": Side.LAY,
+        },
+        {
+            "market_id": "1.123",
+            "selection_id": 123,
+            "handicap": 0,
+            "price": 1.98,
+            "size": 3,
+            "publish_time": publish_time + 100,
+            "aggressor_side": Side.BACK,
+        },
+        {
+            "market_id": "1.123",
+            "selection_id": 123,
+            "handicap": 0,
+            "price": 2.0,
+            "size": 1,
+            "publish_time": publish_time + 100,
+            "aggressor_side": Side.LAY,
+        },
+        {
+            "market_id": "1.123",
+            "selection_id": 456,
+            "handicap": 0,
+            "price": 1.99,
+            "size": 2,
+            "publish_time": publish_time + 100,
+            "aggressor_side": None,
+        },
+    ]
+    assert (
+        list(create_trade_generator_from_prices_file(path_to_prices_file_with_trades))
+        == expected_trades
+    )
+
+    # Market books without the raw stream update are compared runner by runner
+    trade_tape = TradeTape()
+    trades = []
+    for mb in read_prices_file(path_to_prices_file_with_trades):
+        del mb["streaming_update"]
+        trades.extend(trade_tape.process_market_book(mb))
+    assert trades == expected_trades
+
+    trade_tape = TradeTape()
+    trades = []
+    for mb in read_prices_file(path_to_prices_file_with_trades, lightweight=False):
+        trades.extend(trade_tape.process_market_book(mb))
+    assert trades == expected_trades
+
+
+@pytest.mark.parametrize("lightweight", [True, False])
+def test_trade_tape_with_reimage(
+    path_to_prices_file_with_reimage: Path, lightweight: bool
+):
+    trade_tape = TradeTape()
+    market_books = read_prices_file(
+        path_to_prices_file_with_reimage, lightweight=lightweight
+    )
+    assert len(trade_tape.process_market_book(market_books[0])) == 1
+    assert trade_tape.process_market_book(market_books[1]) == []
+
+
+def test_trade_tape_process_runner_change():
+    trade_tape = TradeTape()
+    assert trade_tape.process_runner_change("1.123", {"id": 123}, 0) == []
+    assert trade_tape.process_runner_change(
+        "1.123", {"id": 123, "trd": [[2.0, 1]]}, 0
+    ) == [
+        {
+            "market_id": "1.123",
+            "selection_id": 123,
+            "handicap": 0,
+            "price": 2.0,
+            "size": 1,
+            "publish_time": 0,
+            "aggressor_side": None,
+        }
+    ]
+
+
+@pytest.mark.parametrize("lightweight", [True, False])
+def test_traded_volume_statistics(
+    market_book: dict[str, Any],
+    path_to_prices_file_with_trades: Path,
+    lightweight: bool,
+):
+    publish_time = market_book["publishTime"]
+    market_books = read_prices_file(
+        path_to_prices_file_with_trades, lightweight=lightweight
+    )
+    traded_volume_statistics = TradedVolumeStatistics(rolling_windows=[50, 1000])
+
+    with pytest.raises(ValueError):
+        traded_volume_statistics.get_rolling_traded_volume("1.123", 123, 10)
+    assert traded_volume_statistics.get_vwap("1.123", 123) is None
+    assert traded_volume_statistics.get_volume_profile("1.123", 123) == {}
+    assert traded_volume_statistics.get_rolling_traded_volume("1.123", 123, 50) == 0
+
+    for mb in market_books[:3]:
+        traded_volume_statistics.process_market_book(mb)
+        assert traded_volume_statistics.get_total_matched(
+            "1.123"
+        ) == calculate_total_matched(mb)
+
+    assert traded_volume_statistics.get_runner_total_matched("1.123", 123) == 8
+    assert traded_volume_statistics.get_vwap("1.123", 123) == pytest.approx(
+        (1.98 * 3 + 2.0 * 5) / 8
+    )
+    assert traded_volume_statistics.get_vwap("1.123", 456) == pytest.approx(1.99)
+    assert traded_volume_statistics.get_volume_profile("1.123", 123) == {
+        2.0: 5,
+        1.98: 3,
+    }
+    assert traded_volume_statistics.get_rolling_traded_volume("1.123", 123, 50) == 4
+    assert traded_volume_statistics.get_rolling_traded_volume("1.123", 123, 1000) == 8
+
+    traded_volume_statistics.process_market_book(market_books[3])
+    assert traded_volume_statistics.get_total_matched("1.123") == 0
+    assert traded_volume_statistics.get_vwap("1.123", 123) is None
+    assert traded_volume_statistics.get_rolling_traded_volume("1.123", 123, 50) == 0
+    assert traded_volume_statistics.get_rolling_traded_volume("1.123", 123, 1000) == 8
+
+    traded_volume_statistics = TradedVolumeStatistics()
+    traded_volume_statistics.process_runner_change(
+        "1.123", {"id": 123, "trd": [[2.0, 1], [3.0, 1]]}, publish_time
+    )
+    assert traded_volume_statistics.get_vwap("1.123", 123) == pytest.approx(2.5)
+    volume_profile = traded_volume_statistics.get_volume_profile(
+        "1.123", 123, should_copy=False
+    )
+    traded_volume_statistics.process_runner_change(
+        "1.123", {"id": 123, "trd": [[3.0, 0]]}, publish_time
+    )
+    assert volume_profile == {2.0: 1}
+    assert traded_volume_statistics.get_total_matched("1.123") == 1
+
+
+@pytest.mark.parametrize("lightweight", [True, False])
+def test_traded_volume_statistics_with_reimage(
+    path_to_prices_file_with_reimage: Path, lightweight: bool
+):
+    traded_volume_statistics = TradedVolumeStatistics(rolling_windows=[1000])
+    for mb in read_prices_file(
+        path_to_prices_file_with_reimage, lightweight=lightweight
+    ):
+        traded_volume_statistics.process_market_book(mb)
+        assert traded_volume_statistics.get_total_matched(
+            "1.123"
+        ) == calculate_total_matched(mb)
+
+    assert traded_volume_statistics.get_total_matched("1.123") == 5
+    assert traded_volume_statistics.get_vwap("1.123", 123) == pytest.approx(3.0)
+    assert traded_volume_statistics.get_volume_profile("1.123", 123) == {3.0: 5}
+    # Only the volume traded before the image has been observed as it happened
+    assert traded_volume_statistics.get_rolling_traded_volume("1.123", 123, 1000) == 10
+
+
+def test_rolling_window():
+    rolling_window = RollingWindow(100)
+    assert rolling_window.count == 0
+    assert rolling_window.mean is None
+    assert rolling_window.std is None
+    assert rolling_window.min is None
+
+    for publish_time, value in [(0, 3), (30, 1), (50, 2), (120, 5)]:
+        rolling_window.append(publish_time, value)
+
+    # The observation at 0 has been evicted
+    assert rolling_window.count == 3
+    assert rolling_window.sum == 8
+    assert rolling_window.mean == pytest.approx(8 / 3)
+    assert rolling_window.variance == pytest.approx(13 / 3)
+    assert rolling_window.min == 1
+    assert rolling_window.max == 5
+
+    rolling_window.evict(110)
+    assert rolling_window.count == 3
+    rolling_window.evict(140)
+    assert rolling_window.count == 2
+    assert rolling_window.min == 2
+    rolling_window.evict(220)
+    assert rolling_window.count == 0
+    assert rolling_window.max is None
+    assert rolling_window.sum == 0
+
+
+@pytest.mark.parametrize("lightweight", [False, True])
+def test_rolling_window_statistics(market_book: dict[str, Any], lightweight: bool):
+    publish_time = market_book["publishTime"]
+    rolling_window_statistics = RollingWindowStatistics(windows=[50, 1000])
+
+    with pytest.raises(ValueError):
+        rolling_window_statistics.get_window("1.123", 123, "mid_price", 10)
+    assert (
+        rolling_window_statistics.get_window("1.123", 123, "mid_price", 50).count == 0
+    )
+
+    for i, (atb, atl) in enumerate([(1.98, 2.02), (2.0, 2.04), (2.0, 2.04)]):
+        mb = deepcopy(market_book)
+        mb["publishTime"] = publish_time + 50 * i
+        mb["runners"][0]["ex"]["availableToBack"] = [{"price": atb, "size": 1}]
+        mb["runners"][0]["ex"]["availableToLay"] = [{"price": atl, "size": 3}]
+        if lightweight:
+            mb = MarketBook(**mb)
+        rolling_window_statistics.process_market_book(mb)
+
+    rolling_window = rolling_window_statistics.get_window(
+        "1.123", 123, "mid_price", 1000
+    )
+    assert rolling_window.count == 3
+    assert rolling_window.min == pytest.approx(2.0)
+    assert rolling_window.max == pytest.approx(2.02)
+    assert rolling_window_statistics.get_window(
+        "1.123", 123, "spread", 1000
+    ).mean == pytest.approx(7 / 3)
+    assert rolling_window_statistics.get_window(
+        "1.123", 123, "weight_of_money", 50
+    ).mean == pytest.approx(-0.5)
+    assert rolling_window_statistics.get_window("1.123", 123, "updates", 50).count == 1
+    log_returns = rolling_window_statistics.get_window(
+        "1.123", 123, "mid_price_log_return", 1000
+    )
+    assert log_returns.count == 2
+    assert log_returns.sum == pytest.approx(log(2.02 / 2.0))
+
+    # Unchanged runners are not observed again but are evicted as the market moves on
+    rolling_window_statistics = RollingWindowStatistics(windows=[50])
+    rolling_window_statistics.process_market_book(market_book)
+    mb = dict(market_book, publishTime=publish_time + 100)
+    rolling_window_statistics.process_market_book(mb)
+    assert rolling_window_statistics.get_window("1.123", 123, "updates", 50).count == 0
+
+
+def test_simulated_matching_engine():
+    def make_market_book(
+        publish_time, atb, atl, trd, status="OPEN", bet_delay=0
+    ) -> dict[str, Any]:
+        return {
+            "marketId": "1.123",
+            "publishTime": publish_time,
+            "status": status,
+            "betDelay": bet_delay,
+            "runners": [
+                {
+                    "selectionId": 123,
+                    "handicap": 0,
+                    "status": "ACTIVE",
+                    "ex": {
+                        "availableToBack": [{"price": p, "size": s} for p, s in atb],
+                        "availableToLay": [{"price": p, "size": s} for p, s in atl],
+                        "tradedVolume": [{"price": p, "size": s} for p, s in trd],
+                    },
+                }
+            ],
+        }
+
+    engine = SimulatedMatchingEngine()
+    with pytest.raises(ValueError):
+        engine.place_order("1.123", 123, Side.BACK, 2.0, 5)
+
+    assert (
+        engine.process_market_book(make_market_book(0, [(1.98, 10)], [(2.0, 10)], []))
+        == []
+    )
+    back_order = engine.place_order("1.123", 123, Side.BACK, 2.0, 5)
+    assert back_order.status == "EXECUTABLE"
+    assert back_order.queue_ahead == 10
+    lay_order = engine.place_order("1.123", 123, Side.LAY, 2.0, 4)
+    assert lay_order.status == "EXECUTION_COMPLETE"
+    assert lay_order.size_matched == 4
+    assert lay_order.average_price_matched == 2.0
+    assert list(engine.iterate_orders()) == [back_order]
+
+    # The fill at placement is returned along with those from the next market book. 2 is traded and 4 is cancelled
+    # from the remaining 8 ahead of the order
+    assert engine.process_market_book(
+        make_market_book(1, [(1.98, 10)], [(2.0, 4)], [(2.0, 2)])
+    ) == [{"order": lay_order, "price": 2.0, "size": 4, "publish_time": 0}]
+    assert back_order.queue_ahead == 4
+
+    fills = engine.process_market_book(
+        make_market_book(2, [(1.98, 10)], [], [(2.0, 9)])
+    )
+    assert fills == [{"order": back_order, "price": 2.0, "size": 3, "publish_time": 2}]
+    assert back_order.size_matched == 3
+    assert back_order.size_remaining == 2
+
+    engine.cancel_order(back_order, 1)
+    assert back_order.status == "EXECUTABLE"
+    engine.cancel_order(back_order)
+    assert back_order.status == "EXECUTION_COMPLETE"
+    assert back_order.size_cancelled == 2
+    assert list(engine.iterate_orders()) == []
+
+    # Orders subject to the bet delay
+    engine.process_market_book(
+        make_market_book(3, [(1.98, 10)], [(2.0, 10)], [(2.0, 9)], bet_delay=1)
+    )
+    order = engine.place_order("1.123", 123, Side.BACK, 1.98, 2)
+    assert order.status == "PENDING"
+    engine.process_market_book(
+        make_market_book(500, [(1.98, 10)], [(2.0, 10)], [(2.0, 9)], bet_delay=1)
+    )
+    assert order.status == "PENDING"
+    fills = engine.process_market_book(
+        make_market_book(1003, [(1.98, 10)], [(2.0, 10)], [(2.0, 9)], bet_delay=1)
+    )
+    assert fills == [{"order": order, "price": 1.98, "size": 2, "publish_time": 1003}]
+
+    order = engine.place_order("1.123", 123, Side.BACK, 1.98, 2)
+    engine.process_market_book(
+        make_market_book(
+            2003, [(1.98, 10)], [(2.0, 10)], [(2.0, 9)], "SUSPENDED", bet_delay=1
+        )
+    )
+    assert order.status == "EXECUTION_COMPLETE"
+    assert order.size_lapsed == 2
+
+    engine.process_market_book(
+        make_market_book(2500, [(1.98, 10)], [(2.0, 10)], [(2.0, 9)], bet_delay=1)
+    )
+
+    # Volume traded at a better price than the order's fills it in full however much is queued ahead of it
+    engine.process_market_book(
+        make_market_book(2600, [(1.98, 10)], [(2.0, 10)], [(2.0, 9)])
+    )
+    order = engine.place_order("1.123", 123, Side.BACK, 2.0, 5)
+    assert order.queue_ahead == 10
+    fills = engine.process_market_book(
+        make_market_book(2700, [(2.02, 10)], [(2.04, 10)], [(2.0, 9), (2.02, 1)])
+    )
+    assert fills == [{"order": order, "price": 2.0, "size": 5, "publish_time": 2700}]
+    assert order.status == "EXECUTION_COMPLETE"
+    engine.process_market_book(
+        make_market_book(2800, [(1.98, 10)], [(2.0, 10)], [(2.0, 9)], bet_delay=1)
+    )
+    order = engine.place_order("1.123", 123, Side.LAY, 1.5, 2, publish_time=0)
+    assert order.status == "EXECUTABLE"
+    engine.process_market_book(
+        make_market_book(3003, [], [], [], "CLOSED", bet_delay=1)
+    )
+    assert order.status == "EXECUTION_COMPLETE"
+    assert order.size_lapsed == 2
+
+
+def test_simulated_matching_engine_with_prices_file(
+    market_book: dict[str, Any], path_to_prices_file_with_trades: Path
+):
+    engine = SimulatedMatchingEngine()
+    fills = []
+    g = create_market_book_generator_from_prices_file(path_to_prices_file_with_trades)
+    engine.process_market_book(next(g))
+    order = engine.place_order(
+        "1.123",
+        123,
+        Side.BACK,
+        2.0,
+        2,
+        publish_time=market_book["publishTime"] - 5000,
+    )
+    assert order.queue_ahead == 10
+    for mb in g:
+        fills.extend(engine.process_market_book(mb))
+    assert fills == []
+    assert order.queue_ahead == 5
+
+
 def test_calculate_order_book_imbalance(market_book: dict[str, Any]):
     runner_book = market_book["runners"][0]
     runner_book["ex"]["availableToLay"].append({"price": 1.99, "size": 2})
@@ -1149,6 +2385,21 @@ def test_get_seconds_to_market_time(market_book: dict[str, Any]):
         get_seconds_to_market_time(MarketDefinition(**market_book["marketDefinition"]))
 
 
+def test_calculate_seconds_to_market_time(market_book: dict[str, Any]):
+    publish_time = market_book["publishTime"]
+    publish_times = [publish_time - 7999200000, publish_time, publish_time + 250]
+    expected = [7999200.0, 0.0, -0.25]
+    assert calculate_seconds_to_market_time(market_book, publish_times).tolist() == (
+        expected
+    )
+    assert calculate_seconds_to_market_time(
+        MarketDefinition(**market_book["marketDefinition"]), publish_times
+    ).tolist() == [
+        get_seconds_to_market_time(market_book, current_time)
+        for current_time in publish_times
+    ]
+
+
 def test_get_win_market_id_from_race_file(
     race_change: dict[str, Any], path_to_race_file: Path
 ):
@@ -1181,6 +2432,234 @@ def test_create_combined_market_book_and_race_change_generator(
     assert not is_market_book(_object)
 
 
+def test_create_combined_generator_from_files(
+    race_change: dict[str, Any],
+    market_definition: dict[str, Any],
+    path_to_race_file: Path,
+    tmp_path: Path,
+):
+    publish_time = race_change["rpc"]["ft"]
+    path_to_first_prices_file = tmp_path / "1.1.json"
+    path_to_second_prices_file = tmp_path / "1.2.json"
+    for path_to_prices_file, deltas in (
+        (path_to_first_prices_file, (-100, 0, 200)),
+        (path_to_second_prices_file, (-50, 100)),
+    ):
+        for i, delta in enumerate(deltas):
+            write_to_prices_file(
+                publish_time=publish_time + delta,
+                market_definition=market_definition,
+                rc=[{"id": 123, "atb": [[1.98, i + 1]]}],
+                path_to_prices_file=path_to_prices_file,
+                mode="w" if i == 0 else "a",
+            )
+
+    triples = list(
+        create_combined_generator_from_files(
+            paths_to_prices_files=[
+                path_to_first_prices_file,
+                path_to_second_prices_file,
+            ],
+            paths_to_race_files=[path_to_race_file],
+        )
+    )
+
+    assert [
+        (source, _is_market_book, get_publish_time_from_object(_object))
+        for source, _is_market_book, _object in triples
+    ] == [
+        (path_to_first_prices_file, True, publish_time - 100),
+        (path_to_second_prices_file, True, publish_time - 50),
+        (path_to_first_prices_file, True, publish_time),
+        (path_to_race_file, False, publish_time),
+        (path_to_second_prices_file, True, publish_time + 100),
+        (path_to_first_prices_file, True, publish_time + 200),
+    ]
+
+    assert list(create_combined_generator_from_files()) == []
+
+
+def test_create_as_of_market_book_and_race_change_generator(
+    race_change: dict[str, Any],
+    market_definition: dict[str, Any],
+    path_to_race_file: Path,
+    tmp_path: Path,
+):
+    publish_time = race_change["rpc"]["ft"]
+    path_to_prices_file = tmp_path / "1.207120593.json"
+    for i, delta in enumerate((-100, 0, 250)):
+        write_to_prices_file(
+            publish_time=publish_time + delta,
+            market_definition=market_definition,
+            rc=[{"id": 123, "atb": [[1.98, i + 1]]}],
+            path_to_prices_file=path_to_prices_file,
+            mode="w" if i == 0 else "a",
+        )
+
+    triples = list(
+        create_as_of_market_book_and_race_change_generator(
+            path_to_prices_file=path_to_prices_file,
+            path_to_race_file=path_to_race_file,
+        )
+    )
+
+    assert [mb["publishTime"] for mb, _, _ in triples] == [
+        publish_time - 100,
+        publish_time,
+        publish_time + 250,
+    ]
+    assert triples[0][1:] == (None, None)
+    assert triples[1][1]["pt"] == publish_time
+    assert triples[1][2] == 0
+    assert triples[2][1]["id"] == race_change["id"]
+    assert triples[2][2] == 250
+
+
+def test_join_race_arrays_to_publish_times(
+    race_change: dict[str, Any], path_to_race_file: Path
+):
+    publish_time = race_change["rpc"]["ft"]
+    with smart_open.open(path_to_race_file, "a") as f:
+        f.write(
+            json.dumps(
+                {
+                    "op": "rcm",
+                    "clk": 1,
+                    "pt": publish_time + 100,
+                    "rc": [
+                        {
+                            "id": race_change["id"],
+                            "mid": race_change["mid"],
+                            "rpc": {"ft": publish_time + 100, "g": "1f", "prg": 1000},
+                            "rrc": [{"ft": publish_time + 100, "id": 123, "prg": 999}],
+                        }
+                    ],
+                }
+            )
+        )
+        f.write("\n")
+    race_arrays = race_file_to_arrays(path_to_race_file)
+    publish_times = [publish_time - 1, publish_time + 50, publish_time + 150] * 2
+    selection_ids = [50749188] * 3 + [123] * 3
+
+    columns = join_race_arrays_to_publish_times(publish_times, race_arrays)
+    assert set(columns) == {
+        "race_feed_time",
+        "race_sectional_time",
+        "race_running_time",
+        "race_speed",
+        "race_progress",
+        "race_jumps_remaining",
+        "race_gate",
+        "race_staleness",
+    }
+    np.testing.assert_array_equal(columns["race_progress"], [np.nan, 1106.4, 1000] * 2)
+    np.testing.assert_array_equal(columns["race_staleness"], [np.nan, 50, 50] * 2)
+    assert columns["race_gate"].tolist() == [None, "", "1f"] * 2
+
+    columns = join_race_arrays_to_publish_times(
+        publish_times, race_arrays, selection_ids=selection_ids
+    )
+    np.testing.assert_array_equal(
+        columns["progress"], [np.nan, 1106.4, 1106.4, np.nan, np.nan, 999]
+    )
+    np.testing.assert_array_equal(
+        columns["staleness"], [np.nan, 50, 150, np.nan, np.nan, 50]
+    )
+    np.testing.assert_array_equal(
+        columns["lat"], [np.nan, 40.3955184, 40.3955184, np.nan, np.nan, np.nan]
+    )
+
+
+def test_join_race_arrays_to_publish_times_without_race_progress(
+    race_change: dict[str, Any], tmp_path: Path
+):
+    publish_time = race_change["rpc"]["ft"]
+    path_to_race_file = tmp_path / "31945198.2354.jsonl"
+    with smart_open.open(path_to_race_file, "w") as f:
+        f.write(
+            json.dumps(
+                {
+                    "op": "rcm",
+                    "clk": 0,
+                    "pt": publish_time,
+                    "rc": [{k: v for k, v in race_change.items() if k != "rpc"}],
+                }
+            )
+        )
+        f.write("\n")
+    race_arrays = race_file_to_arrays(path_to_race_file)
+
+    columns = join_race_arrays_to_publish_times(
+        [publish_time - 1, publish_time + 50],
+        race_arrays,
+        selection_ids=[50749188] * 2,
+    )
+    np.testing.assert_array_equal(columns["race_progress"], [np.nan, np.nan])
+    np.testing.assert_array_equal(columns["race_staleness"], [np.nan, np.nan])
+    assert columns["race_gate"].tolist() == [None, None]
+    np.testing.assert_array_equal(columns["progress"], [np.nan, 1106.4])
+
+
+def test_generate_synthetic_prices_file(tmp_path: Path):
+    path_to_prices_file = tmp_path / "1.200000000.json.gz"
+    path_to_race_file = tmp_path / "31945198.1400.jsonl"
+    generate_synthetic_prices_file(
+        path_to_prices_file,
+        path_to_race_file=path_to_race_file,
+        number_of_markets=2,
+        number_of_runners=6,
+        pre_off_seconds=60,
+        inplay_seconds=30,
+        number_of_suspensions=2,
+    )
+
+    assert validate_prices_file(path_to_prices_file) == []
+    market_books = read_prices_file(path_to_prices_file, market_type_filter=["WIN"])
+    assert {mb["marketId"] for mb in market_books} == {"1.200000000"}
+    assert len(market_books[0]["runners"]) == 6
+    assert get_inplay_publish_time_from_prices_file(
+        path_to_prices_file
+    ) == datetime_to_publish_time(
+        datetime.datetime(2022, 4, 3, 14, tzinfo=datetime.timezone.utc)
+    )
+    assert [
+        mb["status"] for mb in market_books if mb["inplay"] and mb["status"] != "OPEN"
+    ].count("SUSPENDED") >= 3
+    assert market_books[-1]["status"] == "CLOSED"
+    assert calculate_total_matched(market_books[-1]) == 0
+    assert calculate_total_matched(market_books[-3]) > 0
+
+    race_changes = read_race_file(path_to_race_file)
+    assert race_changes[-1]["rpc"]["g"] == "Finish"
+    assert get_winners_from_market_definition(market_books[-1]["marketDefinition"]) == [
+        race_changes[-1]["rpc"]["ord"][0]
+    ]
+
+    path_to_first_prices_file = tmp_path / "first.json"
+    path_to_second_prices_file = tmp_path / "second.json"
+    for path in (path_to_first_prices_file, path_to_second_prices_file):
+        generate_synthetic_prices_file(
+            path, should_go_inplay=False, pre_off_seconds=10, ladder_depth=5, seed=1
+        )
+    assert (
+        path_to_first_prices_file.read_bytes()
+        == path_to_second_prices_file.read_bytes()
+    )
+    market_book = read_prices_file(path_to_first_prices_file)[-3]
+    assert not market_book["inplay"]
+    assert len(market_book["runners"][0]["ex"]["availableToBack"]) == 5
+
+    with pytest.raises(ValueError):
+        generate_synthetic_prices_file(
+            path_to_first_prices_file,
+            path_to_race_file=path_to_race_file,
+            should_go_inplay=False,
+        )
+    with pytest.raises(ValueError):
+        generate_synthetic_prices_file(path_to_first_prices_file, ladder_depth=0)
+
+
 def test_get_bsp_from_race_result(
     race_result: dict[str, Any], path_to_race_result_file: Path
 ):
@@ -1277,6 +2756,140 @@ def test_get_inplay_publish_time_from_prices_file(
     )
 
 
+def test_build_race_card_and_result_index(
+    race_card: dict[str, Any], race_result: dict[str, Any], tmp_path: Path
+):
+    from unittest.mock import patch
+
+    import betfairutil
+
+    path_to_directory = tmp_path / "races"
+    path_to_directory.mkdir()
+    with smart_open.open(path_to_directory / "32170433.1340-card.json", "w") as f:
+        f.write(json.dumps(race_card))
+    with smart_open.open(path_to_directory / "32170433.1340-result.json.gz", "w") as f:
+        f.write(json.dumps(race_result))
+    with smart_open.open(path_to_directory / "result.json", "w") as f:
+        f.write(json.dumps(race_result))
+    path_to_index_file = path_to_directory / "index.pkl"
+
+    expected = {
+        "32170433.1340": {
+            "win_market_id": "1.456",
+            "distance_in_metres": 914.4,
+            "is_jump": True,
+            "bsp": {123: 1.5, 456: 3.0},
+            "winners": [123],
+        },
+        str(path_to_directory / "result.json"): {
+            "win_market_id": None,
+            "distance_in_metres": None,
+            "is_jump": None,
+            "bsp": {123: 1.5, 456: 3.0},
+            "winners": [123],
+        },
+    }
+    assert (
+        build_race_card_and_result_index(
+            path_to_directory, path_to_index_file=path_to_index_file
+        )
+        == expected
+    )
+    assert path_to_index_file.exists()
+
+    with patch.object(
+        betfairutil,
+        "_summarise_race_card_or_result_file",
+        side_effect=AssertionError,
+    ):
+        assert (
+            build_race_card_and_result_index(
+                path_to_directory, path_to_index_file=path_to_index_file
+            )
+            == expected
+        )
+
+    race_card["race"]["raceType"]["full"] = "Flat"
+    with smart_open.open(path_to_directory / "32170433.1340-card.json", "w") as f:
+        f.write(json.dumps(race_card))
+    os.utime(path_to_directory / "32170433.1340-card.json", ns=(0, 0))
+    index = build_race_card_and_result_index(
+        path_to_directory, path_to_index_file=path_to_index_file
+    )
+    assert index["32170433.1340"]["is_jump"] is False
+
+    # Files which cannot be parsed are skipped and files which are not JSON are ignored
+    with open(path_to_directory / "32170434.1410-card.json", "w") as f:
+        f.write("{")
+    with open(path_to_directory / "README.txt", "w") as f:
+        f.write("{")
+    with pytest.warns(UserWarning, match="32170434.1410-card.json"):
+        index = build_race_card_and_result_index(
+            path_to_directory, path_to_index_file=path_to_index_file
+        )
+    assert index.keys() == expected.keys()
+
+    # The files can be parsed in parallel in worker processes
+    path_to_index_file.unlink()
+    with pytest.warns(UserWarning, match="32170434.1410-card.json"):
+        index = build_race_card_and_result_index(
+            path_to_directory, max_workers=2, should_use_processes=True
+        )
+    assert index.keys() == expected.keys()
+    assert index["32170433.1340"]["is_jump"] is False
+
+
+def test_race_card_and_result_cache(
+    race_card: dict[str, Any], race_result: dict[str, Any], tmp_path: Path
+):
+    path_to_race_card_file = tmp_path / "race-card.json"
+    with open(path_to_race_card_file, "w") as f:
+        f.write(json.dumps(race_card))
+    os.utime(path_to_race_card_file, ns=(0, 0))
+
+    assert get_is_jump_from_race_card(path_to_race_card_file) is True
+    assert get_win_market_id_from_race_card(path_to_race_card_file) == "1.456"
+    assert (
+        get_win_market_id_from_race_card(path_to_race_card_file, as_integer=True) == 456
+    )
+    # Asking a race card for a race result's values raises as it would without the cache
+    with pytest.raises(KeyError):
+        get_bsp_from_race_result(path_to_race_card_file)
+
+    race_card["race"]["raceType"]["full"] = "Flat"
+    with open(path_to_race_card_file, "w") as f:
+        f.write(json.dumps(race_card))
+    os.utime(path_to_race_card_file, ns=(0, 0))
+    assert get_is_jump_from_race_card(path_to_race_card_file) is True
+
+    os.utime(path_to_race_card_file, ns=(1, 1))
+    assert get_is_jump_from_race_card(path_to_race_card_file) is False
+
+    os.utime(path_to_race_card_file, ns=(0, 0))
+    assert get_is_jump_from_race_card(path_to_race_card_file) is True
+    clear_race_card_and_result_cache()
+    assert get_is_jump_from_race_card(path_to_race_card_file) is False
+
+    # Callers get their own copies of the cached values
+    path_to_race_result_file = tmp_path / "race-result.json"
+    with open(path_to_race_result_file, "w") as f:
+        f.write(json.dumps(race_result))
+    get_bsp_from_race_result(path_to_race_result_file).clear()
+    get_winners_from_race_result(path_to_race_result_file).clear()
+    assert get_bsp_from_race_result(path_to_race_result_file) == {123: 1.5, 456: 3.0}
+    assert get_winners_from_race_result(path_to_race_result_file) == [123]
+
+    set_race_card_and_result_cache_size(0)
+    try:
+        race_card["race"]["raceType"]["full"] = "Chase"
+        with open(path_to_race_card_file, "w") as f:
+            f.write(json.dumps(race_card))
+        os.utime(path_to_race_card_file, ns=(0, 0))
+        assert get_is_jump_from_race_card(path_to_race_card_file) is True
+    finally:
+        set_race_card_and_result_cache_size()
+
+
 def test_get_is_jump_from_race_card(race_card: dict[str, Any]):
     is_jump = get_is_jump_from_race_card(race_card)
     assert is_jump
@@ -1290,6 +2903,52 @@ def test_calculate_haversine_distance_between_runners(race_change: dict[str, Any
     assert haversine_distance == 0
 
 
+def test_calculate_haversine_distance_matrix(race_change: dict[str, Any]):
+    race_change["rrc"].append(
+        {"ft": 1670024522300, "id": 123, "long": -76.6609, "lat": 40.3958, "prg": 1100}
+    )
+    race_change["rrc"].append(
+        {"ft": 1670024522300, "id": 456, "long": -76.6612, "lat": 40.3951, "prg": 1090}
+    )
+
+    selection_ids, distances = calculate_haversine_distance_matrix(race_change)
+    assert selection_ids == [50749188, 123, 456]
+    assert distances.shape == (3, 3)
+    for i, rrc_a in enumerate(race_change["rrc"]):
+        for j, rrc_b in enumerate(race_change["rrc"]):
+            assert distances[i, j] == pytest.approx(
+                calculate_haversine_distance_between_runners(rrc_a, rrc_b)
+            )
+
+    race_change["rrc"] = None
+    selection_ids, distances = calculate_haversine_distance_matrix(race_change)
+    assert selection_ids == []
+    assert distances.shape == (0, 0)
+
+
+def test_calculate_haversine_distance_matrices():
+    latitudes = np.array([[40.3955, 40.3958, np.nan], [40.3956, 40.3959, 40.3951]])
+    longitudes = np.array(
+        [[-76.6608, -76.6609, np.nan], [-76.6607, -76.6610, -76.6612]]
+    )
+
+    distances = calculate_haversine_distance_matrices(latitudes, longitudes)
+    assert distances.shape == (2, 3, 3)
+    assert np.isnan(distances[0, 0, 2])
+    assert np.isnan(distances[0, 2, 1])
+    for t in range(2):
+        for i in range(3):
+            for j in range(3):
+                if t == 0 and 2 in (i, j):
+                    continue
+                assert distances[t, i, j] == pytest.approx(
+                    calculate_haversine_distance_between_runners(
+                        {"lat": latitudes[t, i], "long": longitudes[t, i]},
+                        {"lat": latitudes[t, j], "long": longitudes[t, j]},
+                    )
+                )
+
+
 def test_get_race_leaders(race_change: dict[str, Any]):
     race_leaders = get_race_leaders(race_change)
     assert race_leaders == {race_change["rrc"][0]["id"]}
@@ -1316,6 +2975,41 @@ def test_get_mid_price(market_book: dict[str, Any]):
     assert get_mid_price(runner_book) == pytest.approx(1.985)
 
 
+def test_get_first_market_books_from_prices_file(
+    market_book: dict[str, Any], path_to_prices_file_with_trades: Path
+):
+    publish_time = market_book["publishTime"]
+    assert (
+        get_first_market_books_from_prices_file(path_to_prices_file_with_trades, {})
+        == {}
+    )
+
+    evaluated_publish_times = []
+
+    def is_trade(mb: dict[str, Any]) -> bool:
+        evaluated_publish_times.append(mb["publishTime"])
+        return calculate_total_matched(mb) > 0
+
+    market_books = get_first_market_books_from_prices_file(
+        path_to_prices_file_with_trades,
+        {
+            "trade": is_trade,
+            "total_matched_above_5": lambda mb: calculate_total_matched(mb) > 5,
+            "never": lambda mb: False,
+        },
+    )
+    assert market_books["trade"]["publishTime"] == publish_time + 50
+    assert market_books["total_matched_above_5"]["publishTime"] == publish_time + 100
+    assert market_books["never"] is None
+    # Predicates are not evaluated once satisfied
+    assert evaluated_publish_times == [publish_time, publish_time + 50]
+
+    market_books = get_first_market_books_from_prices_file(
+        path_to_prices_file_with_trades, {"trade": is_trade}, lightweight=False
+    )
+    assert market_books["trade"].publish_time_epoch == publish_time + 50
+
+
 def test_get_total_volume_traded_from_prices_file(
     path_to_prices_file: Path,
     market_book: dict[str, Any],
@@ -1375,6 +3069,60 @@ def test_get_total_volume_traded_from_prices_file(
     assert total_volume_traded is None
 
 
+def test_get_total_volume_traded_from_prices_file_with_long_closure(
+    path_to_prices_file_with_trades: Path,
+    market_book: dict[str, Any],
+    market_definition: dict[str, Any],
+):
+    # More zeroing updates than the previous implementation's default deque length of 8
+    market_definition["status"] = "CLOSED"
+    for i in range(10):
+        write_to_prices_file(
+            publish_time=market_book["publishTime"] + 200 + 50 * i,
+            market_definition=market_definition,
+            rc=[{"id": 123, "trd": []}, {"id": 456, "trd": []}],
+            path_to_prices_file=path_to_prices_file_with_trades,
+            mode="a",
+        )
+    assert (
+        get_total_volume_traded_from_prices_file(path_to_prices_file_with_trades) == 10
+    )
+
+    for runner in market_definition["runners"]:
+        runner["status"] = "REMOVED"
+    write_to_prices_file(
+        publish_time=market_book["publishTime"] + 1000,
+        market_definition=market_definition,
+        rc=[],
+        path_to_prices_file=path_to_prices_file_with_trades,
+        mode="a",
+    )
+    assert (
+        get_total_volume_traded_from_prices_file(path_to_prices_file_with_trades)
+        is None
+    )
+
+
+def test_get_total_volume_traded_from_prices_file_with_reimage(
+    path_to_prices_file_with_reimage: Path,
+):
+    assert (
+        get_total_volume_traded_from_prices_file(path_to_prices_file_with_reimage) == 5
+    )
+
+
+def test_get_total_volume_traded_from_prices_file_deque_len(
+    path_to_prices_file_with_trades: Path,
+):
+    with pytest.warns(DeprecationWarning):
+        assert (
+            get_total_volume_traded_from_prices_file(
+                path_to_prices_file_with_trades, deque_len=8
+            )
+            == 10
+        )
+
+
 def test_publish_time_to_datetime():
     assert publish_time_to_datetime(None) is None
 
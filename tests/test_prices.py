@@ -5,6 +5,7 @@ from betfairlightweight.resources import RunnerBook
 
 from betfairutil import BETFAIR_PRICES
 from betfairutil import BETFAIR_PRICE_TO_PRICE_INDEX_MAP
+from betfairutil import calculate_virtual_ladders
 from betfairutil import decrement_price
 from betfairutil import get_inside_best_price
 from betfairutil import get_outside_best_price
@@ -16,6 +17,7 @@ from betfairutil import is_price_the_same_or_better
 from betfairutil import is_price_worse
 from betfairutil import make_price_betfair_valid
 from betfairutil import Side
+from betfairutil import VirtualLadderCalculator
 from betfairutil import virtualise_two_runner_price
 
 
@@ -300,3 +302,80 @@ def test_virtualise_two_runner_price():
     assert virtualise_two_runner_price(1000, Side.LAY, raw=True) == pytest.approx(
         1.001001
     )
+
+
+def test_calculate_virtual_ladders():
+    def make_runner(selection_id, atb, atl, status="ACTIVE"):
+        return {
+            "selectionId": selection_id,
+            "status": status,
+            "handicap": 0.0,
+            "ex": {
+                "availableToBack": [{"price": p, "size": s} for p, s in atb],
+                "availableToLay": [{"price": p, "size": s} for p, s in atl],
+                "tradedVolume": [],
+            },
+        }
+
+    market_book = {
+        "marketId": "1.123",
+        "runners": [
+            make_runner(1, [(1.5, 10), (1.49, 20)], [(1.52, 30)]),
+            make_runner(2, [(3.0, 10)], [(3.1, 5), (3.2, 5)]),
+            make_runner(3, [], [], status="REMOVED"),
+        ],
+    }
+    virtual_ladders = calculate_virtual_ladders(market_book)
+    assert virtual_ladders == {
+        1: {
+            "availableToBack": [
+                {"price": virtualise_two_runner_price(3.1, Side.LAY), "size": 10.5},
+                {"price": virtualise_two_runner_price(3.2, Side.LAY), "size": 11.0},
+            ],
+            "availableToLay": [
+                {"price": virtualise_two_runner_price(3.0, Side.BACK), "size": 20.0}
+            ],
+        },
+        2: {
+            "availableToBack": [
+                {"price": virtualise_two_runner_price(1.52, Side.LAY), "size": 15.6}
+            ],
+            "availableToLay": [
+                {"price": virtualise_two_runner_price(1.5, Side.BACK), "size": 5.0},
+                {"price": virtualise_two_runner_price(1.49, Side.BACK), "size": 9.8},
+            ],
+        },
+    }
+    assert calculate_virtual_ladders(market_book, max_depth=1)[1][
+        "availableToBack"
+    ] == [virtual_ladders[1]["availableToBack"][0]]
+
+    # Three runners: 1 / (1 - 1 / 4 - 1 / 4) = 2 and the size is limited by runner 3
+    market_book["runners"][1] = make_runner(2, [], [(4, 10)])
+    market_book["runners"][2] = make_runner(3, [], [(4, 5)])
+    assert calculate_virtual_ladders(market_book)[1]["availableToBack"] == [
+        {"price": 2, "size": 10}
+    ]
+    # 1 / (1 - 1 / 1.52 - 1 / 4) ~= 10.86 and the size is again limited by runner 3
+    assert calculate_virtual_ladders(market_book)[2]["availableToBack"] == [
+        {"price": 11, "size": 1.84}
+    ]
+
+    # Incremental updates give the same result as calculating from scratch
+    virtual_ladder_calculator = VirtualLadderCalculator()
+    virtual_ladder_calculator.update(market_book)
+    market_book = {
+        **market_book,
+        "runners": [
+            market_book["runners"][0],
+            make_runner(2, [(2.0, 2)], [(5, 10)]),
+            market_book["runners"][2],
+        ],
+    }
+    assert virtual_ladder_calculator.update(market_book) == calculate_virtual_ladders(
+        market_book
+    )
+    market_book["runners"][2] = make_runner(3, [(3.0, 2)], [(6, 10)], "REMOVED")
+    assert virtual_ladder_calculator.update(market_book) == calculate_virtual_ladders(
+        market_book
+    )